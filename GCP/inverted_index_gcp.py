@@ -9,6 +9,7 @@ from operator import itemgetter
 from time import time
 from pathlib import Path
 import pickle
+import numpy as np
 from google.cloud import storage
 from collections import defaultdict
 from contextlib import closing
@@ -86,6 +87,104 @@ class MultiFileReader:
 TUPLE_SIZE = 6       # We're going to pack the doc_id and tf values in this 
                      # many bytes.
 TF_MASK = 2 ** 16 - 1 # Masking the 16 low bits of an integer
+# On-disk layout of one posting: big-endian 4-byte doc_id, 2-byte tf.
+POSTING_DTYPE = np.dtype([('doc_id', '>u4'), ('tf', '>u2')])
+
+
+def decode_postings(b, n=None):
+    """ Decodes packed (doc_id, tf) postings in one vectorized pass and returns
+        them as native (uint32 doc_ids, uint16 tfs) arrays.
+    """
+    n = len(b) // TUPLE_SIZE if n is None else min(n, len(b) // TUPLE_SIZE)
+    if n == 0:
+        return np.empty(0, np.uint32), np.empty(0, np.uint16)
+    postings = np.frombuffer(b, dtype=POSTING_DTYPE, count=n)
+    return postings['doc_id'].astype(np.uint32), postings['tf'].astype(np.uint16)
+
+
+# Posting list encodings, recorded per index in `InvertedIndex.posting_format`
+# (indices pickled before it existed are POSTING_FORMAT_RAW).
+#   raw:    fixed 6-byte (doc_id << 16 | tf) tuples, tf clipped to 16 bits.
+#   varint: LEB128 varints of the doc id gaps, followed by LEB128 varints of
+#           the tfs; byte lengths are kept in `InvertedIndex.posting_nbytes`.
+POSTING_FORMAT_RAW = 'raw'
+POSTING_FORMAT_VARINT = 'varint'
+# longest LEB128 varint of a 64-bit value
+MAX_VARINT_BYTES = 10
+
+
+def encode_varints(values):
+    """ LEB128-encodes an array of non-negative integers in one vectorized pass. """
+    values = np.asarray(values, dtype=np.uint64)
+    if len(values) == 0:
+        return b''
+    n_bytes = np.ones(len(values), dtype=np.int64)
+    rest = values >> np.uint64(7)
+    while rest.any():
+        n_bytes += rest > 0
+        rest >>= np.uint64(7)
+    ends = np.cumsum(n_bytes)
+    starts = ends - n_bytes
+    out = np.empty(ends[-1], dtype=np.uint8)
+    for k in range(int(n_bytes.max())):
+        has = n_bytes > k
+        byte = (values[has] >> np.uint64(7 * k)) & np.uint64(0x7f)
+        more = (n_bytes[has] > k + 1).astype(np.uint64) << np.uint64(7)
+        out[starts[has] + k] = byte | more
+    return out.tobytes()
+
+
+def decode_varints(b, n):
+    """ Decodes the first `n` LEB128 varints of `b` in one vectorized pass.
+    Returns:
+    --------
+      (uint64 values, number of bytes they took)
+    Raises ValueError when `b` holds fewer than `n` varints or one longer
+    than 64 bits.
+    """
+    if n == 0:
+        return np.empty(0, dtype=np.uint64), 0
+    raw = np.frombuffer(b, dtype=np.uint8)
+    ends = np.flatnonzero(raw < 0x80)[:n]
+    if len(ends) < n:
+        raise ValueError(f"Truncated varints: {len(ends)} of {n} in {len(raw)} bytes")
+    used = int(ends[-1]) + 1
+    if used == n:
+        # every value fit in one byte (the common case for tfs)
+        return raw[:n].astype(np.uint64), used
+    raw = raw[:used]
+    starts = np.empty(n, dtype=np.int64)
+    starts[0] = 0
+    starts[1:] = ends[:-1] + 1
+    if int((ends - starts).max()) >= MAX_VARINT_BYTES:
+        raise ValueError(f"Corrupt varints: one is longer than {MAX_VARINT_BYTES} bytes")
+    # position of every byte within its varint
+    shift = np.arange(used, dtype=np.int64) - np.repeat(starts, ends - starts + 1)
+    parts = (raw & 0x7f).astype(np.uint64) << (7 * shift).astype(np.uint64)
+    return np.add.reduceat(parts, starts), used
+
+
+def encode_compressed(doc_ids, tfs):
+    """ Delta-gap varint encoding of one sorted posting list. """
+    doc_ids = np.asarray(doc_ids, dtype=np.uint64)
+    gaps = np.diff(doc_ids, prepend=np.uint64(0))
+    return encode_varints(gaps) + encode_varints(tfs)
+
+
+def decode_compressed(b, n):
+    """ Inverse of `encode_compressed`: (uint32 doc_ids, uint32 tfs).
+        `b` must be exactly the `n`-entry list (`InvertedIndex.posting_nbytes`
+        bytes); a truncated, padded or corrupt buffer raises ValueError.
+    """
+    gaps, used = decode_varints(b, n)
+    tfs, tfs_used = decode_varints(memoryview(b)[used:], n)
+    if used + tfs_used != len(b):
+        raise ValueError(f"Corrupt posting list: {n} postings take {used + tfs_used} bytes, "
+                         f"read {len(b)}")
+    doc_ids = np.cumsum(gaps)
+    if n and (doc_ids[-1] > 0xffffffff or tfs.max() > 0xffffffff):
+        raise ValueError("Corrupt posting list: doc id or tf past 32 bits")
+    return doc_ids.astype(np.uint32), tfs.astype(np.uint32)
 
 
 class InvertedIndex:  
@@ -152,13 +251,22 @@ class InvertedIndex:
         """
         with closing(MultiFileReader(base_dir, bucket_name)) as reader:
             for w, locs in self.posting_locs.items():
-                b = reader.read(locs, self.df[w] * TUPLE_SIZE)
-                posting_list = []
-                for i in range(self.df[w]):
-                    doc_id = int.from_bytes(b[i*TUPLE_SIZE:i*TUPLE_SIZE+4], 'big')
-                    tf = int.from_bytes(b[i*TUPLE_SIZE+4:(i+1)*TUPLE_SIZE], 'big')
-                    posting_list.append((doc_id, tf))
-                yield w, posting_list
+                doc_ids, tfs = self.decode(reader.read(locs, self.posting_size(w)), w)
+                yield w, list(zip(doc_ids.tolist(), tfs.tolist()))
+
+    def posting_size(self, w):
+        """ Number of bytes the posting list of `w` takes on disk. """
+        if getattr(self, 'posting_format', POSTING_FORMAT_RAW) == POSTING_FORMAT_VARINT:
+            return self.posting_nbytes[w]
+        return self.df[w] * TUPLE_SIZE
+
+    def decode(self, b, w):
+        """ Decodes the posting list of `w` read from disk into (doc_ids, tfs)
+            arrays, whatever the index's posting format.
+        """
+        if getattr(self, 'posting_format', POSTING_FORMAT_RAW) == POSTING_FORMAT_VARINT:
+            return decode_compressed(b, self.df[w])
+        return decode_postings(b, self.df[w])
 
     def read_a_posting_list(self, base_dir, w, bucket_name=None):
         posting_list = []
@@ -166,31 +274,44 @@ class InvertedIndex:
             return posting_list
         with closing(MultiFileReader(base_dir, bucket_name)) as reader:
             locs = self.posting_locs[w]
-            b = reader.read(locs, self.df[w] * TUPLE_SIZE)
-            for i in range(self.df[w]):
-                doc_id = int.from_bytes(b[i*TUPLE_SIZE:i*TUPLE_SIZE+4], 'big')
-                tf = int.from_bytes(b[i*TUPLE_SIZE+4:(i+1)*TUPLE_SIZE], 'big')
-                posting_list.append((doc_id, tf))
+            doc_ids, tfs = self.decode(reader.read(locs, self.posting_size(w)), w)
+            posting_list = list(zip(doc_ids.tolist(), tfs.tolist()))
         return posting_list
 
     @staticmethod
-    def write_a_posting_list(b_w_pl, base_dir, bucket_name=None):
+    def write_a_posting_list(b_w_pl, base_dir, bucket_name=None, compress=False):
+        """ Writes a bucket of (word, sorted posting list) pairs and pickles their
+            locations to `<bucket_id>_posting_locs.pickle`. With `compress`, lists
+            are written in the POSTING_FORMAT_VARINT encoding (no tf clipping)
+            and their byte lengths go to `<bucket_id>_posting_nbytes.pickle`;
+            merge both into the index and set its `posting_format`.
+        """
         posting_locs = defaultdict(list)
+        posting_nbytes = {}
         bucket_id, list_w_pl = b_w_pl
         
         with closing(MultiFileWriter(base_dir, bucket_id, bucket_name)) as writer:
             for w, pl in list_w_pl: 
                 # convert to bytes
-                b = b''.join([(doc_id << 16 | (tf & TF_MASK)).to_bytes(TUPLE_SIZE, 'big')
-                              for doc_id, tf in pl])
+                if compress:
+                    doc_ids, tfs = zip(*pl) if pl else ((), ())
+                    b = encode_compressed(doc_ids, tfs)
+                    posting_nbytes[w] = len(b)
+                else:
+                    b = b''.join([(doc_id << 16 | (tf & TF_MASK)).to_bytes(TUPLE_SIZE, 'big')
+                                  for doc_id, tf in pl])
                 # write to file(s)
                 locs = writer.write(b)
                 # save file locations to index
                 posting_locs[w].extend(locs)
-            path = str(Path(base_dir) / f'{bucket_id}_posting_locs.pickle')
             bucket = None if bucket_name is None else get_bucket(bucket_name)
+            path = str(Path(base_dir) / f'{bucket_id}_posting_locs.pickle')
             with _open(path, 'wb', bucket) as f:
                 pickle.dump(posting_locs, f)
+            if compress:
+                path = str(Path(base_dir) / f'{bucket_id}_posting_nbytes.pickle')
+                with _open(path, 'wb', bucket) as f:
+                    pickle.dump(posting_nbytes, f)
         return bucket_id
 
 
@@ -1,13 +1,26 @@
 import os
 import pickle
 
+import numpy as np
+
+from columnar_metadata import ColumnarMetadata, METADATA_PATH, PAGERANK, PAGEVIEWS
+
 
 class MetadataManager:
     """ניהול טעינה ושליפה של PageRank, PageViews ומיפוי כותרות [cite: 10, 56]"""
     def __init__(self, base_path="."):
-        self.pagerank = self._load(os.path.join(base_path, "pagerank.pkl"))
-        # pageviews צריכים להיות מאוגוסט 2021 [cite: 10]
-        self.pageviews = self._load(os.path.join(base_path, "pageviews.pkl"))
+        # metadata/metadata.cols (columnar_metadata.py) is memory-mapped, the pickles are the fallback
+        columnar_path = os.path.join(base_path, METADATA_PATH)
+        if os.path.exists(columnar_path):
+            metadata = ColumnarMetadata.load_file(columnar_path)
+        else:
+            metadata = ColumnarMetadata.build({
+                PAGERANK: self._load(os.path.join(base_path, "pagerank.pkl")),
+                # pageviews צריכים להיות מאוגוסט 2021 [cite: 10]
+                PAGEVIEWS: self._load(os.path.join(base_path, "pageviews.pkl")),
+            })
+        self.pagerank = metadata[PAGERANK]
+        self.pageviews = metadata[PAGEVIEWS]
         self.id_to_title = self._load(os.path.join(base_path, "id_to_title.pkl"))
 
     def _load(self, path):
@@ -17,7 +30,13 @@ class MetadataManager:
         return {}
 
     def get_pagerank(self, wiki_ids):
-        return [self.pagerank.get(wid, 0) for wid in wiki_ids]
+        return self.pagerank_array(wiki_ids).tolist()
 
     def get_pageview(self, wiki_ids):
-        return [self.pageviews.get(wid, 0) for wid in wiki_ids]
\ No newline at end of file
+        return self.pageview_array(wiki_ids).tolist()
+
+    def pagerank_array(self, wiki_ids):
+        return self.pagerank.lookup(np.asarray(wiki_ids, dtype=np.int64), 0)
+
+    def pageview_array(self, wiki_ids):
+        return self.pageviews.lookup(np.asarray(wiki_ids, dtype=np.int64), 0)
@@ -1,6 +1,6 @@
 import nltk
-from nltk.corpus import stopwords
-import re
+
+from tokenizer import Tokenizer
 
 # הורדת רשימת המילים - יש לבצע פעם אחת בתהליך ההתקנה
 # nltk.download('stopwords')
@@ -8,16 +8,12 @@ import re
 class QueryProcessor:
     """מעבד שאילתות המשתמש בספריית NLTK לניקוי מילים נפוצות """
     def __init__(self):
-        # טעינת רשימת ה-Stopwords באנגלית מהספרייה
-        self.stop_words = set(stopwords.words('english'))
-        # שימוש בטוקנייזר שהוגדר על ידי הסגל [cite: 20]
-        self.tokenizer = re.compile(r"""[\#\@\w](['\-]?\w)*""", re.UNICODE)
+        # שימוש בטוקנייזר שהוגדר על ידי הסגל [cite: 20], עם רשימת ה-Stopwords באנגלית
+        # המרה לאותיות קטנות לפני הפיצול (Lowercasing)
+        self.tokenizer = Tokenizer(r"""[\#\@\w](['\-]?\w)*""", lowercase_text=True)
+        self.stop_words = self.tokenizer.stop_words
 
     def tokenize(self, text):
         """המרת טקסט לרשימת טוקנים נקייה [cite: 20]"""
-        # 1. המרה לאותיות קטנות (Lowercasing)
-        text = text.lower()
-        # 2. פיצול למילים לפי ה-Regex של הסגל [cite: 20]
-        tokens = [token.group() for token in self.tokenizer.finditer(text)]
-        # 3. סינון מילים המופיעות בספריית NLTK
-        return [t for t in tokens if t not in self.stop_words]
\ No newline at end of file
+        # פיצול למילים לפי ה-Regex של הסגל וסינון מילים המופיעות בספריית NLTK
+        return self.tokenizer.tokenize(text, stem=False)
\ No newline at end of file
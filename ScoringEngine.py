@@ -1,5 +1,8 @@
 import math
+import threading
 from collections import Counter, defaultdict
+from contextlib import contextmanager
+import numpy as np
 class ScoringEngine:
     """לוגיקת החישובים המתמטיים [cite: 56, 64, 65]"""
 
@@ -41,4 +44,187 @@ class ScoringEngine:
                 postings = index.read_posting_list(term, ".")
                 for doc_id, _ in postings:
                     doc_counts[doc_id] += 1
-        return sorted(doc_counts.items(), key=lambda x: x[1], reverse=True)
\ No newline at end of file
+        return sorted(doc_counts.items(), key=lambda x: x[1], reverse=True)
+
+    @staticmethod
+    def bm25_term_scores(tfs, doc_len, idf, avgdl, k1=1.2, b=0.5):
+        """תרומת BM25 של מונח לכל posting. NaN lengths count as avgdl."""
+        tf = tfs.astype(np.float64)
+        doc_len = doc_len.astype(np.float64)
+        doc_len[np.isnan(doc_len)] = avgdl
+        numerator = tf * (k1 + 1)
+        denominator = tf + k1 * (1 - b + b * (doc_len / avgdl))
+        return idf * (numerator / denominator)
+
+    @staticmethod
+    def bm25_accumulate(acc, dense_ids, tfs, doc_lengths, idf, avgdl, k1=1.2, b=0.5):
+        """BM25 של רשימת postings שלמה בבת אחת, לתוך מערך צובר לפי מזהה צפוף.
+        dense_ids must be unique (one posting per document)."""
+        acc[dense_ids] += ScoringEngine.bm25_term_scores(tfs, doc_lengths[dense_ids], idf, avgdl, k1, b)
+        return acc
+
+    @staticmethod
+    def bm25_max_score(groups, k, doc_lengths, avgdl, k1=1.2, b=0.5):
+        """
+        MaxScore pruning for BM25 top-k.
+
+        groups: list of BM25Term lists. A document's score is the sum of its
+        per-group sums, each accumulated in the given term order - exactly how
+        exhaustive accumulation adds them up.
+
+        Terms are taken in decreasing upper-bound order, and which ones to
+        fetch is decided from df and the bounds before fetching: first the
+        highest-bound terms whose lists hold enough postings for k candidates,
+        then - once the k-th best partial score (theta) is known - the
+        essential terms, those before the low-bound suffix whose bounds sum to
+        less than theta. No document outside the essential lists can reach
+        the top-k. Candidates whose partial score plus the non-essential
+        terms' (block-max) bounds stays below theta are dropped, and the
+        non-essential lists are only probed for the survivors. Candidate state
+        is sparse: sorted doc ids with their partial scores.
+
+        Returns (dense_ids, scores) of a candidate set that contains the exact
+        top-k, with exact scores.
+        """
+        terms = [term for group in groups for term in group]
+        order = sorted(range(len(terms)), key=lambda i: -terms[i].bound)
+        # suffix[p] = sum of the bounds of the terms from position p on
+        suffix = np.append(np.cumsum([terms[i].bound for i in order][::-1])[::-1], 0.0).tolist()
+        dfs = np.cumsum([terms[i].df for i in order])
+        # slack for rounding: a tie with the k-th score could still win on the
+        # doc id tie-break
+        slack = 1 + 1e-9
+
+        ids = np.empty(0, np.int64)
+        partial = np.empty(0)
+        theta = None
+        done = 0
+        end = min(int(np.searchsorted(dfs, k)) + 1, len(order))
+        while done < len(order):
+            batch = [terms[i] for i in order[done:end]]
+            BM25Term.load_all(batch)
+            for term in batch:
+                dense_ids, tfs = term.load()
+                if len(dense_ids) == 0:
+                    continue
+                scores = ScoringEngine.bm25_term_scores(tfs, doc_lengths[dense_ids], term.idf, avgdl, k1, b)
+                ids, inverse = np.unique(np.concatenate([ids, dense_ids]), return_inverse=True)
+                partial = np.bincount(inverse, weights=np.concatenate([partial, scores]), minlength=len(ids))
+            done = end
+            theta = np.partition(partial, len(ids) - k)[len(ids) - k] if len(ids) >= k else None
+            if theta is None:
+                end = done + 1
+                continue
+            end = done
+            while end < len(order) and suffix[end] * slack >= theta:
+                end += 1
+            if end == done:
+                break
+
+        non_essential = [terms[i] for i in order[done:]]
+        candidates = ids
+        if theta is not None and non_essential:
+            upper = partial
+            for term in non_essential:
+                upper = upper + term.candidate_bounds(candidates)
+            candidates = candidates[upper * slack >= theta]
+        # lists without skip structure are read whole anyway - in one batch
+        BM25Term.load_all([term for term in non_essential if not term.partial_reads])
+
+        scores = np.zeros(len(candidates))
+        for group in groups:
+            group_scores = np.zeros(len(candidates))
+            for term in group:
+                dense_ids, tfs = term.load(candidates)
+                if len(dense_ids) == 0:
+                    continue
+                idx = np.searchsorted(dense_ids, candidates)
+                np.minimum(idx, len(dense_ids) - 1, out=idx)
+                found = dense_ids[idx] == candidates
+                group_scores[found] += ScoringEngine.bm25_term_scores(
+                    tfs[idx[found]], doc_lengths[candidates[found]], term.idf, avgdl, k1, b)
+            scores += group_scores
+        return candidates, scores
+
+
+class AccumulatorPool:
+    """מערכי צבירה צפופים (float64, אחד לכל מסמך) שנשמרים בין שאילתות.
+    A query takes one, adds into it and records the dense ids it added to;
+    only those entries are read back and zeroed, so a query costs its
+    postings, not n_docs. There are as many as there were concurrent queries."""
+    def __init__(self, n):
+        self.n = n
+        self._free = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def acquire(self):
+        """(accumulator, touched) - append every dense id array added into the
+        accumulator to touched; those entries are zeroed on exit."""
+        with self._lock:
+            acc = self._free.pop() if self._free else None
+        if acc is None:
+            acc = np.zeros(self.n)
+        touched = []
+        try:
+            yield acc, touched
+        finally:
+            AccumulatorPool.collect(acc, touched)
+            with self._lock:
+                self._free.append(acc)
+
+    @staticmethod
+    def collect(acc, touched):
+        """(sorted dense ids, scores) of the touched entries, which are then
+        zeroed and touched emptied."""
+        ids = np.unique(np.concatenate(touched)) if touched else np.empty(0, np.int64)
+        values = acc[ids]
+        acc[ids] = 0
+        touched.clear()
+        return ids, values
+
+
+class BM25Term:
+    """מונח שאילתה עבור ScoringEngine.bm25_max_score: idf, חסם עליון, df ו-postings.
+    dense_ids sorted ascending, tfs aligned with them. Without postings, they
+    are fetched on first use by fetch(terms), which loads a list of terms at
+    once - terms sharing a fetch are read in one batch."""
+    # True when load(candidates) reads less than the whole list
+    partial_reads = False
+
+    def __init__(self, idf, bound, dense_ids=None, tfs=None, df=None, fetch=None, term=None):
+        self.term = term
+        self.idf = idf
+        self.bound = bound
+        self.dense_ids = dense_ids
+        self.tfs = tfs
+        self.df = len(dense_ids) if df is None and dense_ids is not None else df
+        self.fetch = fetch
+
+    def set_postings(self, dense_ids, tfs):
+        self.dense_ids = dense_ids
+        self.tfs = tfs
+
+    def load(self, candidates=None):
+        """(dense_ids, tfs) - all postings, or at least those of `candidates`."""
+        if self.dense_ids is None:
+            self.fetch([self])
+        return self.dense_ids, self.tfs
+
+    @staticmethod
+    def load_all(terms):
+        """Loads the whole lists of terms, one fetch per batch of terms sharing it."""
+        batches = {}
+        for term in terms:
+            if term.dense_ids is not None:
+                continue
+            if term.fetch is None:
+                term.load()
+            else:
+                batches.setdefault(term.fetch, []).append(term)
+        for fetch, batch in batches.items():
+            fetch(batch)
+
+    def candidate_bounds(self, candidates):
+        """upper bound of this term's contribution to each candidate"""
+        return np.full(len(candidates), self.bound)
@@ -1,12 +1,34 @@
+import heapq
 import math
 import pickle
 import re
 from collections import Counter, defaultdict
-from nltk.stem.porter import PorterStemmer
-from nltk.corpus import stopwords
 from google.cloud import storage
 import sys
+import os
+import json
+import time
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 import inverted_index_gcp
+from inverted_index_gcp import GCSStore, LocalStore, MultiFileReader
+from remote_store import HTTPRangeStore, gcs_range_store
+from posting_cache import PostingCache
+from doc_index import DocIdMap
+from title_store import TitleStore
+from title_forward_index import TitleForwardIndex
+from lexicon import Lexicon, lexicon_path
+from columnar_metadata import ColumnarMetadata, METADATA_PATH, PAGERANK, PAGEVIEWS, DOC_LENGTH
+from ScoringEngine import ScoringEngine, BM25Term, AccumulatorPool
+from topk import top_k, top_k_items
+from block_max_index import BlockMaxReader, BlockMaxTerm, BLOCK_MAX_FORMAT
+from query_plan import QueryPlan
+from query_cache import QueryCache
+from startup_loader import StartupLoader
+from tokenizer import Tokenizer
+import tracing
+import numpy as np
 import io
 
 old_module_names = [
@@ -20,11 +42,69 @@ for name in old_module_names:
     sys.modules[name] = inverted_index_gcp
 
 BUCKET_NAME = "db204905756"
+# Set to a local mirror of the bucket (gsutil -m rsync -r gs://db204905756 DIR)
+# to serve postings from memory-mapped files instead of GCS.
+LOCAL_INDEX_DIR_ENV = "IR_LOCAL_INDEX_DIR"
+# Set to an HTTP object endpoint (or "gcs" for the bucket's XML API) to fetch
+# postings with pooled, concurrent byte-range requests.
+REMOTE_INDEX_URL_ENV = "IR_REMOTE_INDEX_URL"
+# Memory budget of the decoded posting list cache, and an optional query log
+# (queries_train.json or one query per line) to warm it with at startup.
+POSTING_CACHE_MB_ENV = "IR_POSTING_CACHE_MB"
+DEFAULT_POSTING_CACHE_MB = 512
+WARM_QUERIES_ENV = "IR_WARM_QUERIES"
+# the tokenizer precomputes the stems of this many of the highest-df terms of
+# the (unstemmed) title and anchor indices on a background thread once the
+# backend is ready; 0 skips it
+PRECOMPILE_TERMS_ENV = "IR_PRECOMPILE_TERMS"
+DEFAULT_PRECOMPILE_TERMS = 50000
+# BM25 upper bounds are used for MaxScore only when the k1, b and avgdl they
+# were computed with (`bm25_params`) match the query's; avgdl up to this
+# relative rounding, which the MaxScore slack absorbs
+BOUNDS_AVGDL_REL_TOL = 1e-12
+# search() computes body/title/anchor concurrently on a shared bounded pool;
+# a signal that misses its timeout (seconds) is fused as empty.
+SIGNAL_WORKERS_ENV = "IR_SIGNAL_WORKERS"
+DEFAULT_SIGNAL_WORKERS = 8
+SIGNAL_TIMEOUT_ENV = "IR_SIGNAL_TIMEOUT"
+DEFAULT_SIGNAL_TIMEOUT = 30.0
+# Whole results of search/search_body/search_title/search_anchor are cached
+# per normalized query (0 entries disables the cache), under the version of
+# the loaded indices - the INDEX_VERSION object of the bucket when there is
+# one, a fingerprint of the loaded indices otherwise. The indices are loaded
+# once, so serving a new version takes a restart.
+RESULT_CACHE_SIZE_ENV = "IR_RESULT_CACHE_SIZE"
+DEFAULT_RESULT_CACHE_SIZE = 10000
+# ...and by the memory of the cached results (MB per process)
+RESULT_CACHE_MB_ENV = "IR_RESULT_CACHE_MB"
+DEFAULT_RESULT_CACHE_MB = 128
+RESULT_CACHE_TTL_ENV = "IR_RESULT_CACHE_TTL"
+DEFAULT_RESULT_CACHE_TTL = 600.0
+INDEX_VERSION_PATH = "INDEX_VERSION"
+# Artifacts are fetched concurrently at startup by this many threads; the
+# indices nothing on the query path reads are loaded lazily on first use.
+STARTUP_WORKERS_ENV = "IR_STARTUP_WORKERS"
+DEFAULT_STARTUP_WORKERS = 8
+# The queries of one search_many batch are scored by this many threads.
+BATCH_WORKERS_ENV = "IR_BATCH_WORKERS"
+DEFAULT_BATCH_WORKERS = 4
 
 def get_gcs_client():
     """Get or create GCS client."""
     return storage.Client()
 
+def make_store(local_dir=None, remote_url=None):
+    """Local mirror if one is configured, then a ranged HTTP store, the GCS bucket otherwise."""
+    local_dir = local_dir or os.environ.get(LOCAL_INDEX_DIR_ENV)
+    if local_dir:
+        return LocalStore(local_dir)
+    remote_url = remote_url or os.environ.get(REMOTE_INDEX_URL_ENV)
+    if remote_url == "gcs":
+        return gcs_range_store(BUCKET_NAME)
+    if remote_url:
+        return HTTPRangeStore(remote_url)
+    return GCSStore(BUCKET_NAME)
+
 class RenameUnpickler(pickle.Unpickler):
     def find_class(self, module, name):
         old_modules = [
@@ -39,110 +119,333 @@ class RenameUnpickler(pickle.Unpickler):
             return getattr(inverted_index_gcp, name)
         return super().find_class(module, name)
 
+def load_query_log(path):
+    """Queries from a queries_train.json style file or a plain one-per-line log."""
+    with open(path, encoding='utf-8') as f:
+        text = f.read()
+    try:
+        queries = json.loads(text)
+    except ValueError:
+        return [line.strip() for line in text.splitlines() if line.strip()]
+    return list(queries)
+
+def frequent_terms(index, n):
+    """The n terms of index with the highest df - from the df column when it is a frozen lexicon."""
+    lexicon = getattr(index, 'lexicon', None)
+    if lexicon is None:
+        return heapq.nlargest(n, index.df, key=index.df.get)
+    df = lexicon.arrays['df']
+    rows = np.argpartition(df, -n)[-n:] if n < len(df) else np.arange(len(df))
+    return [lexicon.term(i) for i in rows[df[rows] > 0].tolist()]
+
 def renamed_load(file_obj):
     return RenameUnpickler(file_obj).load()
 
 def read_pickle_from_gcs(bucket_name, blob_path):
-    client = storage.Client()
-    bucket = client.bucket(bucket_name)
-    blob = bucket.blob(blob_path)
-    if not blob.exists():
-        raise FileNotFoundError(f"Missing: gs://{bucket_name}/{blob_path}")
-    return RenameUnpickler(io.BytesIO(blob.download_as_bytes())).load()
+    return read_pickle(GCSStore(bucket_name), blob_path)
+
+def read_pickle(store, path):
+    return RenameUnpickler(io.BytesIO(store.read_bytes(path))).load()
+
+def read_index(store, path):
+    """The index pickled at path - from its frozen lexicon (lexicon.py) when there is one."""
+    try:
+        return Lexicon.load(store, lexicon_path(path)).index()
+    except FileNotFoundError:
+        return read_pickle(store, path)
 
 
 class BackendClass:
-    def __init__(self):
+    def __init__(self, store=None, posting_cache=None, result_cache=None, loader=None):
         self.body_stem_index = None
-        self.title_stem_index = None
         self.title_nostem_index = None
         self.anchor_index = None
-        self.title_phrase_index = None
         self.body_phrase_index = None
         self.page_rank = {}
         self.page_views = {}
         self.doc_lengths = {}
         self.id_to_title = {}
-        self.stop_words = frozenset(stopwords.words('english'))
-        self.stemmer = PorterStemmer()
-        self.RE_WORD = re.compile(r"[\#\@\w](['\-]?\w){2,24}", re.UNICODE)
-        self.gcs_client = storage.Client()
-        self.bucket = self.gcs_client.bucket(BUCKET_NAME)
-
-        BUCKET_NAME_LOCAL = "db204905756"
-
-        print("Loading Indices")
-        self.body_stem_index = read_pickle_from_gcs(BUCKET_NAME_LOCAL, 'postings_gcp/index.pkl')
-        self.title_stem_index = read_pickle_from_gcs(BUCKET_NAME_LOCAL, 'title_stemmed/index.pkl')
-        self.title_nostem_index = read_pickle_from_gcs(BUCKET_NAME_LOCAL, 'title_nostem/index.pkl')
-        self.anchor_index = read_pickle_from_gcs(BUCKET_NAME_LOCAL, 'anchor_index/anchor_index.pkl')
+        self.tokenizer = Tokenizer()
+        self.stop_words = self.tokenizer.stop_words
+        self.stemmer = self.tokenizer.stemmer
+        self.RE_WORD = self.tokenizer.re_word
+        self.store = store if store is not None else make_store()
+        if posting_cache is None:
+            cache_mb = float(os.environ.get(POSTING_CACHE_MB_ENV, DEFAULT_POSTING_CACHE_MB))
+            posting_cache = PostingCache(int(cache_mb * 2**20))
+        self.posting_cache = posting_cache
+        if result_cache is None:
+            result_cache = QueryCache(int(os.environ.get(RESULT_CACHE_SIZE_ENV, DEFAULT_RESULT_CACHE_SIZE)),
+                                      float(os.environ.get(RESULT_CACHE_TTL_ENV, DEFAULT_RESULT_CACHE_TTL)),
+                                      int(float(os.environ.get(RESULT_CACHE_MB_ENV, DEFAULT_RESULT_CACHE_MB)) * 2**20))
+        self.result_cache = result_cache
+        # MaxScore pruning of body retrieval, used when the indices have bounds
+        self.body_pruning = True
+        self.concurrent_signals = True
+        self.signal_pool = ThreadPoolExecutor(
+            max_workers=int(os.environ.get(SIGNAL_WORKERS_ENV, DEFAULT_SIGNAL_WORKERS)),
+            thread_name_prefix='signal')
+        timeout = float(os.environ.get(SIGNAL_TIMEOUT_ENV, DEFAULT_SIGNAL_TIMEOUT))
+        self.signal_timeouts = {'body': timeout, 'title': timeout, 'anchor': timeout}
+
+        print("Loading Indices, Metadata and Title Mappings")
+        start = time.perf_counter()
+        if loader is None:
+            loader = StartupLoader(self.store, int(os.environ.get(STARTUP_WORKERS_ENV, DEFAULT_STARTUP_WORKERS)))
+        self.loader = loader
+        loader.add('body_stem_index', lambda s: read_index(s, 'postings_gcp/index.pkl'))
+        loader.add('title_nostem_index', lambda s: read_index(s, 'title_nostem/index.pkl'))
+        loader.add('anchor_index', lambda s: read_index(s, 'anchor_index/anchor_index.pkl'))
         #######
         #phrase testing:
-        self.title_phrase_index = read_pickle_from_gcs(BUCKET_NAME_LOCAL, 'title_stemmed_phrases_idx/index.pkl')
-        self.body_phrase_index = read_pickle_from_gcs(BUCKET_NAME_LOCAL, 'body_stemmed_phrases_idx/index.pkl')
+        loader.add('body_phrase_index', lambda s: read_index(s, 'body_stemmed_phrases_idx/index.pkl'))
+        # not on the query path - loaded on first use
+        loader.add('title_stem_index', lambda s: read_index(s, 'title_stemmed/index.pkl'), lazy=True)
+        loader.add('title_phrase_index', lambda s: read_index(s, 'title_stemmed_phrases_idx/index.pkl'), lazy=True)
         
         # Phrases not needed - unigrams work better
 
-        print("Loading Metadata")
-        self.page_rank = read_pickle_from_gcs(BUCKET_NAME_LOCAL, 'pr/pr.pkl')
-        self.page_views = read_pickle_from_gcs(BUCKET_NAME_LOCAL, 'page_views/pageview.pkl')
+        loader.add('body_block_reader', self._load_block_reader)
+        loader.add('metadata', self._load_metadata)
+        loader.add('id_to_title', self._load_titles)
+        loader.add('title_forward', self._load_title_forward)
+        loader.add('doc_map', self._load_doc_map)
+        artifacts = loader.wait()
 
-        try:
-            self.doc_lengths = read_pickle_from_gcs(BUCKET_NAME_LOCAL, 'postings_gcp/doc_lengths.pkl')
-        except:
-            self.doc_lengths = read_pickle_from_gcs(BUCKET_NAME_LOCAL, 'postings_gcp/doc_lengths.pickle')
-
-        print("Loading Title Mappings")
-        even = read_pickle_from_gcs(BUCKET_NAME_LOCAL, 'id_title/even_id_title_dict.pkl')
-        odd = read_pickle_from_gcs(BUCKET_NAME_LOCAL, 'id_title/uneven_id_title_dict.pkl')
-        self.id_to_title = {**even, **odd}
+        self.body_stem_index = artifacts['body_stem_index']
+        self.title_nostem_index = artifacts['title_nostem_index']
+        self.anchor_index = artifacts['anchor_index']
+        self.body_phrase_index = artifacts['body_phrase_index']
+        self.body_block_reader = artifacts['body_block_reader']
+        self.metadata = artifacts['metadata']
+        self.page_rank = self.metadata[PAGERANK]
+        self.page_views = self.metadata[PAGEVIEWS]
+        self.doc_lengths = self.metadata[DOC_LENGTH]
+        self.id_to_title = artifacts['id_to_title']
+        self.title_forward = artifacts['title_forward']
         
         self.N = len(self.id_to_title)
+
+        self.doc_map = artifacts['doc_map']
+        if self.doc_map is None:
+            self.doc_map = DocIdMap.build(self.doc_lengths, self.id_to_title.keys())
+        # reused dense body score accumulators, one per concurrent query
+        self.accumulators = AccumulatorPool(self.doc_map.n_docs)
+        # indices whose BM25 bounds were found not to match, logged once each
+        self._stale_bounds = set()
         #maoing for the indexes
         self.index_gcs_dirs = {
-            id(self.body_stem_index): 'postings_gcp',
-            id(self.title_stem_index): 'title_stemmed',
-            id(self.title_nostem_index): 'title_nostem',
-            id(self.anchor_index): 'anchor_postings_gcp',
-            id(self.title_phrase_index): 'title_stemmed_phrases_idx',
-            id(self.body_phrase_index): 'body_stemmed_phrases_idx'
+            'body_stem_index': 'postings_gcp',
+            'title_stem_index': 'title_stemmed',
+            'title_nostem_index': 'title_nostem',
+            'anchor_index': 'anchor_postings_gcp',
+            'title_phrase_index': 'title_stemmed_phrases_idx',
+            'body_phrase_index': 'body_stemmed_phrases_idx'
         }
+        self.index_version = self.read_index_version()
+        print(f"Loaded in {time.perf_counter() - start:.2f}s")
 
+        warm_path = os.environ.get(WARM_QUERIES_ENV)
+        if warm_path:
+            print("Warming Posting Cache")
+            queries = load_query_log(warm_path)
+            self.tokenizer.precompile(t for q in queries for t in self.tokenizer.words(q))
+            print(self.warm_posting_cache(queries))
+
+        self.precompiled = False
+        self.start_precompile()
         print("Backend ready!")
 
+    @property
+    def title_stem_index(self):
+        return self.loader.get('title_stem_index')
+
+    @property
+    def title_phrase_index(self):
+        return self.loader.get('title_phrase_index')
+
+    def start_precompile(self):
+        """
+        stem the IR_PRECOMPILE_TERMS highest-df title and anchor terms into the
+        tokenizer's table on a background thread; queries stem on demand meanwhile
+        """
+        n_terms = int(os.environ.get(PRECOMPILE_TERMS_ENV, DEFAULT_PRECOMPILE_TERMS))
+        if n_terms <= 0 or self.precompiled:
+            return
+
+        def precompile():
+            start = time.perf_counter()
+            for index in (self.title_nostem_index, self.anchor_index):
+                self.tokenizer.precompile(frequent_terms(index, n_terms))
+            self.precompiled = True
+            print(f"Precompiled stems in {time.perf_counter() - start:.2f}s")
+        threading.Thread(target=precompile, name='precompile', daemon=True).start()
+
+    def after_fork(self):
+        """
+        re-create the per-process state in a forked worker (prefork_server.py):
+        thread pools and pooled connections do not survive fork(), and neither
+        does an unfinished precompile
+        """
+        self.signal_pool = ThreadPoolExecutor(
+            max_workers=int(os.environ.get(SIGNAL_WORKERS_ENV, DEFAULT_SIGNAL_WORKERS)),
+            thread_name_prefix='signal')
+        if hasattr(self.store, 'after_fork'):
+            self.store.after_fork()
+        self.start_precompile()
+
+    def _load_block_reader(self, store):
+        # optional block-max copy of the body postings (block_max_index.py)
+        try:
+            block_index = read_index(store, 'postings_gcp_block_max/index.pkl')
+        except FileNotFoundError:
+            return None
+        return BlockMaxReader(block_index, 'postings_gcp_block_max', self.store, self.posting_cache)
+
+    def _load_metadata(self, store):
+        try:
+            # columnar file written by columnar_metadata.py - mapped, not unpickled
+            return ColumnarMetadata.load(store, METADATA_PATH)
+        except FileNotFoundError:
+            pass
+        try:
+            doc_lengths = read_pickle(store, 'postings_gcp/doc_lengths.pkl')
+        except:
+            doc_lengths = read_pickle(store, 'postings_gcp/doc_lengths.pickle')
+        return ColumnarMetadata.build({
+            PAGERANK: read_pickle(store, 'pr/pr.pkl'),
+            PAGEVIEWS: read_pickle(store, 'page_views/pageview.pkl'),
+            DOC_LENGTH: doc_lengths,
+        })
+
+    def _load_titles(self, store):
+        try:
+            # blob + offsets written by title_store.py - mapped, decoded per result
+            return TitleStore.load(store)
+        except FileNotFoundError:
+            return TitleStore.build((read_pickle(store, 'id_title/even_id_title_dict.pkl'),
+                                     read_pickle(store, 'id_title/uneven_id_title_dict.pkl')))
+
+    def _load_title_forward(self, store):
+        # optional title tokens per doc (title_forward_index.py) for the title penalty
+        try:
+            return TitleForwardIndex.load(store)
+        except FileNotFoundError:
+            return None
+
+    def _load_doc_map(self, store):
+        # None when there is no saved map; it is then built from the metadata
+        try:
+            return DocIdMap.load(store)
+        except FileNotFoundError:
+            return None
+
+    def read_index_version(self):
+        """
+        version of the served indices - the INDEX_VERSION object if the bucket
+        has one, otherwise a fingerprint of what was loaded
+        """
+        try:
+            return self.store.read_bytes(INDEX_VERSION_PATH).decode().strip()
+        except FileNotFoundError:
+            return self.index_fingerprint()
+
+    def index_fingerprint(self):
+        """hash of the shape (doc counts, df totals, formats) of the loaded indices"""
+        shape = [self.N, self.doc_map.n_docs]
+        for index in (self.body_stem_index, self.title_nostem_index,
+                      self.anchor_index, self.body_phrase_index):
+            if index is not None:
+                total_df = index.df.values()
+                total_df = int(total_df.sum()) if isinstance(total_df, np.ndarray) else sum(total_df)
+                shape.append((len(index.df), total_df, getattr(index, 'posting_format', None)))
+        return hashlib.sha1(repr(shape).encode()).hexdigest()
+
+    def cached(self, endpoint, query, compute):
+        """
+        compute(plan) through the result cache, keyed by the endpoint and the
+        normalized (tokenized, lowercased, stopword-free) query. Cached
+        results are shared - treat them as read-only. Partial results (a
+        signal timed out) are returned but not cached.
+        """
+        plan = self.plan(query)
+        if self.result_cache is None:
+            return compute(plan)
+        return self.result_cache.get_or_compute((endpoint, tuple(plan.tokens)),
+                                                lambda: compute(plan), self.index_version,
+                                                lambda: not plan.partial)
+
     def read_posting_list_from_gcs(self, index, term, gcs_folder):
         """
         callin for the psoting list from GCP
         """
-        if term not in index.posting_locs:
-            return []
-        
-        posting_list = []
-        locs = index.posting_locs[term]
-        TUPLE_SIZE = 6
-        
-        for file_name, offset in locs:
-            if '/' in file_name:
-                file_name = file_name.split('/')[-1]
+        return self.read_posting_lists(index, [term], gcs_folder).get(term, [])
 
-            blob_path = f"{gcs_folder}/{file_name}"
-            blob = self.bucket.blob(blob_path)
-            
-            if not blob.exists():
+    def read_posting_lists(self, index, terms, gcs_folder):
+        """
+        posting lists of all the query terms - cached ones from the posting
+        cache, the rest fetched in one batch (ranged, concurrent and coalesced
+        when the store supports it)
+        """
+        postings = {}
+        missing = []
+        for term in dict.fromkeys(terms):
+            if term not in index.posting_locs:
                 continue
-            
-            data = blob.download_as_bytes()
-            
-            # read the posting list
-            num_entries = index.df[term]
-            for i in range(num_entries):
-                pos = offset + (i * TUPLE_SIZE)
-                if pos + TUPLE_SIZE <= len(data):
-                    doc_id = int.from_bytes(data[pos:pos+4], 'big')
-                    tf = int.from_bytes(data[pos+4:pos+TUPLE_SIZE], 'big')
-                    posting_list.append((doc_id, tf))
-        
-        return posting_list
+            posting_list = self.posting_cache.get((gcs_folder, term))
+            if posting_list is None:
+                missing.append(term)
+            else:
+                postings[term] = posting_list
+        if postings:
+            tracing.count('ir_posting_lists_read_total', len(postings), source='cache')
+        if missing:
+            tracing.count('ir_posting_lists_read_total', len(missing), source='store')
+            postings.update(self._fetch_posting_lists(index, missing, gcs_folder))
+        return postings
+
+    def _fetch_posting_lists(self, index, terms, gcs_folder):
+        reader = MultiFileReader(gcs_folder, store=self.store)
+        # only the bytes of each term's list, split across files at BLOCK_SIZE
+        requests = [(index.posting_locs[t], index.posting_size(t)) for t in terms]
+        start = time.perf_counter()
+        try:
+            with tracing.stage('download'):
+                chunks = reader.read_many(requests)
+        except FileNotFoundError:
+            if len(terms) == 1:
+                return {}
+            # term by term so one missing file skips only its terms
+            postings = {}
+            for term in terms:
+                postings.update(self._fetch_posting_lists(index, [term], gcs_folder))
+            return postings
+        fetch_cost = (time.perf_counter() - start) / len(terms)
+        tracing.count('ir_postings_fetched_total', len(terms), folder=gcs_folder)
+        tracing.count('ir_posting_bytes_fetched_total', sum(len(data) for data in chunks), folder=gcs_folder)
+
+        postings = {}
+        with tracing.stage('decode'):
+            for term, data in zip(terms, chunks):
+                start = time.perf_counter()
+                posting_list = index.decode(data, term)
+                cost = fetch_cost + time.perf_counter() - start
+                self.posting_cache.put((gcs_folder, term), posting_list, posting_list.nbytes, cost)
+                postings[term] = posting_list
+        return postings
+
+    def warm_posting_cache(self, queries):
+        """
+        load every posting list the given queries touch into the posting cache
+        """
+        for query in queries:
+            plan = self.plan(query)
+            plan.read_posting_lists(self.body_stem_index, plan.stemmed_tokens, 'postings_gcp')
+            if self.body_phrase_index is not None:
+                plan.read_posting_lists(self.body_phrase_index, plan.bigrams, 'body_stemmed_phrases_idx')
+            plan.read_posting_lists(self.title_nostem_index, plan.tokens, 'postings_title_nostem')
+            plan.read_posting_lists(self.anchor_index, plan.tokens, 'anchor_postings_gcp')
+        return self.posting_cache.stats()
 
     def create_bigrams(self, tokens):
         """create bigram from the tokens list"""
@@ -153,10 +456,7 @@ class BackendClass:
         return bigrams
     
     def tokenize(self, text, stem=True):
-        tokens = [token.group().lower() for token in self.RE_WORD.finditer(text)]
-        if stem:
-            return [self.stemmer.stem(t) for t in tokens if t not in self.stop_words]
-        return [t for t in tokens if t not in self.stop_words]
+        return self.tokenizer.tokenize(text, stem)
     
     def extract_phrases(self, tokens):
         """
@@ -167,70 +467,302 @@ class BackendClass:
             phrases.append(bigram)
         return phrases
 
+    @tracing.timed('plan')
+    def plan(self, query, fetch=None):
+        """
+        QueryPlan of the query - tokenized, stemmed and split into bigrams once,
+        shared by all the signals. A plan is returned as is. Posting lists are
+        read through fetch (default read_posting_lists).
+        """
+        if isinstance(query, QueryPlan):
+            return query
+        tokens = self.tokenize(query, stem=False)
+        stemmed_tokens = [self.tokenizer.stem(t) for t in tokens]
+        return QueryPlan(query, tokens, stemmed_tokens, self.create_bigrams(stemmed_tokens),
+                         fetch or self.read_posting_lists)
+
     def search(self, query):
-        tokens = self.tokenize(query, stem=True)
-        if not tokens:
+        return self.cached('search', query, self._search)
+
+    def search_many(self, queries, max_workers=None):
+        """
+        search() of many queries at once, results in input order. The posting
+        lists of all the queries' terms are read in one batch per index and
+        each is decoded once for the whole batch, then the queries are scored
+        on a thread pool (IR_BATCH_WORKERS threads)
+        """
+        # one plan shared by the batch holds every list fetched for it
+        batch = QueryPlan(None, [], [], [], self.read_posting_lists)
+        plans = [self.plan(query, batch.read_posting_lists) for query in queries]
+        tokens = [t for plan in plans for t in plan.tokens]
+        batch.read_posting_lists(self.title_nostem_index, tokens, 'postings_title_nostem')
+        batch.read_posting_lists(self.anchor_index, tokens, 'anchor_postings_gcp')
+        # with block-max postings the body lists are read block by block instead
+        if self.body_block_reader is None:
+            batch.read_posting_lists(self.body_stem_index, [t for plan in plans for t in plan.stemmed_tokens],
+                                     'postings_gcp')
+        if self.body_phrase_index is not None:
+            batch.read_posting_lists(self.body_phrase_index, [t for plan in plans for t in plan.bigrams],
+                                     'body_stemmed_phrases_idx')
+        if max_workers is None:
+            max_workers = int(os.environ.get(BATCH_WORKERS_ENV, DEFAULT_BATCH_WORKERS))
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='batch') as pool:
+            return list(pool.map(tracing.propagate(self.search), plans))
+
+    def _search(self, plan):
+        if not plan.tokens:
             return []
 
-        body_results_raw = self.get_body_scores(query)
-        title_results_raw = self.get_title_scores(query)
-        anchor_results_raw = self.get_anchor_incoming_score(query)  # Query-Specific PageRank!
+        signals, timed_out = self.run_signals({
+            'body': (self.get_body_top_k, (plan, 500)),
+            'title': (self.get_title_scores, (plan,)),
+            'anchor': (self.get_anchor_incoming_score, (plan,)),  # Query-Specific PageRank!
+        })
+        if timed_out:
+            plan.partial = True
+        body_sorted = signals['body'] or []
+        title_results_raw = signals['title'] or {}
+        anchor_results_raw = signals['anchor'] or {}
+
+        with tracing.stage('fusion'):
+            top_ids = self._fuse(body_sorted, title_results_raw, anchor_results_raw)
+        return self.with_titles(top_ids)
 
-        body_sorted = sorted(body_results_raw.items(), key=lambda x: x[1], reverse=True)[:500]
-        title_sorted = sorted(title_results_raw.items(), key=lambda x: x[1], reverse=True)[:500]
-        anchor_sorted = sorted(anchor_results_raw.items(), key=lambda x: x[1], reverse=True)[:500]
+    def _fuse(self, body_sorted, title_results_raw, anchor_results_raw):
+        """ids of the top 100 by the weighted, normalized signal scores"""
+        title_sorted = top_k(title_results_raw, 500)
+        anchor_sorted = top_k(anchor_results_raw, 500)
         
         body_dict = dict(body_sorted)
         title_dict = dict(title_sorted)
         anchor_dict = dict(anchor_sorted)
 
-        candidate_ids = set(body_dict.keys()) | set(title_dict.keys()) | set(anchor_dict.keys())
+        candidate_ids = list(set(body_dict.keys()) | set(title_dict.keys()) | set(anchor_dict.keys()))
 
         #normalize the wieght
         max_body = max(body_dict.values()) if body_dict else 1
         max_title = max(title_dict.values()) if title_dict else 1
         max_anchor = max(anchor_dict.values()) if anchor_dict else 1
         
-        candidate_prs = [self.page_rank.get(int(doc_id), 0) for doc_id in candidate_ids]
+        candidate_prs = self.page_rank.lookup(np.array(candidate_ids, dtype=np.int64), 0).tolist()
         max_pr = max(candidate_prs) if candidate_prs else 1
 
         final_scores = []
-        for doc_id in candidate_ids:
+        for doc_id, pr in zip(candidate_ids, candidate_prs):
             s_body = (body_dict.get(doc_id, 0) / max_body)
             s_title = (title_dict.get(doc_id, 0) / max_title)
             s_anchor = (anchor_dict.get(doc_id, 0) / max_anchor)
 
-            pr = self.page_rank.get(int(doc_id), 0)
             pr_normalized = pr / max_pr  # נרמול!
-            pv = self.page_views.get(int(doc_id), 0)
 
             score = (0.3 * s_body) + (0.5 * s_title) + (0.15 * s_anchor) + (0.05 * pr_normalized)  # Max title!
 
-            title = self.id_to_title.get(int(doc_id), "Unknown")
-            final_scores.append((str(doc_id), title, score))
+            final_scores.append((int(doc_id), score))
 
-        final_scores.sort(key=lambda x: x[2], reverse=True)
-        return [(res[0], res[1]) for res in final_scores[:100]]
+        final_ids, final_values = zip(*final_scores) if final_scores else ((), ())
+        return [doc_id for doc_id, _ in top_k_items(final_ids, final_values, 100)]
+
+    @tracing.timed('titles')
+    def with_titles(self, doc_ids):
+        """(str(doc_id), title) results - only these titles get decoded"""
+        doc_ids = list(doc_ids)
+        titles = self.id_to_title.titles(np.array(doc_ids, dtype=np.int64), "Unknown")
+        return [(str(doc_id), title) for doc_id, title in zip(doc_ids, titles)]
     
+    def run_signals(self, signals):
+        """
+        run the {name: (fn, args)} signal computations - concurrently on the
+        signal pool, each with its own timeout counted from when it starts
+        running (or from submission while it waits in the pool's queue), or
+        one after another when concurrent_signals is off. Returns
+        ({name: result}, [names of the signals that timed out]). A signal
+        that times out gives None; its thread is not interrupted and finishes
+        in the background.
+        """
+        if not self.concurrent_signals:
+            return {name: fn(*args) for name, (fn, args) in signals.items()}, []
+        started = {}
+
+        def run(name, fn, args):
+            started[name] = time.monotonic()
+            return fn(*args)
+        submitted = time.monotonic()
+        futures = {name: self.signal_pool.submit(tracing.propagate(run), name, fn, args)
+                   for name, (fn, args) in signals.items()}
+        results = {}
+        timed_out = []
+        for name, future in futures.items():
+            timeout = self.signal_timeouts.get(name, DEFAULT_SIGNAL_TIMEOUT)
+            while True:
+                began = started.get(name)
+                deadline = (submitted if began is None else began) + timeout
+                try:
+                    results[name] = future.result(timeout=max(0.0, deadline - time.monotonic()))
+                    break
+                except FutureTimeoutError:
+                    if began is None and name in started:
+                        # started while we waited - its timeout runs from then
+                        continue
+                    print(f"Signal {name} timed out after {timeout}s")
+                    results[name] = None
+                    timed_out.append(name)
+                    break
+        return results, timed_out
+
     def get_body_scores(self, query):
         """החזר dict של {doc_id: score} לגוף - with BM25 + phrases!"""
-        tokens = self.tokenize(query, stem=False)
-        if not tokens:
-            return {}
+        doc_ids, values = self.get_body_score_arrays(query)
+        return dict(zip(doc_ids.tolist(), values.tolist()))
+
+    @tracing.timed('body')
+    def get_body_top_k(self, query, k):
+        """
+        top-k body (doc_id, score) pairs - with MaxScore pruning when the body
+        indices carry BM25 upper bounds, exhaustive otherwise. Both give the
+        exact same results. query is a string or a QueryPlan.
+        """
+        plan = self.plan(query)
+        if self.body_pruning:
+            if not plan.tokens:
+                return []
+            groups = [self._bm25_bounded_terms(plan.stemmed_tokens, self.body_stem_index, 'postings_gcp',
+                                               plan=plan)]
+            if plan.bigrams and self.body_phrase_index is not None:
+                groups.append(self._bm25_bounded_terms(plan.bigrams, self.body_phrase_index,
+                                                       'body_stemmed_phrases_idx', plan=plan))
+            if all(group is not None for group in groups):
+                try:
+                    dense_ids, values = self.bm25_max_score(groups, k)
+                    return top_k_items(self.doc_map.to_wiki(dense_ids).astype(np.int64), values, k)
+                except LookupError:
+                    # a block-max posting outside the doc id map
+                    pass
+        return top_k_items(*self.get_body_score_arrays(plan), k)
+
+    @tracing.timed('maxscore')
+    def bm25_max_score(self, groups, k):
+        """(dense ids, scores) of the top-k body documents by MaxScore over the BM25Term groups"""
+        return ScoringEngine.bm25_max_score(groups, k, self.doc_map.doc_lengths, self.get_avgdl())
+
+    def _bm25_bounded_terms(self, tokens, index, gcs_folder, k1=1.2, b=0.5, plan=None):
+        """
+        BM25Term per query term, in the order calculate_bm25_dense adds them
+        up - from df and the bounds only; each term's postings are fetched
+        when bm25_max_score first needs them (LookupError if one falls outside
+        the doc id map). None when the index has no bounds for these BM25
+        parameters.
+        """
+        unique_terms = set(tokens)
+        if index is self.body_stem_index and self.body_block_reader is not None:
+            terms = self._block_max_terms(unique_terms, index, k1, b, plan)
+            if terms is not None:
+                return terms
         
-        stemmed_tokens = [self.stemmer.stem(t) for t in tokens]
-        bigrams = self.create_bigrams(stemmed_tokens)
+        bounds = getattr(index, 'bm25_max', None)
+        if not bounds or not self.bm25_bounds_match(gcs_folder, getattr(index, 'bm25_params', None), k1, b):
+            return None
         
-        unigram_scores = self.calculate_bm25(stemmed_tokens, self.body_stem_index, 'postings_gcp')
+        dfs = plan.term_stats(index, unique_terms) if plan is not None else index.df
+
+        def fetch(batch):
+            postings = (plan or self).read_posting_lists(index, [t.term for t in batch], gcs_folder)
+            for t in batch:
+                posting_list = postings.get(t.term)
+                if posting_list is None:
+                    t.set_postings(np.empty(0, np.int64), np.empty(0, np.uint16))
+                    continue
+                dense_ids = self.doc_map.to_dense(posting_list.doc_ids)
+                if len(dense_ids) and dense_ids.min() < 0:
+                    raise LookupError(f"posting of {t.term!r} outside the doc id map")
+                tfs = posting_list.tfs
+                if np.any(dense_ids[1:] <= dense_ids[:-1]):
+                    order = np.argsort(dense_ids, kind='stable')
+                    dense_ids, tfs = dense_ids[order], tfs[order]
+                t.set_postings(dense_ids, tfs)
+
+        terms = []
+        for term in unique_terms:
+            if term not in dfs or term not in index.posting_locs:
+                continue
+            if term not in bounds:
+                return None
+            df = dfs[term]
+            idf = math.log((self.N - df + 0.5) / (df + 0.5) + 1.0)
+            terms.append(BM25Term(idf, idf * bounds[term], df=df, fetch=fetch, term=term))
+        return terms
+
+    def bm25_bounds_match(self, name, params, k1, b):
+        """
+        whether the BM25 bounds of index `name`, computed with `params`
+        ({'k1', 'b', 'avgdl'}), hold for k1, b and the collection's avgdl;
+        a mismatch is logged once per index, which is then scored exhaustively
+        """
+        avgdl = self.get_avgdl()
+        if params is not None and params.get('k1') == k1 and params.get('b') == b and \
+                math.isclose(params.get('avgdl', 0.0), avgdl, rel_tol=BOUNDS_AVGDL_REL_TOL):
+            return True
+        if name not in self._stale_bounds:
+            self._stale_bounds.add(name)
+            print(f"BM25 bounds of {name} were computed with {params}, not k1={k1}, b={b}, "
+                  f"avgdl={avgdl}; scoring it without MaxScore")
+        return False
+
+    def _block_max_terms(self, unique_terms, index, k1, b, plan=None):
+        """BlockMaxTerm per query term - postings are read block by block, on demand"""
+        block_index = self.body_block_reader.index
+        if getattr(block_index, 'posting_format', None) != BLOCK_MAX_FORMAT or \
+                not self.bm25_bounds_match(self.body_block_reader.base_dir, block_index.bm25_params, k1, b):
+            return None
+        dfs = plan.term_stats(index, unique_terms) if plan is not None else index.df
+        fetch = BlockMaxTerm.fetcher(self.body_block_reader, self.doc_map, plan)
+        terms = []
+        for term in unique_terms:
+            if term not in dfs or term not in block_index.posting_locs:
+                continue
+            df = dfs[term]
+            idf = math.log((self.N - df + 0.5) / (df + 0.5) + 1.0)
+            terms.append(BlockMaxTerm(self.body_block_reader, term, idf, self.doc_map, df, plan, fetch))
+        return terms
+
+    def get_body_score_arrays(self, query):
+        """
+        body BM25 + phrases as parallel (wiki doc_id, score) arrays of the
+        matched documents, straight from the dense accumulator
+        """
+        plan = self.plan(query)
+        if not plan.tokens:
+            return np.empty(0, np.int64), np.empty(0)
         
-        if bigrams and hasattr(self, 'body_phrase_index') and self.body_phrase_index is not None:
-            phrase_scores = self.calculate_bm25(bigrams, self.body_phrase_index, 'body_stemmed_phrases_idx')
-            for doc_id, score in phrase_scores.items():
-                unigram_scores[doc_id] = unigram_scores.get(doc_id, 0) + score
+        with self.accumulators.acquire() as (acc, touched):
+            _, unigram_scores = self.calculate_bm25_dense(plan.stemmed_tokens, self.body_stem_index,
+                                                          'postings_gcp', plan=plan, acc=acc, touched=touched)
+            matched, values = AccumulatorPool.collect(acc, touched)
+            
+            if plan.bigrams and hasattr(self, 'body_phrase_index') and self.body_phrase_index is not None:
+                _, phrase_scores = self.calculate_bm25_dense(plan.bigrams, self.body_phrase_index,
+                                                             'body_stemmed_phrases_idx', plan=plan,
+                                                             acc=acc, touched=touched)
+                phrase_ids, phrase_values = AccumulatorPool.collect(acc, touched)
+                # unigram sum + phrase sum per document, as two dense arrays would add up
+                merged = np.union1d(matched, phrase_ids)
+                merged_values = np.zeros(len(merged))
+                merged_values[np.searchsorted(merged, matched)] = values
+                merged_values[np.searchsorted(merged, phrase_ids)] += phrase_values
+                matched, values = merged, merged_values
+                for doc_id, score in phrase_scores.items():
+                    unigram_scores[doc_id] = unigram_scores.get(doc_id, 0) + score
         
-        return unigram_scores
+        # every posting adds a positive BM25 term, so non-zero = matched
+        nonzero = values != 0
+        doc_ids = self.doc_map.to_wiki(matched[nonzero]).astype(np.int64)
+        values = values[nonzero]
+        if unigram_scores:
+            doc_ids = np.concatenate([doc_ids, np.fromiter(unigram_scores.keys(), np.int64)])
+            values = np.concatenate([values, np.fromiter(unigram_scores.values(), np.float64)])
+        return doc_ids, values
     
 
+    @tracing.timed('title')
     def get_title_scores(self, query):
         """
         Smart IDF-Weighted Title with Missing Word Penalty
@@ -238,34 +770,42 @@ class BackendClass:
         import math
         from collections import defaultdict
         
-        tokens = self.tokenize(query, stem=False)
+        plan = self.plan(query)
+        tokens = plan.tokens
         if not tokens:
             return {}
         
-        stemmed_tokens = [self.stemmer.stem(t) for t in tokens]
         scores = defaultdict(float)
         
         # Calculate IDF for each query term (use nostem index - the one we have!)
         query_idfs = {}
-        for token in tokens:  # Use original tokens, not stemmed
-            if token in self.title_nostem_index.df:
-                df = self.title_nostem_index.df[token]
-                query_idfs[token] = math.log10(self.N / df) if df > 0 else 0
+        for token, df in plan.term_stats(self.title_nostem_index, tokens).items():  # Use original tokens, not stemmed
+            query_idfs[token] = math.log10(self.N / df) if df > 0 else 0
         
         # Sum IDF of matching terms
+        try:
+            postings = plan.read_posting_lists(
+                self.title_nostem_index, query_idfs, 'postings_title_nostem'
+            )
+        except:
+            postings = {}
         for token, idf in query_idfs.items():
-            try:
-                for doc_id, tf in self.read_posting_list_from_gcs(
-                    self.title_nostem_index, token, 'postings_title_nostem'
-                ):
-                    scores[doc_id] += idf
-            except:
-                continue
+            for doc_id, tf in postings.get(token, []):
+                scores[doc_id] += idf
         
         # Penalty for missing rare words
-        for doc_id in list(scores.keys()):
-            title = self.id_to_title.get(doc_id, '').lower()
-            title_tokens = set(self.tokenize(title, stem=False))  # No stem to match
+        candidates = list(scores.keys())
+        if self.title_forward is not None:
+            with tracing.stage('title_penalty'):
+                penalties = self.title_missing_penalties(candidates, tokens, query_idfs)
+            for doc_id, missing_penalty in zip(candidates, penalties):
+                scores[doc_id] -= missing_penalty
+            return scores
+        candidate_titles = self.id_to_title.titles(np.array(candidates, dtype=np.int64), '')
+        # No stem to match
+        title_token_lists = self.tokenizer.tokenize_many((t.lower() for t in candidate_titles), stem=False)
+        for doc_id, title_tokens in zip(candidates, title_token_lists):
+            title_tokens = set(title_tokens)
             
             missing_penalty = 0
             for token in tokens:  # Check original tokens
@@ -278,12 +818,29 @@ class BackendClass:
         
         return scores
     
+    def title_missing_penalties(self, doc_ids, tokens, query_idfs):
+        """
+        the missing rare word penalty of each doc, from the title forward
+        index - one membership check per rare query token instead of
+        tokenizing every title
+        """
+        rare = [(token, query_idfs.get(token, 0)) for token in tokens if query_idfs.get(token, 0) > 3.5]
+        penalties = np.zeros(len(doc_ids))
+        if not rare:
+            return penalties.tolist()
+        in_title = self.title_forward.contains(
+            doc_ids, [self.title_forward.term_id(token) for token, _ in rare])
+        for j, (token, idf) in enumerate(rare):  # same order as the per-title sum
+            penalties += np.where(in_title[:, j], 0.0, idf * 0.15)
+        return penalties.tolist()
+
     def get_anchor_scores(self, query):
         """החזר dict של {doc_id: score} ל-anchor"""
-        tokens = self.tokenize(query, stem=False)
+        tokens = self.plan(query).tokens
         if not tokens:
             return {}
 
+    @tracing.timed('anchor')
     def get_anchor_incoming_score(self, query):
         """
         Query-Specific PageRank!
@@ -291,30 +848,33 @@ class BackendClass:
         import math
         from collections import defaultdict
         
-        tokens = self.tokenize(query, stem=False)
+        plan = self.plan(query)
+        tokens = plan.tokens
         if not tokens:
             return {}
         
         scores = defaultdict(float)
         
+        try:
+            postings = plan.read_posting_lists(self.anchor_index, tokens, 'anchor_postings_gcp')
+        except Exception as e:
+            postings = {}
+        
+        anchor_dfs = plan.term_stats(self.anchor_index, tokens)
         for token in tokens:
-            if token not in self.anchor_index.df:
+            if token not in anchor_dfs:
                 continue
             
-            df = self.anchor_index.df[token]
+            df = anchor_dfs[token]
             idf = math.log10(self.N / df) if df > 0 else 0
             
-            try:
-                for doc_id, anchor_count in self.read_posting_list_from_gcs(
-                    self.anchor_index, token, 'anchor_postings_gcp'
-                ):
-                    scores[doc_id] += idf * math.log1p(anchor_count)
-            except Exception as e:
-                continue
+            for doc_id, anchor_count in postings.get(token, []):
+                scores[doc_id] += idf * math.log1p(anchor_count)
         
         return scores
         return self.get_overlap_score(tokens, self.anchor_index, 'anchor_postings_gcp')
 
+    @tracing.timed('bm25')
     def calculate_bm25(self, tokens, index, gcs_folder, k1=1.2, b=0.5):
         """
         BM25 scoring - better than TF-IDF for IR!
@@ -323,14 +883,13 @@ class BackendClass:
         """
         scores = defaultdict(float)
         
-        # Calculate average document length
-        if not hasattr(self, '_avgdl'):
-            self._avgdl = sum(self.doc_lengths.values()) / len(self.doc_lengths) if self.doc_lengths else 1
-        avgdl = self._avgdl
+        avgdl = self.get_avgdl()
         
         query_counts = Counter(tokens)
+        unique_terms = set(tokens)  # Unique terms only
+        postings = self.read_posting_lists(index, unique_terms, gcs_folder)
         
-        for term in set(tokens):  # Unique terms only
+        for term in unique_terms:
             if term not in index.df:
                 continue
                 
@@ -338,7 +897,7 @@ class BackendClass:
             # BM25 IDF (different from TF-IDF!)
             idf = math.log((self.N - df + 0.5) / (df + 0.5) + 1.0)
             
-            for doc_id, tf in self.read_posting_list_from_gcs(index, term, gcs_folder):
+            for doc_id, tf in postings.get(term, []):
                 doc_len = self.doc_lengths.get(doc_id, avgdl)
                 
                 # BM25 formula
@@ -349,50 +908,192 @@ class BackendClass:
         
         return scores
 
-    def get_overlap_score(self, tokens, index, gcs_folder):
+    def get_avgdl(self):
+        """Calculate average document length"""
+        if not hasattr(self, '_avgdl'):
+            lengths = self.doc_lengths.values()
+            self._avgdl = float(np.sum(lengths, dtype=np.float64)) / len(lengths) if len(lengths) else 1
+        return self._avgdl
+
+    @tracing.timed('bm25')
+    def calculate_bm25_dense(self, tokens, index, gcs_folder, k1=1.2, b=0.5, plan=None, acc=None, touched=None):
+        """
+        Vectorized BM25 - same scores as calculate_bm25, but whole posting
+        arrays are scored at once into a float64 accumulator indexed by dense
+        doc id (a new one unless acc is given; the dense ids added to are
+        appended to touched). Returns (accumulator, {doc_id: score}) where the
+        dict only holds postings of documents missing from the doc id map.
+        Postings and df come through the query plan when one is given.
+        """
+        if acc is None:
+            acc = np.zeros(self.doc_map.n_docs)
+        outside = defaultdict(float)
+        avgdl = self.get_avgdl()
+        
+        unique_terms = set(tokens)
+        postings = (plan or self).read_posting_lists(index, unique_terms, gcs_folder)
+        dfs = plan.term_stats(index, unique_terms) if plan is not None else index.df
+        
+        for term in unique_terms:
+            if term not in dfs or term not in postings:
+                continue
+            
+            df = dfs[term]
+            idf = math.log((self.N - df + 0.5) / (df + 0.5) + 1.0)
+            
+            posting_list = postings[term]
+            dense_ids = self.doc_map.to_dense(posting_list.doc_ids)
+            known = dense_ids >= 0
+            if known.all():
+                ScoringEngine.bm25_accumulate(acc, dense_ids, posting_list.tfs,
+                                              self.doc_map.doc_lengths, idf, avgdl, k1, b)
+                if touched is not None:
+                    touched.append(dense_ids)
+                continue
+            ScoringEngine.bm25_accumulate(acc, dense_ids[known], posting_list.tfs[known],
+                                          self.doc_map.doc_lengths, idf, avgdl, k1, b)
+            if touched is not None:
+                touched.append(dense_ids[known])
+            for doc_id, tf in zip(posting_list.doc_ids[~known].tolist(), posting_list.tfs[~known].tolist()):
+                doc_len = self.doc_lengths.get(doc_id, avgdl)
+                outside[doc_id] += idf * (tf * (k1 + 1) / (tf + k1 * (1 - b + b * (doc_len / avgdl))))
+        
+        return acc, outside
+
+    @tracing.timed('cosine')
+    def calculate_cosine_similarity(self, tokens, index, gcs_folder, plan=None):
+        """
+        TF-IDF cosine as ScoringEngine.cosine_similarity computes it - query
+        tf-idf times document tf / length times idf (idf = log10(N/df)),
+        divided by the query norm; the indices keep no document norms.
+        Returns parallel (wiki doc_id, score) arrays of the matched documents.
+        """
+        query_counts = Counter(tokens)
+        postings = (plan or self).read_posting_lists(index, query_counts, gcs_folder)
+        dfs = plan.term_stats(index, query_counts) if plan is not None else index.df
+        doc_ids, weights = [], []
+        q_norm_sq = 0.0
+        for term, freq in query_counts.items():
+            if not dfs.get(term):
+                continue
+            idf = math.log10(self.N / dfs[term])
+            q_tfidf = freq / len(tokens) * idf
+            q_norm_sq += q_tfidf ** 2
+            posting_list = postings.get(term)
+            if posting_list is None or len(posting_list) == 0:
+                continue
+            dense_ids = self.doc_map.to_dense(posting_list.doc_ids)
+            known = dense_ids >= 0
+            lengths = np.ones(len(dense_ids))
+            lengths[known] = self.doc_map.doc_lengths[dense_ids[known]]
+            # unknown (NaN) or empty documents count as length 1
+            lengths[~(lengths > 0)] = 1
+            doc_ids.append(posting_list.doc_ids)
+            weights.append(q_tfidf * idf * posting_list.tfs / lengths)
+        if not doc_ids or q_norm_sq == 0:
+            return np.empty(0, np.int64), np.empty(0)
+        unique_ids, inverse = np.unique(np.concatenate(doc_ids), return_inverse=True)
+        return unique_ids.astype(np.int64), np.bincount(inverse, np.concatenate(weights)) / math.sqrt(q_norm_sq)
+
+    def get_overlap_score(self, tokens, index, gcs_folder, plan=None):
         scores = defaultdict(float)
         unique_tokens = set(tokens)
+        postings = (plan or self).read_posting_lists(index, unique_tokens, gcs_folder)
+        dfs = plan.term_stats(index, unique_tokens) if plan is not None else index.df
         
         for term in unique_tokens:
-            if term in index.df:
-                for doc_id, freq in self.read_posting_list_from_gcs(index, term, gcs_folder):
+            if term in dfs:
+                for doc_id, freq in postings.get(term, []):
                     scores[doc_id] += 1
         
         return scores
 
     def search_body(self, query):
-        tokens = self.tokenize(query, stem=False)
-        if not tokens:
+        return self.cached('search_body', query, self._search_body)
+
+    def _search_body(self, plan):
+        if not plan.tokens:
             return []
 
-        stemmed_tokens = [self.stemmer.stem(t) for t in tokens]
-        scores = self.calculate_cosine_similarity(stemmed_tokens, self.body_stem_index, 'postings_gcp')
+        doc_ids, values = self.calculate_cosine_similarity(plan.stemmed_tokens, self.body_stem_index,
+                                                           'postings_gcp', plan=plan)
 
-        sorted_results = sorted(scores.items(), key=lambda x: x[1], reverse=True)[:100]
-        return [(str(doc_id), self.id_to_title.get(doc_id, "Unknown")) for doc_id, _ in sorted_results]
+        sorted_results = top_k_items(doc_ids, values, 100)
+        return self.with_titles(doc_id for doc_id, _ in sorted_results)
 
     def search_title(self, query):
-        tokens = self.tokenize(query, stem=False)
-        if not tokens:
-            return []
-        
-        scores = self.get_overlap_score(tokens, self.title_nostem_index, 'postings_title_nostem')
-        
-        sorted_results = sorted(scores.items(), key=lambda x: x[1], reverse=True)
-        return [(str(doc_id), self.id_to_title.get(doc_id, "Unknown")) for doc_id, _ in sorted_results]
+        return self.cached('search_title', query, self._search_title)
+
+    def _search_title(self, plan):
+        return self.with_titles(self._title_ranking(plan).tolist())
+
+    def _title_ranking(self, plan):
+        return self.overlap_ranking(plan, self.title_nostem_index, 'postings_title_nostem')
 
     def search_anchor(self, query):
-        tokens = self.tokenize(query, stem=False)
-        if not tokens:
-            return []
-        
-        scores = self.get_overlap_score(tokens, self.anchor_index, 'anchor_postings_gcp')
-        
-        sorted_results = sorted(scores.items(), key=lambda x: x[1], reverse=True)
-        return [(str(doc_id), self.id_to_title.get(doc_id, "Unknown")) for doc_id, _ in sorted_results]
+        return self.cached('search_anchor', query, self._search_anchor)
+
+    def _search_anchor(self, plan):
+        return self.with_titles(self._anchor_ranking(plan).tolist())
+
+    def _anchor_ranking(self, plan):
+        return self.overlap_ranking(plan, self.anchor_index, 'anchor_postings_gcp')
+
+    @tracing.timed('overlap')
+    def overlap_ranking(self, plan, index, gcs_folder):
+        """
+        doc ids matching any query term in index, ordered by the number of
+        distinct terms matched, then doc id - top_k(get_overlap_score(...))
+        without the dict
+        """
+        unique_tokens = set(plan.tokens)
+        postings = plan.read_posting_lists(index, unique_tokens, gcs_folder)
+        dfs = plan.term_stats(index, unique_tokens)
+        arrays = [postings[t].doc_ids for t in unique_tokens if t in dfs and t in postings]
+        if not arrays:
+            return np.empty(0, np.int64)
+        doc_ids, counts = np.unique(np.concatenate(arrays).astype(np.int64), return_counts=True)
+        # stable: doc ids stay ascending within each count
+        return doc_ids[np.argsort(-counts, kind='stable')]
+
+    def ranked_ids(self, endpoint, query):
+        """
+        the full ranking of search_title / search_anchor as a doc id array,
+        through the result cache - pages and streams only decode the titles
+        of the rows they return
+        """
+        ranking = {'search_title': self._title_ranking, 'search_anchor': self._anchor_ranking}[endpoint]
+        return self.cached(endpoint + '_ids', query, ranking)
+
+    def search_page(self, endpoint, query, offset=0, limit=None):
+        """
+        (results[offset:offset + limit], total number of results) of
+        search_title / search_anchor
+        """
+        doc_ids = self.ranked_ids(endpoint, query)
+        stop = None if limit is None else offset + limit
+        return self.with_titles(doc_ids[offset:stop].tolist()), len(doc_ids)
+
+    def iter_search(self, endpoint, query, offset=0, limit=None, chunk_size=1000):
+        """
+        results of search_title / search_anchor as successive lists of up to
+        chunk_size, with the titles of each chunk decoded as it is reached
+        """
+        doc_ids = self.ranked_ids(endpoint, query)
+        stop = len(doc_ids) if limit is None else min(len(doc_ids), offset + limit)
+        for start in range(offset, stop, chunk_size):
+            yield self.with_titles(doc_ids[start:min(start + chunk_size, stop)].tolist())
 
     def get_pagerank(self, wiki_ids):
-        return [self.page_rank.get(int(doc_id), 0) for doc_id in wiki_ids]
+        return self.pagerank_array(wiki_ids).tolist()
 
     def get_pageview(self, wiki_ids):
-        return [self.page_views.get(int(doc_id), 0) for doc_id in wiki_ids]
+        return self.pageview_array(wiki_ids).tolist()
+
+    def pagerank_array(self, wiki_ids):
+        """PageRank of many ids (any int sequence or array) as one array, 0 where missing"""
+        return self.page_rank.lookup(np.asarray(wiki_ids, dtype=np.int64), 0)
+
+    def pageview_array(self, wiki_ids):
+        """page views of many ids (any int sequence or array) as one array, 0 where missing"""
+        return self.page_views.lookup(np.asarray(wiki_ids, dtype=np.int64), 0)
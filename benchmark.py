@@ -0,0 +1,268 @@
+import json
+import resource
+import subprocess
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+
+import numpy as np
+
+from backend_OPTIMIZED_FIXED import BackendClass
+from inverted_index_gcp import LocalStore
+from query_cache import QueryCache
+from startup_loader import MeteredStore
+
+ENDPOINTS = ('search', 'search_body', 'search_title', 'search_anchor')
+# stage name -> BackendClass method timed as that stage. Stages nest (fetch
+# runs inside body, title and anchor), so their times are inclusive. Body
+# BM25 is 'maxscore' when pruned (block-max reads included) and 'bm25' when
+# exhaustive; 'cosine' is /search_body.
+STAGES = {
+    'plan': 'plan',
+    'postings': 'read_posting_lists',
+    'fetch': '_fetch_posting_lists',
+    'body': 'get_body_top_k',
+    'maxscore': 'bm25_max_score',
+    'bm25': 'calculate_bm25_dense',
+    'cosine': 'calculate_cosine_similarity',
+    'title': 'get_title_scores',
+    'anchor': 'get_anchor_incoming_score',
+    'overlap': 'overlap_ranking',
+    'titles': 'with_titles',
+}
+PERCENTILES = (50, 95, 99)
+PRECISION_AT = (5, 10, 40)
+
+
+def precision_at_k(true_ids, predicted, k):
+    return sum(1 for doc_id in predicted[:k] if doc_id in true_ids) / k
+
+
+def recall_at_k(true_ids, predicted, k):
+    if not true_ids:
+        return 0.0
+    return sum(1 for doc_id in predicted[:k] if doc_id in true_ids) / len(true_ids)
+
+
+def average_precision_at_k(true_ids, predicted, k=40):
+    """ Mean of the precision at each relevant result in the top k (0 when
+        there is none) - the course's AP@40.
+    """
+    precisions = []
+    for i, doc_id in enumerate(predicted[:k]):
+        if doc_id in true_ids:
+            precisions.append((len(precisions) + 1) / (i + 1))
+    return sum(precisions) / len(precisions) if precisions else 0.0
+
+
+def quality(ground_truth, results):
+    """ Mean precision@k, MAP@40 and recall@100 of {query: [wiki_id, ...]}
+        results against {query: [wiki_id, ...]} ground truth.
+    """
+    per_query = []
+    for query, true_list in ground_truth.items():
+        true_ids = set(map(str, true_list))
+        predicted = results[query]
+        row = {f'precision@{k}': precision_at_k(true_ids, predicted, k) for k in PRECISION_AT}
+        row['map@40'] = average_precision_at_k(true_ids, predicted, 40)
+        row['recall@100'] = recall_at_k(true_ids, predicted, 100)
+        per_query.append(row)
+    return {name: float(np.mean([row[name] for row in per_query])) for name in per_query[0]} if per_query else {}
+
+
+def summarize(seconds):
+    values = np.asarray(seconds, dtype=np.float64) * 1000
+    if len(values) == 0:
+        return {'count': 0}
+    summary = {'count': len(values), 'mean_ms': float(values.mean()), 'max_ms': float(values.max())}
+    for p in PERCENTILES:
+        summary[f'p{p}_ms'] = float(np.percentile(values, p))
+    return summary
+
+
+def peak_rss_bytes():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                              cwd=Path(__file__).parent, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class StageTimer:
+    """ Times the STAGES methods of one backend instance by shadowing them
+        with timing wrappers - the backend itself is not modified.
+    """
+    def __init__(self, backend):
+        self.timings = {name: [] for name in STAGES}
+        for name, method in STAGES.items():
+            if hasattr(backend, method):
+                setattr(backend, method, self._timed(name, getattr(backend, method)))
+
+    def _timed(self, name, fn):
+        timings = self.timings[name]
+
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                timings.append(time.perf_counter() - start)
+        return timed
+
+    def report(self):
+        return {name: summarize(seconds) for name, seconds in self.timings.items() if seconds}
+
+
+def run(root, ground_truth, endpoints=ENDPOINTS, repeat=1, cold=False, trace_memory=False):
+    """ Replays the ground-truth queries against an in-process BackendClass
+        over the local mirror at `root`, with the result cache off. Returns
+        the report: load cost, and per endpoint the latency percentiles,
+        bytes read and quality, plus per-stage latencies and peak memory.
+        `cold` empties the posting cache before every query.
+    """
+    store = MeteredStore(LocalStore(root))
+    start = time.perf_counter()
+    backend = BackendClass(store=store, result_cache=QueryCache(0, 0))
+    report = {
+        'meta': {'root': str(root), 'queries': len(ground_truth), 'repeat': repeat, 'cold': cold,
+                 'commit': git_commit(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S')},
+        'load': {'seconds': time.perf_counter() - start, 'bytes': store.nbytes,
+                 'peak_rss_bytes': peak_rss_bytes()},
+        'endpoints': {},
+    }
+    stages = StageTimer(backend)
+    if trace_memory:
+        tracemalloc.start()
+    for endpoint in endpoints:
+        search = getattr(backend, endpoint)
+        latencies, nbytes, peaks = [], [], []
+        results = {}
+        errors = {}
+        for i in range(repeat):
+            for query in ground_truth:
+                if cold:
+                    backend.posting_cache.clear()
+                if trace_memory:
+                    tracemalloc.reset_peak()
+                before = store.nbytes
+                start = time.perf_counter()
+                try:
+                    res = search(query)
+                except Exception as e:
+                    # scored as an empty result, and reported
+                    errors[query] = repr(e)
+                    res = []
+                latencies.append(time.perf_counter() - start)
+                nbytes.append(store.nbytes - before)
+                if trace_memory:
+                    peaks.append(tracemalloc.get_traced_memory()[1])
+                if i == 0:
+                    results[query] = [doc_id for doc_id, _ in res]
+        report['endpoints'][endpoint] = {
+            'latency': summarize(latencies),
+            'bytes_read': {'mean': float(np.mean(nbytes)), 'total': int(np.sum(nbytes))},
+            'quality': quality(ground_truth, results),
+            'errors': len(errors),
+        }
+        if errors:
+            report['endpoints'][endpoint]['error_examples'] = sorted(set(errors.values()))[:3]
+        if trace_memory:
+            report['endpoints'][endpoint]['peak_alloc_bytes'] = {'mean': float(np.mean(peaks)),
+                                                                 'max': int(np.max(peaks))}
+    if trace_memory:
+        tracemalloc.stop()
+    report['stages'] = stages.report()
+    report['peak_rss_bytes'] = peak_rss_bytes()
+    return report
+
+
+def regressions(report, baseline, max_slowdown=0.2, max_quality_drop=0.01):
+    """ Lines describing where `report` is worse than `baseline`: a latency
+        percentile or mean bytes read up by more than `max_slowdown`
+        (relative), or a quality metric down by more than `max_quality_drop`
+        (absolute).
+    """
+    found = []
+    for endpoint, current in report['endpoints'].items():
+        old = baseline.get('endpoints', {}).get(endpoint)
+        if old is None:
+            continue
+        for p in PERCENTILES:
+            key = f'p{p}_ms'
+            new_value, old_value = current['latency'].get(key), old['latency'].get(key)
+            if new_value is not None and old_value and new_value > old_value * (1 + max_slowdown):
+                found.append(f"{endpoint} {key}: {old_value:.2f} -> {new_value:.2f}")
+        if current['errors'] > old.get('errors', 0):
+            found.append(f"{endpoint} errors: {old.get('errors', 0)} -> {current['errors']}")
+        new_bytes, old_bytes = current['bytes_read']['mean'], old['bytes_read']['mean']
+        if old_bytes and new_bytes > old_bytes * (1 + max_slowdown):
+            found.append(f"{endpoint} bytes read: {old_bytes:,.0f} -> {new_bytes:,.0f}")
+        for metric, new_value in current['quality'].items():
+            old_value = old['quality'].get(metric)
+            if old_value is not None and new_value < old_value - max_quality_drop:
+                found.append(f"{endpoint} {metric}: {old_value:.3f} -> {new_value:.3f}")
+    return found
+
+
+def print_report(report):
+    print(f"Loaded in {report['load']['seconds']:.2f}s, {report['load']['bytes']:,} bytes")
+    for endpoint, r in report['endpoints'].items():
+        latency, q = r['latency'], r['quality']
+        print(f"{endpoint:14} p50 {latency['p50_ms']:8.2f}ms  p95 {latency['p95_ms']:8.2f}ms  "
+              f"p99 {latency['p99_ms']:8.2f}ms  {r['bytes_read']['mean']:12,.0f} B/query  "
+              f"P@10 {q.get('precision@10', 0):.3f}  MAP@40 {q.get('map@40', 0):.3f}  "
+              f"R@100 {q.get('recall@100', 0):.3f}")
+        if r['errors']:
+            print(f"{'':14} {r['errors']} failed: {'; '.join(r['error_examples'])}")
+    for stage, s in report['stages'].items():
+        print(f"  {stage:12} x{s['count']:<6} p50 {s['p50_ms']:8.2f}ms  p95 {s['p95_ms']:8.2f}ms  "
+              f"p99 {s['p99_ms']:8.2f}ms")
+    print(f"Peak RSS {report['peak_rss_bytes'] / 2**20:,.1f} MiB")
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(
+        description="Replay queries_train.json against BackendClass and report latency and quality.")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--mirror', help="local mirror of the bucket")
+    source.add_argument('--synthetic', help="synthetic mirror directory, built on first use")
+    parser.add_argument('--docs', type=int, default=5000, help="documents of a new synthetic mirror")
+    parser.add_argument('--queries', default=str(Path(__file__).parent / 'queries_train.json'))
+    parser.add_argument('--endpoints', default=','.join(ENDPOINTS))
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--cold', action='store_true', help="empty the posting cache before every query")
+    parser.add_argument('--tracemalloc', action='store_true',
+                        help="also record peak Python allocations per query (slows the run)")
+    parser.add_argument('--output', help="write the report as JSON")
+    parser.add_argument('--baseline', help="earlier JSON report to flag regressions against")
+    parser.add_argument('--max-slowdown', type=float, default=0.2)
+    parser.add_argument('--max-quality-drop', type=float, default=0.01)
+    args = parser.parse_args()
+
+    with open(args.queries, encoding='utf-8') as f:
+        ground_truth = json.load(f)
+    root = args.mirror
+    if args.synthetic:
+        root = args.synthetic
+        if not (Path(root) / 'postings_gcp/index.pkl').exists():
+            from synthetic_index import build_mirror
+            print(f"Building a synthetic mirror of {build_mirror(root, ground_truth, args.docs):,} documents")
+    report = run(root, ground_truth, args.endpoints.split(','), args.repeat, args.cold, args.tracemalloc)
+    print_report(report)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            found = regressions(report, json.load(f), args.max_slowdown, args.max_quality_drop)
+        for line in found:
+            print(f"REGRESSION {line}")
+        sys.exit(1 if found else 0)
@@ -0,0 +1,277 @@
+import copy
+import time
+from collections import defaultdict
+from contextlib import closing
+from pathlib import Path
+
+import numpy as np
+
+from inverted_index_gcp import (MultiFileReader, MultiFileWriter,
+                                PostingList, POSTING_DTYPE, TUPLE_SIZE, decode_postings)
+from ScoringEngine import ScoringEngine, BM25Term
+import tracing
+
+# Postings per block. Blocks are the unit of skipping: a reader fetches and
+# decodes only the blocks that can hold the documents it is looking for.
+BLOCK_POSTINGS = 128
+# One header entry per block, stored in front of the term's postings:
+# last doc id in the block, byte offset of the block from the end of the
+# header, and the block's largest BM25 tf component (idf excluded).
+BLOCK_HEADER_DTYPE = np.dtype([('last_doc_id', '>u4'), ('offset', '>u4'), ('max_impact', '>f4')])
+BLOCK_MAX_FORMAT = 'block_max'
+# parts of a term's block-max list besides its numbered blocks, as read and cached
+HEADER = 'header'
+POSTINGS = 'postings'
+
+
+def n_blocks(df, block_postings=BLOCK_POSTINGS):
+    return -(-df // block_postings)
+
+
+def header_size(df, block_postings=BLOCK_POSTINGS):
+    return n_blocks(df, block_postings) * BLOCK_HEADER_DTYPE.itemsize
+
+
+def encode_blocks(doc_ids, tfs, impacts, block_postings=BLOCK_POSTINGS):
+    """ Encodes one posting list in the block-max layout: the block headers
+        followed by the postings in the usual 6-byte (doc_id, tf) layout.
+    Parameters:
+    -----------
+      doc_ids, tfs: sorted posting arrays
+      impacts: per-posting BM25 tf component, used for the block maxima
+    """
+    df = len(doc_ids)
+    starts = np.arange(0, df, block_postings)
+    header = np.empty(len(starts), dtype=BLOCK_HEADER_DTYPE)
+    header['last_doc_id'] = doc_ids[np.minimum(starts + block_postings, df) - 1]
+    header['offset'] = starts * TUPLE_SIZE
+    block_max = np.maximum.reduceat(impacts, starts) if df else np.empty(0)
+    max32 = block_max.astype(np.float32)
+    # float32 rounding must not take the bound below the true maximum
+    rounded_down = max32.astype(np.float64) < block_max
+    max32[rounded_down] = np.nextafter(max32[rounded_down], np.float32(np.inf))
+    header['max_impact'] = max32
+    postings = np.empty(df, dtype=POSTING_DTYPE)
+    postings['doc_id'] = doc_ids
+    postings['tf'] = tfs
+    return header.tobytes() + postings.tobytes()
+
+
+def convert_index(index, src_dir, dst_dir, doc_map, avgdl, k1=1.2, b=0.5,
+                  name='0', src_store=None, bucket_name=None):
+    """ Converts an index in the `.bin` + `posting_locs` layout to the block-max
+        layout. Writes `dst_dir/<name>_NNN.bin` and `dst_dir/index.pkl`.
+    Returns:
+    --------
+      the converted InvertedIndex; its posting_locs point at the new files and
+      `bm25_max` / `bm25_params` hold the whole-list bounds.
+    """
+    converted = copy.copy(index)
+    converted.posting_locs = defaultdict(list)
+    converted.bm25_max = {}
+    converted.bm25_params = {'k1': k1, 'b': b, 'avgdl': avgdl}
+    converted.posting_format = BLOCK_MAX_FORMAT
+    converted.block_postings = BLOCK_POSTINGS
+    if bucket_name is None:
+        Path(dst_dir).mkdir(parents=True, exist_ok=True)
+    with closing(MultiFileWriter(dst_dir, name, bucket_name)) as writer:
+        for w, posting_list in index.posting_arrays_iter(src_dir, store=src_store):
+            dense_ids = doc_map.to_dense(posting_list.doc_ids)
+            doc_len = np.full(len(dense_ids), np.nan, dtype=np.float32)
+            known = dense_ids >= 0
+            doc_len[known] = doc_map.doc_lengths[dense_ids[known]]
+            impacts = ScoringEngine.bm25_term_scores(posting_list.tfs, doc_len, 1.0, avgdl, k1, b)
+            converted.posting_locs[w].extend(
+                writer.write(encode_blocks(posting_list.doc_ids, posting_list.tfs, impacts)))
+            if len(impacts):
+                converted.bm25_max[w] = float(impacts.max())
+    converted.write_index(dst_dir, 'index', bucket_name)
+    return converted
+
+
+class BlockMaxReader:
+    """ Reads posting lists of a block-max index through a storage backend,
+        fetching only the blocks that are needed. Block headers, blocks and
+        whole lists go through `cache` (the backend's PostingCache, keyed by
+        (base_dir, (term, part))), and reads given a QueryPlan through its
+        single-fetch path, so the signals of a query share them.
+    """
+    def __init__(self, index, base_dir, store, cache=None):
+        self.index = index
+        self.base_dir = base_dir
+        self.block_postings = getattr(index, 'block_postings', BLOCK_POSTINGS)
+        self.cache = cache
+        self._reader = MultiFileReader(base_dir, store=store)
+
+    def _read(self, keys, plan=None):
+        """ {key: value} of (term, HEADER), (term, POSTINGS) and (term, block) keys. """
+        if plan is not None:
+            return plan.read_posting_lists(self.index, keys, self.base_dir, fetch=self._fetch)
+        return self._fetch(self.index, keys, self.base_dir)
+
+    def _fetch(self, index, keys, base_dir):
+        out = {}
+        missing = []
+        for key in dict.fromkeys(keys):
+            value = self.cache.get((base_dir, key)) if self.cache is not None else None
+            if value is None:
+                missing.append(key)
+            else:
+                out[key] = value
+        if not missing:
+            return out
+        # (key or run of block keys, loc, size, offset); adjacent blocks are read as one range
+        parts = []
+        blocks = defaultdict(list)
+        for term, part in missing:
+            df = index.df[term]
+            locs = index.posting_locs[term]
+            if part == HEADER:
+                parts.append(([(term, part)], locs, header_size(df, self.block_postings), 0))
+            elif part == POSTINGS:
+                parts.append(([(term, part)], locs, df * TUPLE_SIZE, header_size(df, self.block_postings)))
+            else:
+                blocks[term].append(part)
+        for term, numbers in blocks.items():
+            df = index.df[term]
+            header = self.headers(term)
+            base = header_size(df, self.block_postings)
+            numbers = np.sort(numbers)
+            run_starts = np.flatnonzero(np.diff(numbers, prepend=-2) != 1)
+            for run in np.split(numbers, run_starts[1:]):
+                start = int(header['offset'][run[0]])
+                end = int(header['offset'][run[-1] + 1]) if run[-1] + 1 < len(header) else df * TUPLE_SIZE
+                parts.append(([(term, int(n)) for n in run], index.posting_locs[term], end - start, base + start))
+
+        start = time.perf_counter()
+        with tracing.stage('download'):
+            chunks = self._reader.read_many([(locs, size, offset) for _, locs, size, offset in parts])
+        fetch_cost = (time.perf_counter() - start) / len(missing)
+        tracing.count('ir_posting_bytes_fetched_total', sum(len(data) for data in chunks), folder=base_dir)
+        with tracing.stage('decode'):
+            for (part_keys, _, _, _), data in zip(parts, chunks):
+                term, part = part_keys[0]
+                if part == HEADER:
+                    values = [np.frombuffer(data, dtype=BLOCK_HEADER_DTYPE).copy()]
+                elif part == POSTINGS:
+                    values = [PostingList.from_bytes(data, index.df[term])]
+                else:
+                    header = self.headers(term)
+                    first = int(header['offset'][part])
+                    ends = np.append(header['offset'][1:].astype(np.int64), index.df[term] * TUPLE_SIZE)
+                    values = [PostingList(*decode_postings(data[int(header['offset'][n]) - first:int(ends[n]) - first]))
+                              for _, n in part_keys]
+                for key, value in zip(part_keys, values):
+                    if self.cache is not None:
+                        self.cache.put((base_dir, key), value, value.nbytes, fetch_cost)
+                    out[key] = value
+        return out
+
+    def headers(self, term, plan=None):
+        """ The term's block headers as a structured array. """
+        return self._read([(term, HEADER)], plan)[(term, HEADER)]
+
+    def blocks_for(self, term, doc_ids, plan=None):
+        """ Index of the block that would hold each of the (wiki) `doc_ids`;
+            n_blocks for ids past the end of the list.
+        """
+        return np.searchsorted(self.headers(term, plan)['last_doc_id'], doc_ids)
+
+    def read_blocks(self, term, blocks, plan=None):
+        """ PostingList of the given blocks only, in doc id order. """
+        header = self.headers(term, plan)
+        blocks = np.unique(blocks)
+        blocks = blocks[blocks < len(header)]
+        if len(blocks) == 0:
+            return PostingList.from_bytes(b'')
+        keys = [(term, int(n)) for n in blocks]
+        values = self._read(keys, plan)
+        return PostingList(np.concatenate([values[key].doc_ids for key in keys]),
+                           np.concatenate([values[key].tfs for key in keys]))
+
+    def read_postings(self, terms, plan=None):
+        """ {term: PostingList} of the whole lists, read in one batch. """
+        values = self._read([(term, POSTINGS) for term in terms], plan)
+        return {term: values[(term, POSTINGS)] for term in terms}
+
+    def probe(self, term, doc_ids, plan=None):
+        """ tf of each of the sorted (wiki) `doc_ids` in the term's list, 0 where
+            absent, reading only the blocks that could hold them.
+        """
+        doc_ids = np.asarray(doc_ids)
+        posting_list = self.read_blocks(term, self.blocks_for(term, doc_ids, plan), plan)
+        tfs = np.zeros(len(doc_ids), dtype=np.uint16)
+        if len(posting_list):
+            idx = np.minimum(np.searchsorted(posting_list.doc_ids, doc_ids), len(posting_list) - 1)
+            found = posting_list.doc_ids[idx] == doc_ids
+            tfs[found] = posting_list.tfs[idx[found]]
+        return tfs
+
+
+class BlockMaxTerm(BM25Term):
+    """ BM25Term over a block-max list: candidate bounds come from the block
+        maxima and probing candidates reads only the blocks that hold them.
+        Terms sharing a `fetch` (see fetcher) read their whole lists together.
+    """
+    partial_reads = True
+
+    def __init__(self, reader, term, idf, doc_map, df=None, plan=None, fetch=None):
+        super().__init__(idf, idf * reader.index.bm25_max.get(term, 0.0),
+                         df=reader.index.df[term] if df is None else df,
+                         fetch=fetch or self.fetcher(reader, doc_map, plan), term=term)
+        self.reader = reader
+        self.doc_map = doc_map
+        self.plan = plan
+
+    @staticmethod
+    def fetcher(reader, doc_map, plan=None):
+        """ fetch(terms) reading the whole lists of BlockMaxTerms in one batch. """
+        def fetch(batch):
+            lists = reader.read_postings([t.term for t in batch], plan)
+            for t in batch:
+                t.set_postings(*t._dense(lists[t.term]))
+        return fetch
+
+    def _dense(self, posting_list):
+        dense_ids = self.doc_map.to_dense(posting_list.doc_ids)
+        if len(dense_ids) and dense_ids.min() < 0:
+            raise LookupError(f"posting of {self.term!r} outside the doc id map")
+        return dense_ids, posting_list.tfs
+
+    def load(self, candidates=None):
+        if self.dense_ids is not None or candidates is None:
+            return super().load()
+        wiki_ids = self.doc_map.to_wiki(candidates)
+        return self._dense(self.reader.read_blocks(
+            self.term, self.reader.blocks_for(self.term, wiki_ids, self.plan), self.plan))
+
+    def candidate_bounds(self, candidates):
+        header = self.reader.headers(self.term, self.plan)
+        blocks = self.reader.blocks_for(self.term, self.doc_map.to_wiki(candidates), self.plan)
+        impacts = np.append(header['max_impact'].astype(np.float64), 0.0)
+        return self.idf * impacts[blocks]
+
+
+if __name__ == '__main__':
+    import argparse
+    import pickle
+    from inverted_index_gcp import LocalStore
+    from doc_index import DocIdMap
+    from backend_OPTIMIZED_FIXED import renamed_load
+
+    parser = argparse.ArgumentParser(
+        description="Convert an index of a local mirror to the block-max posting format.")
+    parser.add_argument('root')
+    parser.add_argument('--index', default='postings_gcp/index.pkl')
+    parser.add_argument('--postings', default='postings_gcp')
+    parser.add_argument('--out', default='postings_gcp_block_max')
+    args = parser.parse_args()
+    root = Path(args.root)
+    with open(root / 'postings_gcp/doc_lengths.pkl', 'rb') as f:
+        doc_lengths = pickle.load(f)
+    avgdl = sum(doc_lengths.values()) / len(doc_lengths) if doc_lengths else 1
+    with open(root / args.index, 'rb') as f:
+        index = renamed_load(f)
+    converted = convert_index(index, args.postings, str(root / args.out),
+                              DocIdMap.build(doc_lengths), avgdl, src_store=LocalStore(root))
+    print(f"{len(converted.posting_locs):,} terms -> {root / args.out}")
@@ -0,0 +1,238 @@
+import json
+import struct
+from pathlib import Path
+
+import numpy as np
+
+METADATA_PATH = 'metadata/metadata.cols'
+PAGERANK = 'pagerank'
+PAGEVIEWS = 'pageviews'
+DOC_LENGTH = 'doc_length'
+
+MAGIC = b'IRCOLS1\n'
+ALIGN = 64
+
+
+def _align(n):
+    return -(-n // ALIGN) * ALIGN
+
+
+def pack_arrays(meta, arrays):
+    """ Serializes named numpy arrays plus a JSON-able `meta` dict: MAGIC, a
+        little-endian uint64 header length, a JSON header {meta, arrays:
+        {name: {dtype, offset, count}}}, then the arrays, each starting at a
+        64-byte aligned offset of the data section.
+    """
+    specs, size = {}, 0
+    for name, arr in arrays.items():
+        specs[name] = {'dtype': arr.dtype.str, 'offset': size, 'count': len(arr)}
+        size = _align(size + arr.nbytes)
+    header = json.dumps({'meta': meta, 'arrays': specs}).encode()
+    prefix = MAGIC + struct.pack('<Q', len(header)) + header
+    data_start = _align(len(prefix))
+    out = bytearray(data_start + size)
+    out[:len(prefix)] = prefix
+    for name, arr in arrays.items():
+        start = data_start + specs[name]['offset']
+        out[start:start + arr.nbytes] = arr.tobytes()
+    return bytes(out)
+
+
+def unpack_arrays(buf):
+    """ (meta, {name: array}) of a `pack_arrays` buffer; the arrays are views
+        over `buf`, nothing is copied.
+    """
+    if bytes(buf[:len(MAGIC)]) != MAGIC:
+        raise ValueError("not a packed array file")
+    (header_len,) = struct.unpack('<Q', bytes(buf[len(MAGIC):len(MAGIC) + 8]))
+    header = json.loads(bytes(buf[len(MAGIC) + 8:len(MAGIC) + 8 + header_len]))
+    data_start = _align(len(MAGIC) + 8 + header_len)
+    arrays = {name: np.frombuffer(buf, dtype=np.dtype(spec['dtype']), count=spec['count'],
+                                  offset=data_start + spec['offset'])
+              for name, spec in header['arrays'].items()}
+    return header['meta'], arrays
+
+
+def load_buffer(store, path):
+    """ The whole of `path` - memory-mapped when the store can, read otherwise. """
+    if hasattr(store, 'map_bytes'):
+        return store.map_bytes(path)
+    return store.read_bytes(path)
+
+
+def _column_dtype(values):
+    """ Smallest exact dtype for a float64 array of dict values: uint32 or
+        int64 when all values are integral, float64 otherwise. The largest
+        uint32 / smallest int64 is reserved as the missing value.
+    """
+    if len(values) and not np.all(np.isfinite(values) & (values == np.round(values))):
+        return np.dtype('<f8')
+    if not len(values) or (values.min() >= 0 and values.max() < np.iinfo(np.uint32).max):
+        return np.dtype('<u4')
+    return np.dtype('<i8')
+
+
+def _missing_value(dtype):
+    if dtype.kind == 'f':
+        return np.nan
+    if dtype.kind == 'u':
+        return np.iinfo(dtype).max
+    return np.iinfo(dtype).min
+
+
+class Column:
+    """ One typed value array aligned with the shared sorted doc id array.
+        Rows the column has no value for hold the missing value (NaN for
+        floats). Supports the read-only dict API used on the old pickled
+        dicts (`get`, `in`, `[]`, `len`, `keys`/`values`/`items`) plus a
+        vectorized `lookup`.
+    """
+    def __init__(self, doc_ids, values):
+        self.doc_ids = doc_ids
+        self.values_array = values
+        self._present = None
+
+    @property
+    def present(self):
+        """ Boolean mask of the rows holding a value. """
+        if self._present is None:
+            if self.values_array.dtype.kind == 'f':
+                self._present = ~np.isnan(self.values_array)
+            else:
+                self._present = self.values_array != _missing_value(self.values_array.dtype)
+        return self._present
+
+    def find(self, doc_ids):
+        """ (row, found) for an array of doc ids; rows are only meaningful
+            where found.
+        """
+        doc_ids = np.asarray(doc_ids, dtype=np.int64)
+        if len(self.doc_ids) == 0:
+            return np.zeros(len(doc_ids), dtype=np.int64), np.zeros(len(doc_ids), dtype=bool)
+        rows = np.searchsorted(self.doc_ids, doc_ids)
+        np.minimum(rows, len(self.doc_ids) - 1, out=rows)
+        found = (self.doc_ids[rows] == doc_ids) & self.present[rows]
+        return rows, found
+
+    def lookup(self, doc_ids, default=0):
+        """ Values of many doc ids at once, `default` where there is none. """
+        rows, found = self.find(np.atleast_1d(doc_ids))
+        if len(self.doc_ids) == 0:
+            return np.full(len(rows), default)
+        return np.where(found, self.values_array[rows], np.asarray(default))
+
+    def get(self, doc_id, default=None):
+        rows, found = self.find([doc_id])
+        return self.values_array[rows[0]].item() if found[0] else default
+
+    def __contains__(self, doc_id):
+        return bool(self.find([doc_id])[1][0])
+
+    def __getitem__(self, doc_id):
+        rows, found = self.find([doc_id])
+        if not found[0]:
+            raise KeyError(doc_id)
+        return self.values_array[rows[0]].item()
+
+    def __len__(self):
+        return int(np.count_nonzero(self.present))
+
+    def __bool__(self):
+        return len(self) > 0
+
+    def keys(self):
+        return self.doc_ids[self.present]
+
+    def values(self):
+        return self.values_array[self.present]
+
+    def items(self):
+        return zip(self.keys().tolist(), self.values().tolist())
+
+
+class ColumnarMetadata:
+    """ Per-document metadata as columns: one sorted doc id array shared by
+        typed value arrays, all in a single file that is memory-mapped (local
+        store) or read in one request, with no unpickling.
+
+        The file is a `pack_arrays` buffer holding `doc_ids` and one array
+        per column.
+    """
+    def __init__(self, doc_ids, columns):
+        self.doc_ids = doc_ids
+        self.columns = {name: Column(doc_ids, values) for name, values in columns.items()}
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def __contains__(self, name):
+        return name in self.columns
+
+    @property
+    def n_rows(self):
+        return len(self.doc_ids)
+
+    @classmethod
+    def build(cls, dicts):
+        """ Builds the columns from {name: {doc_id: value}} dicts, over the
+            union of their doc ids.
+        """
+        keys = {name: np.fromiter(d.keys(), dtype=np.int64, count=len(d)) for name, d in dicts.items()}
+        doc_ids = np.unique(np.concatenate(list(keys.values()) or [np.empty(0, np.int64)]))
+        id_dtype = np.dtype('<u4') if not len(doc_ids) or \
+            (doc_ids[0] >= 0 and doc_ids[-1] <= np.iinfo(np.uint32).max) else np.dtype('<i8')
+        columns = {}
+        for name, d in dicts.items():
+            values = np.fromiter(d.values(), dtype=np.float64, count=len(d))
+            dtype = _column_dtype(values)
+            column = np.full(len(doc_ids), _missing_value(dtype), dtype=dtype)
+            column[np.searchsorted(doc_ids, keys[name])] = values.astype(dtype)
+            columns[name] = column
+        return cls(doc_ids.astype(id_dtype), columns)
+
+    def to_bytes(self):
+        arrays = {'doc_ids': self.doc_ids}
+        arrays.update((name, column.values_array) for name, column in self.columns.items())
+        return pack_arrays({'columns': list(self.columns)}, arrays)
+
+    def save(self, path):
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(self.to_bytes())
+
+    @classmethod
+    def from_buffer(cls, buf):
+        """ Columns over `buf` (bytes or memoryview) without copying. """
+        meta, arrays = unpack_arrays(buf)
+        return cls(arrays['doc_ids'], {name: arrays[name] for name in meta['columns']})
+
+    @classmethod
+    def load(cls, store, path=METADATA_PATH):
+        """ Loads through a storage backend - memory-mapped when it is local. """
+        return cls.from_buffer(load_buffer(store, path))
+
+    @classmethod
+    def load_file(cls, path):
+        """ Memory-maps a metadata file from the local file system. """
+        if Path(path).stat().st_size == 0:
+            raise ValueError(f"empty metadata file {path}")
+        return cls.from_buffer(memoryview(np.memmap(path, dtype=np.uint8, mode='r')))
+
+
+if __name__ == '__main__':
+    import argparse
+    import pickle
+    parser = argparse.ArgumentParser(
+        description="Convert the pickled PageRank, PageViews and doc length dicts of a local "
+                    "mirror to one columnar metadata file.")
+    parser.add_argument('root')
+    args = parser.parse_args()
+    root = Path(args.root)
+    dicts = {}
+    for name, rel in ((PAGERANK, 'pr/pr.pkl'), (PAGEVIEWS, 'page_views/pageview.pkl'),
+                      (DOC_LENGTH, 'postings_gcp/doc_lengths.pkl')):
+        with open(root / rel, 'rb') as f:
+            dicts[name] = pickle.load(f)
+    metadata = ColumnarMetadata.build(dicts)
+    metadata.save(root / METADATA_PATH)
+    print(f"{metadata.n_rows:,} documents -> {root / METADATA_PATH}")
@@ -0,0 +1,90 @@
+import io
+import pickle
+from pathlib import Path
+
+import numpy as np
+
+DOC_IDS_PATH = 'postings_gcp/doc_ids.npy'
+DOC_LENGTHS_PATH = 'postings_gcp/doc_lengths.npy'
+
+
+def _as_array(values, dtype):
+    if isinstance(values, np.ndarray):
+        return values.astype(dtype)
+    return np.fromiter(values, dtype=dtype)
+
+
+class DocIdMap:
+    """ Maps sparse Wikipedia ids to dense internal ids 0..n_docs-1 (the rank of
+        the wiki id in sorted order), with the body length of each document in
+        a dense float32 array, so per-document state can live in flat arrays
+        instead of dicts keyed by wiki id.
+    """
+    def __init__(self, wiki_ids, doc_lengths):
+        self.wiki_ids = wiki_ids
+        self.doc_lengths = doc_lengths
+
+    @classmethod
+    def build(cls, doc_lengths, extra_ids=()):
+        """ Builds the map from a {wiki_id: length} dict (or a columnar
+            metadata Column). Ids in `extra_ids`
+            without a known length get a NaN length, which scorers treat as the
+            average length.
+        """
+        lengths = _as_array(doc_lengths.values(), np.float64)
+        ids = _as_array(doc_lengths.keys(), np.int64)
+        extra = np.setdiff1d(_as_array(extra_ids, np.int64), ids)
+        ids = np.concatenate([ids, extra])
+        lengths = np.concatenate([lengths, np.full(len(extra), np.nan)])
+        order = np.argsort(ids, kind='stable')
+        return cls(ids[order].astype(np.uint32), lengths[order].astype(np.float32))
+
+    @property
+    def n_docs(self):
+        return len(self.wiki_ids)
+
+    def avgdl(self):
+        known = self.doc_lengths[~np.isnan(self.doc_lengths)]
+        return float(known.sum(dtype=np.float64) / len(known)) if len(known) else 1.0
+
+    def to_dense(self, wiki_ids):
+        """ Dense ids for an array of wiki ids, -1 where the id is unknown. """
+        wiki_ids = np.asarray(wiki_ids, dtype=np.int64)
+        if self.n_docs == 0:
+            return np.full(len(wiki_ids), -1, dtype=np.int64)
+        pos = np.searchsorted(self.wiki_ids, wiki_ids)
+        np.minimum(pos, self.n_docs - 1, out=pos)
+        return np.where(self.wiki_ids[pos] == wiki_ids, pos, -1)
+
+    def to_wiki(self, dense_ids):
+        return self.wiki_ids[dense_ids]
+
+    def save(self, base_dir):
+        for path, arr in ((DOC_IDS_PATH, self.wiki_ids), (DOC_LENGTHS_PATH, self.doc_lengths)):
+            path = Path(base_dir) / path
+            path.parent.mkdir(parents=True, exist_ok=True)
+            np.save(path, arr)
+
+    @classmethod
+    def load(cls, store):
+        """ Loads the map written by `save` through a storage backend. """
+        return cls(np.load(io.BytesIO(store.read_bytes(DOC_IDS_PATH))),
+                   np.load(io.BytesIO(store.read_bytes(DOC_LENGTHS_PATH))))
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(
+        description="Build the dense doc id map from a local mirror of the bucket.")
+    parser.add_argument('root')
+    args = parser.parse_args()
+    root = Path(args.root)
+    with open(root / 'postings_gcp/doc_lengths.pkl', 'rb') as f:
+        lengths = pickle.load(f)
+    ids = set()
+    for name in ('even_id_title_dict.pkl', 'uneven_id_title_dict.pkl'):
+        with open(root / 'id_title' / name, 'rb') as f:
+            ids.update(pickle.load(f))
+    doc_map = DocIdMap.build(lengths, ids)
+    doc_map.save(root)
+    print(f"{doc_map.n_docs:,} documents -> {root / DOC_IDS_PATH}")
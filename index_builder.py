@@ -1,6 +1,11 @@
 import math
+import pickle
 from collections import Counter
 
+import numpy as np
+
+from ScoringEngine import ScoringEngine
+
 
 def collect_counts(pages, tokenize_func):
     unigram_counts = Counter()
@@ -40,4 +45,50 @@ def calculate_pmi(unigram_counts, bigram_counts, total_unigrams, min_count=5, th
         if pmi > threshold:
             phrases[(w1, w2)] = pmi
 
-    return phrases
\ No newline at end of file
+    return phrases
+
+
+def add_bm25_bounds(index, base_dir, doc_map, avgdl, k1=1.2, b=0.5, store=None):
+    """ שומר לכל מונח את החסם העליון של רכיב ה-tf ב-BM25 (ללא idf), לצורך MaxScore.
+        The bound is exact for these k1, b and avgdl, which are recorded with it.
+    """
+    bounds = {}
+    for w, posting_list in index.posting_arrays_iter(base_dir, store=store):
+        if len(posting_list) == 0:
+            continue
+        dense_ids = doc_map.to_dense(posting_list.doc_ids)
+        doc_len = np.full(len(dense_ids), np.nan, dtype=np.float32)
+        known = dense_ids >= 0
+        doc_len[known] = doc_map.doc_lengths[dense_ids[known]]
+        bounds[w] = float(ScoringEngine.bm25_term_scores(posting_list.tfs, doc_len, 1.0, avgdl, k1, b).max())
+    index.bm25_max = bounds
+    index.bm25_params = {'k1': k1, 'b': b, 'avgdl': avgdl}
+    return index
+
+
+if __name__ == '__main__':
+    import argparse
+    from pathlib import Path
+    from inverted_index_gcp import LocalStore
+    from doc_index import DocIdMap
+    from backend_OPTIMIZED_FIXED import renamed_load
+
+    parser = argparse.ArgumentParser(
+        description="Add BM25 upper bounds to the body indices of a local mirror of the bucket.")
+    parser.add_argument('root')
+    args = parser.parse_args()
+    root = Path(args.root)
+    store = LocalStore(root)
+    with open(root / 'postings_gcp/doc_lengths.pkl', 'rb') as f:
+        doc_lengths = pickle.load(f)
+    doc_map = DocIdMap.build(doc_lengths)
+    avgdl = sum(doc_lengths.values()) / len(doc_lengths) if doc_lengths else 1
+    for index_path, postings_dir in (('postings_gcp/index.pkl', 'postings_gcp'),
+                                     ('body_stemmed_phrases_idx/index.pkl', 'body_stemmed_phrases_idx')):
+        with open(root / index_path, 'rb') as f:
+            index = renamed_load(f)
+        add_bm25_bounds(index, postings_dir, doc_map, avgdl, store=store)
+        data = pickle.dumps(index)
+        with open(root / index_path, 'wb') as f:
+            f.write(data)
+        print(f"{index_path}: {len(index.bm25_max):,} term bounds")
@@ -9,9 +9,20 @@ from operator import itemgetter
 from time import time
 from pathlib import Path
 import pickle
+import copy
+import mmap
+import posixpath
+import threading
+import numpy as np
+import google.auth
+from google.auth.transport.requests import AuthorizedSession
 from google.cloud import storage
+from google.api_core.exceptions import NotFound
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import closing
+from requests.adapters import HTTPAdapter
+from remote_store import fetch_ranges
 
 PROJECT_ID = 'YOUR-PROJECT-ID-HERE'
 def get_bucket(bucket_name):
@@ -22,6 +33,153 @@ def _open(path, mode, bucket=None):
         return open(path, mode)
     return bucket.blob(path).open(mode)
 
+def _store_path(base_dir, name):
+    """ Joins a posting file name onto an index folder as a store-relative path.
+        `name` may be a bare file name or the full path recorded by the writer.
+    """
+    base_dir = str(base_dir).strip('/')
+    name = posixpath.basename(str(name).replace('\\', '/'))
+    if base_dir in ('', '.'):
+        return name
+    return f'{base_dir}/{name}'
+
+
+def pooled_session(max_workers, credentials=None):
+    """ Authorized requests session with one pooled connection per fetch
+        thread, for `storage.Client(_http=...)`.
+    """
+    if credentials is None:
+        credentials, _ = google.auth.default(scopes=storage.Client.SCOPE)
+    session = AuthorizedSession(credentials)
+    session.mount('https://', HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers))
+    return session
+
+
+class GCSStore:
+    """ Storage backend that reads index artifacts from a GCS bucket.
+        `read_ranges` downloads a batch of ranges concurrently on a thread
+        pool, with adjacent ranges of the same blob merged into one download.
+        Without a `client`, one is built over `pooled_session`; a client
+        passed in keeps its own connection pool.
+    """
+    def __init__(self, bucket_name, client=None, max_workers=16, max_gap=0):
+        self.bucket_name = bucket_name
+        self.max_gap = max_gap
+        self._session = None
+        if client is None:
+            credentials, project = google.auth.default(scopes=storage.Client.SCOPE)
+            self._session = pooled_session(max_workers, credentials)
+            kwargs = {} if project is None else {'project': project}
+            client = storage.Client(credentials=credentials, _http=self._session, **kwargs)
+        self._bucket = client.bucket(bucket_name)
+        self._max_workers = max_workers
+        self._pool = ThreadPoolExecutor(max_workers=max_workers)
+
+    def exists(self, path):
+        return self._bucket.blob(path).exists()
+
+    def open(self, path, mode='rb'):
+        return self._bucket.blob(path).open(mode)
+
+    def read_bytes(self, path):
+        try:
+            return self._bucket.blob(path).download_as_bytes()
+        except NotFound:
+            raise FileNotFoundError(f"Missing: gs://{self.bucket_name}/{path}")
+
+    def read_range(self, path, offset, n_bytes):
+        """ Returns `n_bytes` bytes of `path` starting at `offset`. """
+        if n_bytes <= 0:
+            return b''
+        try:
+            return self._bucket.blob(path).download_as_bytes(
+                start=offset, end=offset + n_bytes - 1)
+        except NotFound:
+            raise FileNotFoundError(f"Missing: gs://{self.bucket_name}/{path}")
+
+    def read_ranges(self, ranges):
+        """ Fetches a batch of (path, offset, n_bytes) ranges concurrently and
+            returns their bytes in input order.
+        """
+        return fetch_ranges(self.read_range, ranges, self._pool, self.max_gap)
+
+    def after_fork(self):
+        """ Drops the connections and fetch threads inherited from the parent
+            process.
+        """
+        if self._session is not None:
+            self._session.close()
+        self._pool = ThreadPoolExecutor(max_workers=self._max_workers)
+
+    def close(self):
+        self._pool.shutdown(wait=False)
+
+
+class LocalStore:
+    """ Storage backend over a local directory laid out like the bucket (e.g.
+        after `gsutil -m rsync -r gs://<bucket> <root>`). Posting files are
+        memory-mapped once and ranges are returned as zero-copy memoryviews.
+    """
+    def __init__(self, root):
+        self.root = Path(root)
+        self._maps = {}
+        self._lock = threading.Lock()
+
+    def _path(self, path):
+        return self.root / path
+
+    def exists(self, path):
+        return self._path(path).exists()
+
+    def open(self, path, mode='rb'):
+        path = self._path(path)
+        if 'w' in mode:
+            path.parent.mkdir(parents=True, exist_ok=True)
+        return open(path, mode)
+
+    def read_bytes(self, path):
+        return self._path(path).read_bytes()
+
+    def _mmap(self, path):
+        m = self._maps.get(path)
+        if m is None:
+            with self._lock:
+                m = self._maps.get(path)
+                if m is None:
+                    with open(self._path(path), 'rb') as f:
+                        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                    self._maps[path] = m
+        return m
+
+    def read_range(self, path, offset, n_bytes):
+        """ Returns a read-only memoryview of `n_bytes` bytes of `path` starting
+            at `offset`, backed directly by the page cache.
+        """
+        if n_bytes <= 0:
+            return b''
+        return self.map_bytes(path)[offset:offset + n_bytes]
+
+    def map_bytes(self, path):
+        """ The whole of `path` as a read-only memoryview over its mmap. """
+        try:
+            return memoryview(self._mmap(path))
+        except (FileNotFoundError, ValueError):
+            if not self.exists(path):
+                raise FileNotFoundError(f"Missing: {self._path(path)}")
+            # mmap of an empty file
+            return memoryview(b'')
+
+    def close(self):
+        with self._lock:
+            maps, self._maps = self._maps, {}
+        for m in maps.values():
+            try:
+                m.close()
+            except BufferError:
+                # a caller still holds a view; the map is released with it.
+                pass
+
+
 # Let's start with a small block size of 30 bytes just to test things out. 
 BLOCK_SIZE = 1999998
 
@@ -56,13 +214,20 @@ class MultiFileWriter:
         self._f.close()
 
 class MultiFileReader:
-    """ Sequential binary reader of multiple files of up to BLOCK_SIZE each. """
-    def __init__(self, base_dir, bucket_name=None):
+    """ Sequential binary reader of multiple files of up to BLOCK_SIZE each. 
+        When a `store` (GCSStore / LocalStore) is given, reads go through its
+        ranged `read_range` instead of opening file objects.
+    """
+    def __init__(self, base_dir, bucket_name=None, store=None):
         self._base_dir = Path(base_dir)
-        self._bucket = None if bucket_name is None else get_bucket(bucket_name)
+        self._store = store
+        self._bucket = None if bucket_name is None or store is not None \
+            else get_bucket(bucket_name)
         self._open_files = {}
 
     def read(self, locs, n_bytes):
+        if self._store is not None:
+            return self._read_from_store(locs, n_bytes)
         b = []
         for f_name, offset in locs:
             f_name = str(self._base_dir / f_name)
@@ -74,6 +239,64 @@ class MultiFileReader:
             b.append(f.read(n_read))
             n_bytes -= n_read
         return b''.join(b)
+
+    def _ranges(self, locs, n_bytes, start=0):
+        """ Splits `n_bytes` bytes of a posting list, starting `start` bytes into
+            it, at BLOCK_SIZE into the (path, offset, n_bytes) range they occupy
+            in each file.
+        """
+        ranges = []
+        for f_name, offset in locs:
+            if n_bytes <= 0:
+                break
+            capacity = BLOCK_SIZE - offset
+            if start >= capacity:
+                start -= capacity
+                continue
+            n_read = min(n_bytes, capacity - start)
+            ranges.append((_store_path(self._base_dir.as_posix(), f_name), offset + start, n_read))
+            n_bytes -= n_read
+            start = 0
+        return ranges
+
+    @staticmethod
+    def _join(chunks):
+        if not chunks:
+            return b''
+        if len(chunks) == 1:
+            # single file: hand back the (possibly zero-copy) view as is.
+            return chunks[0]
+        return b''.join(chunks)
+
+    def _read_from_store(self, locs, n_bytes):
+        return self._join([self._store.read_range(*r) for r in self._ranges(locs, n_bytes)])
+
+    def read_many(self, requests):
+        """ Reads several posting lists in one batch.
+        Parameters:
+        -----------
+          requests: list of (locs, n_bytes) or (locs, n_bytes, start), where
+            `start` skips that many bytes into the posting list.
+        Returns:
+        --------
+          list of bytes-like objects, in the order of `requests`. Stores that
+          implement `read_ranges` fetch the whole batch at once.
+        """
+        if self._store is None:
+            if any(len(request) > 2 for request in requests):
+                raise ValueError("reads at a start offset need a store")
+            return [self.read(locs, n_bytes) for locs, n_bytes in requests]
+        ranges, spans = [], []
+        for request in requests:
+            r = self._ranges(*request)
+            spans.append((len(ranges), len(r)))
+            ranges.extend(r)
+        read_ranges = getattr(self._store, 'read_ranges', None)
+        if read_ranges is not None:
+            chunks = read_ranges(ranges)
+        else:
+            chunks = [self._store.read_range(*r) for r in ranges]
+        return [self._join(chunks[start:start + n]) for start, n in spans]
   
     def close(self):
         for f in self._open_files.values():
@@ -86,6 +309,140 @@ class MultiFileReader:
 TUPLE_SIZE = 6       # We're going to pack the doc_id and tf values in this 
                      # many bytes.
 TF_MASK = 2 ** 16 - 1 # Masking the 16 low bits of an integer
+# On-disk layout of one posting: big-endian 4-byte doc_id, 2-byte tf.
+POSTING_DTYPE = np.dtype([('doc_id', '>u4'), ('tf', '>u2')])
+
+
+def decode_postings(b, n=None):
+    """ Decodes packed (doc_id, tf) postings in one vectorized pass.
+    Parameters:
+    -----------
+      b: bytes-like buffer (bytes, memoryview over an mmap, ...)
+      n: number of postings to decode, defaults to all complete ones in `b`
+    Returns:
+    --------
+      (doc_ids, tfs) as native uint32 / uint16 arrays. They are copies, so
+      they do not pin the buffer they were decoded from.
+    """
+    n = len(b) // TUPLE_SIZE if n is None else min(n, len(b) // TUPLE_SIZE)
+    if n == 0:
+        return np.empty(0, np.uint32), np.empty(0, np.uint16)
+    postings = np.frombuffer(b, dtype=POSTING_DTYPE, count=n)
+    return postings['doc_id'].astype(np.uint32), postings['tf'].astype(np.uint16)
+
+
+# Posting list encodings, recorded per index in `InvertedIndex.posting_format`
+# (indices pickled before it existed are POSTING_FORMAT_RAW).
+#   raw:    fixed 6-byte (doc_id << 16 | tf) tuples, tf clipped to 16 bits.
+#   varint: LEB128 varints of the doc id gaps, followed by LEB128 varints of
+#           the tfs; byte lengths are kept in `InvertedIndex.posting_nbytes`.
+POSTING_FORMAT_RAW = 'raw'
+POSTING_FORMAT_VARINT = 'varint'
+# longest LEB128 varint of a 64-bit value
+MAX_VARINT_BYTES = 10
+
+
+def encode_varints(values):
+    """ LEB128-encodes an array of non-negative integers in one vectorized pass. """
+    values = np.asarray(values, dtype=np.uint64)
+    if len(values) == 0:
+        return b''
+    n_bytes = np.ones(len(values), dtype=np.int64)
+    rest = values >> np.uint64(7)
+    while rest.any():
+        n_bytes += rest > 0
+        rest >>= np.uint64(7)
+    ends = np.cumsum(n_bytes)
+    starts = ends - n_bytes
+    out = np.empty(ends[-1], dtype=np.uint8)
+    for k in range(int(n_bytes.max())):
+        has = n_bytes > k
+        byte = (values[has] >> np.uint64(7 * k)) & np.uint64(0x7f)
+        more = (n_bytes[has] > k + 1).astype(np.uint64) << np.uint64(7)
+        out[starts[has] + k] = byte | more
+    return out.tobytes()
+
+
+def decode_varints(b, n):
+    """ Decodes the first `n` LEB128 varints of `b` in one vectorized pass.
+    Returns:
+    --------
+      (uint64 values, number of bytes they took)
+    Raises ValueError when `b` holds fewer than `n` varints or one longer
+    than 64 bits.
+    """
+    if n == 0:
+        return np.empty(0, dtype=np.uint64), 0
+    raw = np.frombuffer(b, dtype=np.uint8)
+    ends = np.flatnonzero(raw < 0x80)[:n]
+    if len(ends) < n:
+        raise ValueError(f"Truncated varints: {len(ends)} of {n} in {len(raw)} bytes")
+    used = int(ends[-1]) + 1
+    if used == n:
+        # every value fit in one byte (the common case for tfs)
+        return raw[:n].astype(np.uint64), used
+    raw = raw[:used]
+    starts = np.empty(n, dtype=np.int64)
+    starts[0] = 0
+    starts[1:] = ends[:-1] + 1
+    if int((ends - starts).max()) >= MAX_VARINT_BYTES:
+        raise ValueError(f"Corrupt varints: one is longer than {MAX_VARINT_BYTES} bytes")
+    # position of every byte within its varint
+    shift = np.arange(used, dtype=np.int64) - np.repeat(starts, ends - starts + 1)
+    parts = (raw & 0x7f).astype(np.uint64) << (7 * shift).astype(np.uint64)
+    return np.add.reduceat(parts, starts), used
+
+
+def encode_compressed(doc_ids, tfs):
+    """ Delta-gap varint encoding of one sorted posting list. """
+    doc_ids = np.asarray(doc_ids, dtype=np.uint64)
+    gaps = np.diff(doc_ids, prepend=np.uint64(0))
+    return encode_varints(gaps) + encode_varints(tfs)
+
+
+def decode_compressed(b, n):
+    """ Inverse of `encode_compressed`: (uint32 doc_ids, uint32 tfs).
+        `b` must be exactly the `n`-entry list (`InvertedIndex.posting_nbytes`
+        bytes); a truncated, padded or corrupt buffer raises ValueError.
+    """
+    gaps, used = decode_varints(b, n)
+    tfs, tfs_used = decode_varints(memoryview(b)[used:], n)
+    if used + tfs_used != len(b):
+        raise ValueError(f"Corrupt posting list: {n} postings take {used + tfs_used} bytes, "
+                         f"read {len(b)}")
+    doc_ids = np.cumsum(gaps)
+    if n and (doc_ids[-1] > 0xffffffff or tfs.max() > 0xffffffff):
+        raise ValueError("Corrupt posting list: doc id or tf past 32 bits")
+    return doc_ids.astype(np.uint32), tfs.astype(np.uint32)
+
+
+class PostingList:
+    """ A decoded posting list held compactly as parallel doc_id / tf arrays.
+        Iterating yields (doc_id, tf) tuples, so it can stand in for the
+        list-of-tuples returned by `read_a_posting_list`.
+    """
+    __slots__ = ('doc_ids', 'tfs')
+
+    def __init__(self, doc_ids, tfs):
+        self.doc_ids = doc_ids
+        self.tfs = tfs
+
+    @classmethod
+    def from_bytes(cls, b, n=None):
+        return cls(*decode_postings(b, n))
+
+    @property
+    def nbytes(self):
+        return self.doc_ids.nbytes + self.tfs.nbytes
+
+    def __len__(self):
+        return len(self.doc_ids)
+
+    def __iter__(self):
+        return zip(self.doc_ids.tolist(), self.tfs.tolist())
+
+    def to_list(self):
+        return list(self)
 
 
 class InvertedIndex:  
@@ -110,6 +467,15 @@ class InvertedIndex:
         # the number of bytes from the beginning of the file where the posting list
         # starts. 
         self.posting_locs = defaultdict(list)
+        # largest BM25 tf component (idf excluded) per term, and the BM25
+        # parameters it was computed with. Filled in after the posting lists are
+        # written (see index_builder.add_bm25_bounds) and used for pruning.
+        self.bm25_max = {}
+        self.bm25_params = None
+        # on-disk encoding of the posting lists, and the byte length of each
+        # list for encodings whose size does not follow from df.
+        self.posting_format = POSTING_FORMAT_RAW
+        self.posting_nbytes = {}
 
         for doc_id, tokens in docs.items():
             self.add_doc(doc_id, tokens)
@@ -143,59 +509,113 @@ class InvertedIndex:
             from the object's state dictionary. 
         """
         state = self.__dict__.copy()
-        del state['_posting_list']
+        # indices read back from disk no longer have it
+        state.pop('_posting_list', None)
         return state
 
-    def posting_lists_iter(self, base_dir, bucket_name=None):
+    def posting_lists_iter(self, base_dir, bucket_name=None, store=None):
         """ A generator that reads one posting list from disk and yields 
             a (word:str, [(doc_id:int, tf:int), ...]) tuple.
         """
-        with closing(MultiFileReader(base_dir, bucket_name)) as reader:
+        for w, posting_list in self.posting_arrays_iter(base_dir, bucket_name, store):
+            yield w, posting_list.to_list()
+
+    def posting_arrays_iter(self, base_dir, bucket_name=None, store=None):
+        """ Like `posting_lists_iter`, but yields (word:str, PostingList). """
+        with closing(MultiFileReader(base_dir, bucket_name, store)) as reader:
             for w, locs in self.posting_locs.items():
-                b = reader.read(locs, self.df[w] * TUPLE_SIZE)
-                posting_list = []
-                for i in range(self.df[w]):
-                    doc_id = int.from_bytes(b[i*TUPLE_SIZE:i*TUPLE_SIZE+4], 'big')
-                    tf = int.from_bytes(b[i*TUPLE_SIZE+4:(i+1)*TUPLE_SIZE], 'big')
-                    posting_list.append((doc_id, tf))
-                yield w, posting_list
-
-    def read_a_posting_list(self, base_dir, w, bucket_name=None):
-        posting_list = []
+                yield w, self.decode(reader.read(locs, self.posting_size(w)), w)
+
+    def posting_size(self, w):
+        """ Number of bytes the posting list of `w` takes on disk. """
+        if getattr(self, 'posting_format', POSTING_FORMAT_RAW) == POSTING_FORMAT_VARINT:
+            return self.posting_nbytes[w]
+        return self.df[w] * TUPLE_SIZE
+
+    def decode(self, b, w):
+        """ Decodes the posting list of `w` read from disk into a PostingList,
+            whatever the index's posting format.
+        """
+        if getattr(self, 'posting_format', POSTING_FORMAT_RAW) == POSTING_FORMAT_VARINT:
+            return PostingList(*decode_compressed(b, self.df[w]))
+        return PostingList.from_bytes(b, self.df[w])
+
+    def read_a_posting_list(self, base_dir, w, bucket_name=None, store=None):
+        return self.read_a_posting_array(base_dir, w, bucket_name, store).to_list()
+
+    def read_a_posting_array(self, base_dir, w, bucket_name=None, store=None):
+        """ Like `read_a_posting_list`, but returns the decoded PostingList with
+            its parallel doc_id / tf arrays.
+        """
         if not w in self.posting_locs:
-            return posting_list
-        with closing(MultiFileReader(base_dir, bucket_name)) as reader:
+            return PostingList.from_bytes(b'')
+        with closing(MultiFileReader(base_dir, bucket_name, store)) as reader:
             locs = self.posting_locs[w]
-            b = reader.read(locs, self.df[w] * TUPLE_SIZE)
-            for i in range(self.df[w]):
-                doc_id = int.from_bytes(b[i*TUPLE_SIZE:i*TUPLE_SIZE+4], 'big')
-                tf = int.from_bytes(b[i*TUPLE_SIZE+4:(i+1)*TUPLE_SIZE], 'big')
-                posting_list.append((doc_id, tf))
-        return posting_list
+            b = reader.read(locs, self.posting_size(w))
+            return self.decode(b, w)
 
     @staticmethod
-    def write_a_posting_list(b_w_pl, base_dir, bucket_name=None):
+    def write_a_posting_list(b_w_pl, base_dir, bucket_name=None, compress=False):
+        """ Writes a bucket of (word, sorted posting list) pairs and pickles their
+            locations to `<bucket_id>_posting_locs.pickle`. With `compress`, lists
+            are written in the POSTING_FORMAT_VARINT encoding (no tf clipping)
+            and their byte lengths go to `<bucket_id>_posting_nbytes.pickle`;
+            merge both into the index and set its `posting_format`.
+        """
         posting_locs = defaultdict(list)
+        posting_nbytes = {}
         bucket_id, list_w_pl = b_w_pl
         
         with closing(MultiFileWriter(base_dir, bucket_id, bucket_name)) as writer:
             for w, pl in list_w_pl: 
                 # convert to bytes
-                b = b''.join([(doc_id << 16 | (tf & TF_MASK)).to_bytes(TUPLE_SIZE, 'big')
-                              for doc_id, tf in pl])
+                if compress:
+                    doc_ids, tfs = zip(*pl) if pl else ((), ())
+                    b = encode_compressed(doc_ids, tfs)
+                    posting_nbytes[w] = len(b)
+                else:
+                    b = b''.join([(doc_id << 16 | (tf & TF_MASK)).to_bytes(TUPLE_SIZE, 'big')
+                                  for doc_id, tf in pl])
                 # write to file(s)
                 locs = writer.write(b)
                 # save file locations to index
                 posting_locs[w].extend(locs)
-            path = str(Path(base_dir) / f'{bucket_id}_posting_locs.pickle')
             bucket = None if bucket_name is None else get_bucket(bucket_name)
+            path = str(Path(base_dir) / f'{bucket_id}_posting_locs.pickle')
             with _open(path, 'wb', bucket) as f:
                 pickle.dump(posting_locs, f)
+            if compress:
+                path = str(Path(base_dir) / f'{bucket_id}_posting_nbytes.pickle')
+                with _open(path, 'wb', bucket) as f:
+                    pickle.dump(posting_nbytes, f)
         return bucket_id
 
+    def compressed_copy(self, src_dir, dst_dir, name='0', bucket_name=None, store=None):
+        """ Re-writes this index's posting lists to `dst_dir` in the
+            POSTING_FORMAT_VARINT encoding and returns the matching index, also
+            written to `dst_dir/index.pkl`. Clipped tfs of a raw index stay
+            clipped.
+        """
+        compressed = copy.copy(self)
+        compressed.posting_locs = defaultdict(list)
+        compressed.posting_nbytes = {}
+        compressed.posting_format = POSTING_FORMAT_VARINT
+        if bucket_name is None:
+            Path(dst_dir).mkdir(parents=True, exist_ok=True)
+        with closing(MultiFileWriter(dst_dir, name, bucket_name)) as writer:
+            for w, posting_list in self.posting_arrays_iter(src_dir, store=store):
+                b = encode_compressed(posting_list.doc_ids, posting_list.tfs)
+                compressed.posting_nbytes[w] = len(b)
+                compressed.posting_locs[w].extend(writer.write(b))
+        compressed.write_index(dst_dir, 'index', bucket_name)
+        return compressed
+
 
     @staticmethod
-    def read_index(base_dir, name, bucket_name=None):
+    def read_index(base_dir, name, bucket_name=None, store=None):
+        if store is not None:
+            with store.open(_store_path(base_dir, f'{name}.pkl'), 'rb') as f:
+                return pickle.load(f)
         path = str(Path(base_dir) / f'{name}.pkl')
         bucket = None if bucket_name is None else get_bucket(bucket_name)
         with _open(path, 'rb', bucket) as f:
@@ -0,0 +1,266 @@
+import copy
+import zlib
+
+import numpy as np
+
+from columnar_metadata import pack_arrays, unpack_arrays, load_buffer
+from inverted_index_gcp import InvertedIndex, POSTING_FORMAT_RAW
+
+# extension of a frozen lexicon next to the index pickle it replaces
+LEXICON_SUFFIX = '.lex'
+
+
+def lexicon_path(index_path):
+    """ `postings_gcp/index.pkl` -> `postings_gcp/index.lex` """
+    return index_path.rsplit('.', 1)[0] + LEXICON_SUFFIX
+
+
+def _uint_dtype(max_value):
+    return np.dtype('<u4') if max_value < 2**32 else np.dtype('<u8')
+
+
+def term_arrays(terms):
+    """ The `terms` / `term_offsets` / `hash_slots` arrays of a term table:
+        the UTF-8 terms back to back, their offsets, and the hash table
+        `find_term` looks them up with. A term's row is its position in
+        `terms`.
+    """
+    encoded = [t.encode('utf-8') for t in terms]
+    lengths = np.fromiter(map(len, encoded), dtype=np.int64, count=len(encoded))
+    term_offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+    return {
+        'terms': np.frombuffer(b''.join(encoded), dtype=np.uint8),
+        'term_offsets': term_offsets.astype(_uint_dtype(term_offsets[-1])),
+        'hash_slots': _hash_slots(encoded),
+    }
+
+
+def find_term(arrays, term):
+    """ Row of `term` in a `term_arrays` table, -1 when it is not there. """
+    if not isinstance(term, str):
+        return -1
+    key = term.encode('utf-8')
+    blob, offsets, slots = arrays['terms'], arrays['term_offsets'], arrays['hash_slots']
+    mask = len(slots) - 1
+    h = zlib.crc32(key) & mask
+    while True:
+        row = slots.item(h) - 1
+        if row < 0:
+            return -1
+        if blob[offsets.item(row):offsets.item(row + 1)].tobytes() == key:
+            return row
+        h = (h + 1) & mask
+
+
+def _hash_slots(encoded):
+    """ Hash table of row + 1 (0 = empty slot) for the UTF-8 terms. """
+    n_slots = 1 << max(4, (2 * len(encoded)).bit_length())
+    mask = n_slots - 1
+    slots = np.zeros(n_slots, dtype=_uint_dtype(len(encoded) + 1))
+    for row, key in enumerate(encoded):
+        h = zlib.crc32(key) & mask
+        while slots[h]:
+            h = (h + 1) & mask
+        slots[h] = row + 1
+    return slots
+
+
+class Lexicon:
+    """ Read-only term dictionary of an InvertedIndex, packed into arrays:
+        the terms sorted and concatenated as UTF-8 with their offsets, the
+        df / total tf per term, and the posting locations as (file id, offset)
+        arrays with the file names interned once. Terms are found through an
+        open-addressing hash table of rows (crc32 of the UTF-8 term, linear
+        probing, at most half full). Loaded from one memory-mapped file; the views
+        below make it a drop-in for `index.df`, `index.posting_locs` etc.
+    """
+    def __init__(self, meta, arrays):
+        self.meta = meta
+        self.files = meta['files']
+        self.n_terms = meta['n_terms']
+        self.blob = arrays['terms']
+        self.term_offsets = arrays['term_offsets']
+        self.arrays = arrays
+
+    @staticmethod
+    def freeze(index):
+        """ Packs the term statistics of `index` into lexicon file bytes. """
+        terms = sorted(set(index.df) | set(index.posting_locs))
+
+        files, file_ids = [], {}
+        loc_counts, loc_files, loc_offsets = [], [], []
+        for t in terms:
+            locs = index.posting_locs.get(t, ())
+            loc_counts.append(len(locs))
+            for file_name, offset in locs:
+                if file_name not in file_ids:
+                    file_ids[file_name] = len(files)
+                    files.append(file_name)
+                loc_files.append(file_ids[file_name])
+                loc_offsets.append(offset)
+        loc_starts = np.concatenate([[0], np.cumsum(loc_counts, dtype=np.int64)])
+
+        df = np.array([index.df.get(t, 0) for t in terms], dtype=np.int64)
+        term_total = np.array([index.term_total.get(t, 0) for t in terms], dtype=np.int64)
+        arrays = term_arrays(terms)
+        arrays.update({
+            'df': df.astype(_uint_dtype(df.max(initial=0))),
+            'term_total': term_total.astype(_uint_dtype(term_total.max(initial=0))),
+            'loc_starts': loc_starts.astype(_uint_dtype(loc_starts[-1])),
+            'loc_files': np.array(loc_files, dtype=np.int64).astype(_uint_dtype(len(files))),
+            'loc_offsets': np.array(loc_offsets, dtype=np.int64).astype(
+                _uint_dtype(max(loc_offsets, default=0))),
+        })
+        # optional per-term values; NaN / missing where a term has none
+        posting_nbytes = getattr(index, 'posting_nbytes', None) or {}
+        if posting_nbytes:
+            arrays['posting_nbytes'] = np.array([posting_nbytes.get(t, 0) for t in terms], dtype='<u8')
+        bm25_max = getattr(index, 'bm25_max', None) or {}
+        if bm25_max:
+            arrays['bm25_max'] = np.array([bm25_max.get(t, np.nan) for t in terms], dtype='<f8')
+
+        meta = {
+            'n_terms': len(terms),
+            'files': files,
+            'posting_format': getattr(index, 'posting_format', POSTING_FORMAT_RAW),
+            'bm25_params': getattr(index, 'bm25_params', None),
+            'block_postings': getattr(index, 'block_postings', None),
+        }
+        return pack_arrays(meta, arrays)
+
+    @classmethod
+    def from_buffer(cls, buf):
+        return cls(*unpack_arrays(buf))
+
+    @classmethod
+    def load(cls, store, path):
+        """ Loads through a storage backend - memory-mapped when it is local. """
+        return cls.from_buffer(load_buffer(store, path))
+
+    def term(self, i):
+        return str(self.blob[self.term_offsets[i]:self.term_offsets[i + 1]], 'utf-8')
+
+    def find(self, term):
+        """ Row of `term`, -1 when it is not in the lexicon. """
+        return find_term(self.arrays, term)
+
+    def locs(self, i):
+        starts = self.arrays['loc_starts']
+        start, end = int(starts[i]), int(starts[i + 1])
+        files = self.arrays['loc_files'][start:end].tolist()
+        offsets = self.arrays['loc_offsets'][start:end].tolist()
+        return [(self.files[f], offset) for f, offset in zip(files, offsets)]
+
+    def index(self):
+        """ An InvertedIndex whose term statistics are views over this lexicon. """
+        index = InvertedIndex.__new__(InvertedIndex)
+        index.df = LexiconView(self, 'df', missing=0)
+        index.term_total = LexiconView(self, 'term_total', missing=0)
+        index.posting_locs = LexiconView(self, None, missing=[])
+        index.posting_nbytes = LexiconView(self, 'posting_nbytes') if 'posting_nbytes' in self.arrays else {}
+        index.bm25_max = LexiconView(self, 'bm25_max') if 'bm25_max' in self.arrays else {}
+        index.bm25_params = self.meta['bm25_params']
+        index.posting_format = self.meta['posting_format']
+        if self.meta['block_postings'] is not None:
+            index.block_postings = self.meta['block_postings']
+        index.lexicon = self
+        return index
+
+
+class LexiconView:
+    """ Read-only mapping from term to one lexicon column (`posting_locs` when
+        `column` is None). A term is present when it has a value: non-zero
+        df / total tf, at least one location, a non-NaN bound; every term has
+        a posting_nbytes. Missing terms read as `missing`, like the Counter /
+        defaultdict they replace - but are not inserted.
+    """
+    def __init__(self, lexicon, column, missing=None):
+        self.lexicon = lexicon
+        self.column = column
+        self.values_array = None if column is None else lexicon.arrays[column]
+        self.missing = missing
+
+    def _present(self, i):
+        return bool(self._mask(slice(i, i + 1))[0])
+
+    def _mask(self, rows):
+        """ Presence of the terms in `rows` (a slice). """
+        if self.column is None:
+            stop = self.lexicon.n_terms if rows.stop is None else rows.stop
+            return np.diff(self.lexicon.arrays['loc_starts'][rows.start:stop + 1]) > 0
+        values = self.values_array[rows]
+        if self.column == 'posting_nbytes':
+            return np.ones(len(values), dtype=bool)
+        if self.column == 'bm25_max':
+            return ~np.isnan(values)
+        return values != 0
+
+    def _value(self, i):
+        if self.column is None:
+            return self.lexicon.locs(i)
+        return self.values_array[i].item()
+
+    def _row(self, term):
+        i = self.lexicon.find(term)
+        return i if i >= 0 and self._present(i) else -1
+
+    def __contains__(self, term):
+        return self._row(term) >= 0
+
+    def __getitem__(self, term):
+        i = self._row(term)
+        if i < 0:
+            if self.missing is None:
+                raise KeyError(term)
+            return copy.copy(self.missing)
+        return self._value(i)
+
+    def get(self, term, default=None):
+        i = self._row(term)
+        return self._value(i) if i >= 0 else default
+
+    def _rows(self):
+        return np.flatnonzero(self._mask(slice(0, None)))
+
+    def __len__(self):
+        return len(self._rows())
+
+    def __bool__(self):
+        return len(self) > 0
+
+    def __iter__(self):
+        return (self.lexicon.term(i) for i in self._rows().tolist())
+
+    def keys(self):
+        return iter(self)
+
+    def values(self):
+        if self.column is None:
+            return (self.lexicon.locs(i) for i in self._rows().tolist())
+        return self.values_array[self._rows()]
+
+    def items(self):
+        return ((self.lexicon.term(i), self._value(i)) for i in self._rows().tolist())
+
+
+if __name__ == '__main__':
+    import argparse
+    from pathlib import Path
+    from backend_OPTIMIZED_FIXED import renamed_load
+    parser = argparse.ArgumentParser(
+        description="Freeze the index pickles of a local mirror into memory-mapped lexicons.")
+    parser.add_argument('root')
+    parser.add_argument('indices', nargs='*', default=[
+        'postings_gcp/index.pkl', 'title_stemmed/index.pkl', 'title_nostem/index.pkl',
+        'anchor_index/anchor_index.pkl', 'title_stemmed_phrases_idx/index.pkl',
+        'body_stemmed_phrases_idx/index.pkl', 'postings_gcp_block_max/index.pkl'])
+    args = parser.parse_args()
+    root = Path(args.root)
+    for rel in args.indices:
+        if not (root / rel).exists():
+            continue
+        with open(root / rel, 'rb') as f:
+            index = renamed_load(f)
+        out = root / lexicon_path(rel)
+        out.write_bytes(Lexicon.freeze(index))
+        print(f"{len(index.df):,} terms -> {out}")
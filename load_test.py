@@ -0,0 +1,322 @@
+import http.client
+import json
+import os
+import random
+import signal
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from urllib.parse import quote_plus, urlsplit
+
+import numpy as np
+
+# share of the requests going to each endpoint
+DEFAULT_MIX = "search=0.6,search_body=0.1,search_title=0.1,search_anchor=0.1,get_pagerank=0.05,get_pageview=0.05"
+POST_ENDPOINTS = ('get_pagerank', 'get_pageview')
+PERCENTILES = (50, 95, 99)
+# a step is saturated when it answers less than this share of the load it was sent
+MIN_THROUGHPUT_RATIO = 0.9
+# runs search_frontend.py with `backend` bound to the repo's backend module,
+# for a server directory that has no deployed backend.py
+REPO_SERVER = ("import runpy, sys, backend_OPTIMIZED_FIXED; "
+               "sys.modules['backend'] = backend_OPTIMIZED_FIXED; sys.argv[0] = 'search_frontend.py'; "
+               "runpy.run_path('search_frontend.py', run_name='__main__')")
+
+
+def parse_mix(text):
+    mix = {}
+    for item in text.split(','):
+        endpoint, _, weight = item.partition('=')
+        mix[endpoint.strip()] = float(weight or 1)
+    return mix
+
+
+class Workload:
+    """ Random requests over the training queries: a GET of ?query=... for
+        the search endpoints, and for /get_pagerank and /get_pageview a POST
+        of the ground-truth wiki ids of a query (ids the index has).
+    """
+    def __init__(self, queries, mix, seed=0):
+        self.queries = list(queries)
+        self.id_lists = [[int(doc_id) for doc_id in ids] for ids in queries.values() if ids]
+        self.endpoints = list(mix)
+        self.weights = [mix[e] for e in self.endpoints]
+        self.rng = random.Random(seed)
+
+    def next(self):
+        """ (endpoint, method, path, body) of a random request. """
+        endpoint = self.rng.choices(self.endpoints, self.weights)[0]
+        if endpoint in POST_ENDPOINTS:
+            return endpoint, 'POST', f'/{endpoint}', json.dumps(self.rng.choice(self.id_lists)).encode()
+        query = self.rng.choice(self.queries)
+        return endpoint, 'GET', f'/{endpoint}?query={quote_plus(query)}', None
+
+
+class Client:
+    """ Keep-alive HTTP connections, one per sending thread. """
+    def __init__(self, url, timeout=60.0):
+        parts = urlsplit(url)
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def request(self, method, path, body=None):
+        """ (status, response bytes); raises on connection errors. """
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+        headers = {'Content-Type': 'application/json'} if body is not None else {}
+        try:
+            conn.request(method, path, body=body, headers=headers)
+            response = conn.getresponse()
+            return response.status, response.read()
+        except Exception:
+            conn.close()
+            self._local.conn = None
+            raise
+
+
+def summarize(seconds):
+    values = np.asarray(seconds, dtype=np.float64) * 1000
+    if len(values) == 0:
+        return {'count': 0}
+    summary = {'count': len(values), 'mean_ms': float(values.mean()), 'max_ms': float(values.max())}
+    for p in PERCENTILES:
+        summary[f'p{p}_ms'] = float(np.percentile(values, p))
+    return summary
+
+
+def run_step(client, workload, qps, duration, pool, seed=0):
+    """ Offers Poisson arrivals at `qps` for `duration` seconds and waits for
+        the answers. Open loop: a request is sent at its arrival time however
+        many are still in flight, and its latency is counted from that time,
+        so queueing in the client shows up too (size the pool above qps x
+        latency). Returns the step report.
+    """
+    rng = random.Random(seed)
+    records = []
+    lock = threading.Lock()
+
+    def send(endpoint, method, path, body, scheduled):
+        error = None
+        try:
+            status, _ = client.request(method, path, body)
+            if status != 200:
+                error = f'HTTP {status}'
+        except Exception as e:
+            error = type(e).__name__
+        end = time.perf_counter()
+        with lock:
+            records.append((endpoint, end - scheduled, end, error))
+
+    start = time.perf_counter()
+    arrival = start
+    futures = []
+    while True:
+        arrival += rng.expovariate(qps)
+        if arrival - start > duration:
+            break
+        delay = arrival - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        futures.append(pool.submit(send, *workload.next(), arrival))
+    for future in futures:
+        future.result()
+    elapsed = max(end for _, _, end, _ in records) - start if records else duration
+
+    ok = [latency for _, latency, _, error in records if error is None]
+    errors = {}
+    for _, _, _, error in records:
+        if error is not None:
+            errors[error] = errors.get(error, 0) + 1
+    by_endpoint = {}
+    for endpoint in workload.endpoints:
+        rows = [(latency, error) for e, latency, _, error in records if e == endpoint]
+        if rows:
+            by_endpoint[endpoint] = summarize([latency for latency, error in rows if error is None])
+            by_endpoint[endpoint]['errors'] = sum(1 for _, error in rows if error is not None)
+    return {
+        'offered_qps': qps,
+        'sent': len(records),
+        'sent_qps': len(records) / duration,
+        'throughput_qps': len(records) / elapsed,
+        'goodput_qps': len(ok) / elapsed,
+        'error_rate': (len(records) - len(ok)) / len(records) if records else 0.0,
+        'errors': errors,
+        'latency': summarize(ok),
+        'endpoints': by_endpoint,
+    }
+
+
+def saturated(step, slo_ms, max_error_rate):
+    """ Why the step is past the server's capacity, or None. """
+    if step['throughput_qps'] < step['sent_qps'] * MIN_THROUGHPUT_RATIO:
+        return f"throughput {step['throughput_qps']:.1f} < {MIN_THROUGHPUT_RATIO:.0%} of {step['sent_qps']:.1f} sent"
+    if step['error_rate'] > max_error_rate:
+        return f"error rate {step['error_rate']:.1%}"
+    if step['latency'].get('p99_ms', 0) > slo_ms:
+        return f"p99 {step['latency']['p99_ms']:.0f}ms > {slo_ms:.0f}ms"
+    return None
+
+
+def run(url, queries, rates, duration=30.0, mix=DEFAULT_MIX, warmup=5.0, concurrency=256,
+        timeout=60.0, slo_ms=2000.0, max_error_rate=0.01, seed=0, stop_at_saturation=True):
+    """ Runs one load step per rate in `rates` (ascending QPS) against the
+        server at `url` and returns the report: the steps, and the
+        saturation point - the highest rate served within the p99 SLO and
+        error budget at (nearly) the offered throughput.
+    """
+    client = Client(url, timeout)
+    workload = Workload(queries, parse_mix(mix) if isinstance(mix, str) else mix, seed)
+    report = {'meta': {'url': url, 'duration': duration, 'mix': workload.endpoints, 'weights': workload.weights,
+                       'slo_ms': slo_ms, 'time': time.strftime('%Y-%m-%dT%H:%M:%S')},
+              'steps': [], 'saturation': None}
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='load') as pool:
+        if warmup:
+            run_step(client, workload, rates[0], warmup, pool, seed)
+        sustained = None
+        for i, qps in enumerate(rates):
+            step = run_step(client, workload, qps, duration, pool, seed + i + 1)
+            reason = saturated(step, slo_ms, max_error_rate)
+            step['saturated'] = reason
+            report['steps'].append(step)
+            print_step(step)
+            if reason is None:
+                sustained = step
+            elif report['saturation'] is None:
+                report['saturation'] = {'max_sustained_qps': sustained['offered_qps'] if sustained else None,
+                                        'saturated_at_qps': qps, 'reason': reason}
+                if stop_at_saturation:
+                    break
+    if report['saturation'] is None and sustained is not None:
+        report['saturation'] = {'max_sustained_qps': sustained['offered_qps'], 'saturated_at_qps': None,
+                                'reason': None}
+    return report
+
+
+def print_step(step):
+    latency = step['latency']
+    line = (f"{step['offered_qps']:8.1f} qps offered  {step['throughput_qps']:8.1f} qps answered  "
+            f"errors {step['error_rate']:6.1%}")
+    if latency['count']:
+        line += f"  p50 {latency['p50_ms']:8.1f}ms  p95 {latency['p95_ms']:8.1f}ms  p99 {latency['p99_ms']:8.1f}ms"
+    if step['saturated']:
+        line += f"  SATURATED ({step['saturated']})"
+    print(line)
+
+
+def print_report(report):
+    last = report['steps'][-1]
+    for endpoint, s in last['endpoints'].items():
+        if s['count']:
+            print(f"  {endpoint:14} x{s['count']:<6} p50 {s['p50_ms']:8.1f}ms  p99 {s['p99_ms']:8.1f}ms  "
+                  f"errors {s['errors']}")
+    saturation = report['saturation']
+    if saturation['max_sustained_qps'] is None:
+        print(f"Saturated at the first rate ({saturation['reason']})")
+    elif saturation['saturated_at_qps'] is None:
+        print(f"Not saturated up to {saturation['max_sustained_qps']} qps")
+    else:
+        print(f"Sustained {saturation['max_sustained_qps']} qps; saturated at "
+              f"{saturation['saturated_at_qps']} qps ({saturation['reason']})")
+
+
+def start_server(index_dir, workers, port, server_dir=None, ready_timeout=600.0):
+    """ Starts `search_frontend.py --workers N` from `server_dir` (the
+        directory deployed to the server, with backend.py; by default this
+        repo, with backend_OPTIMIZED_FIXED.py as the backend) on a local index
+        mirror, and returns the process once /readyz answers 200.
+    """
+    server_dir = Path(server_dir or Path(__file__).parent)
+    if not (server_dir / 'search_frontend.py').exists():
+        raise FileNotFoundError(f"no search_frontend.py in {server_dir}")
+    if (server_dir / 'backend.py').exists():
+        command = [sys.executable, 'search_frontend.py']
+    elif (server_dir / 'backend_OPTIMIZED_FIXED.py').exists():
+        command = [sys.executable, '-c', REPO_SERVER]
+    else:
+        raise FileNotFoundError(f"no backend.py or backend_OPTIMIZED_FIXED.py in {server_dir}")
+    env = dict(os.environ, IR_LOCAL_INDEX_DIR=str(index_dir))
+    proc = subprocess.Popen(command + ['--workers', str(workers), '--port', str(port)],
+                            cwd=server_dir, env=env)
+    client = Client(f'http://127.0.0.1:{port}', timeout=5.0)
+    deadline = time.monotonic() + ready_timeout
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"server exited with status {proc.returncode}")
+        try:
+            if client.request('GET', '/readyz')[0] == 200:
+                return proc
+        except OSError:
+            pass
+        time.sleep(0.5)
+    stop_server(proc)
+    raise TimeoutError(f"server not ready after {ready_timeout}s")
+
+
+def stop_server(proc, timeout=60.0):
+    proc.send_signal(signal.SIGTERM)
+    try:
+        proc.wait(timeout)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.wait()
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(
+        description="Open-loop (Poisson) load test of the search frontend at increasing QPS.")
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument('--url', help="running server, e.g. http://127.0.0.1:8080")
+    target.add_argument('--mirror', help="local mirror of the bucket to start a server on")
+    target.add_argument('--synthetic', help="synthetic mirror directory to start a server on, built on first use")
+    parser.add_argument('--workers', type=int, default=1, help="workers of the started server (0: one per core)")
+    parser.add_argument('--port', type=int, default=8090, help="port of the started server")
+    parser.add_argument('--server-dir', help="directory with search_frontend.py and backend.py (default: this repo)")
+    parser.add_argument('--docs', type=int, default=5000, help="documents of a new synthetic mirror")
+    parser.add_argument('--queries', default=str(Path(__file__).parent / 'queries_train.json'))
+    parser.add_argument('--rates', default='1,2,5,10,20,50,100', help="comma-separated QPS steps, ascending")
+    parser.add_argument('--duration', type=float, default=30.0, help="seconds per step")
+    parser.add_argument('--warmup', type=float, default=5.0, help="seconds at the first rate, not reported")
+    parser.add_argument('--mix', default=DEFAULT_MIX, help="endpoint=weight,... request mix")
+    parser.add_argument('--concurrency', type=int, default=256, help="max requests in flight")
+    parser.add_argument('--timeout', type=float, default=60.0, help="request timeout (seconds)")
+    parser.add_argument('--slo-ms', type=float, default=2000.0, help="p99 latency a sustained rate must meet")
+    parser.add_argument('--max-error-rate', type=float, default=0.01)
+    parser.add_argument('--all-rates', action='store_true', help="keep going past the saturation point")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help="write the report as JSON")
+    args = parser.parse_args()
+
+    with open(args.queries, encoding='utf-8') as f:
+        queries = json.load(f)
+    server = None
+    url = args.url
+    if url is None:
+        index_dir = args.mirror
+        if args.synthetic:
+            index_dir = args.synthetic
+            if not (Path(index_dir) / 'postings_gcp/index.pkl').exists():
+                from synthetic_index import build_mirror
+                print(f"Building a synthetic mirror of {build_mirror(index_dir, queries, args.docs):,} documents")
+        server = start_server(index_dir, args.workers, args.port, args.server_dir)
+        url = f'http://127.0.0.1:{args.port}'
+    try:
+        report = run(url, queries, [float(r) for r in args.rates.split(',')], args.duration, args.mix,
+                     args.warmup, args.concurrency, args.timeout, args.slo_ms, args.max_error_rate, args.seed,
+                     not args.all_rates)
+    finally:
+        if server is not None:
+            stop_server(server)
+    if server is not None:
+        report['meta']['workers'] = args.workers
+        report['meta']['cpus'] = os.cpu_count()
+    print_report(report)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
@@ -0,0 +1,99 @@
+import heapq
+import itertools
+import threading
+
+
+class PostingCache:
+    """ Byte-budgeted cache of decoded posting lists, shared by all indices and
+        keyed by (index folder, term).
+
+        Eviction is GreedyDual-Frequency: an entry's priority is the cache clock
+        plus its hit count times its load cost (seconds spent fetching and
+        decoding it), and the lowest priority entry is evicted first. Expensive
+        high-df lists therefore outlive cheap ones, while every eviction raises
+        the clock so entries that stop being used age out as in an LRU.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # key -> [value, nbytes, cost, freq, seq]
+        self._entries = {}
+        # (priority, seq, key); entries whose seq no longer matches are stale
+        self._heap = []
+        self._seq = itertools.count()
+        self._clock = 0.0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def _push(self, key, entry):
+        entry[4] = next(self._seq)
+        heapq.heappush(self._heap, (self._clock + entry[3] * entry[2], entry[4], key))
+        if len(self._heap) > 4 * len(self._entries) + 1024:
+            self._heap = [(p, seq, k) for p, seq, k in self._heap
+                          if k in self._entries and self._entries[k][4] == seq]
+            heapq.heapify(self._heap)
+
+    def get(self, key):
+        """ Returns the cached value for `key` or None. """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            entry[3] += 1
+            self._push(key, entry)
+            return entry[0]
+
+    def put(self, key, value, nbytes, cost):
+        """ Caches `value`, which occupies `nbytes` bytes and took `cost`
+            seconds to load, evicting lower priority entries to make room.
+            Values larger than the whole budget are not cached.
+        """
+        if nbytes > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.nbytes -= old[1]
+            while self.nbytes + nbytes > self.max_bytes and self._heap:
+                priority, seq, victim = heapq.heappop(self._heap)
+                entry = self._entries.get(victim)
+                if entry is None or entry[4] != seq:
+                    continue
+                del self._entries[victim]
+                self.nbytes -= entry[1]
+                self.evictions += 1
+                self._clock = priority
+            entry = [value, nbytes, cost, 1 if old is None else old[3], 0]
+            self._entries[key] = entry
+            self.nbytes += nbytes
+            self._push(key, entry)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._heap = []
+            self.nbytes = 0
+            self._clock = 0.0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'bytes': self.nbytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+            }
@@ -0,0 +1,126 @@
+import gc
+import os
+import signal
+import socket
+import threading
+import time
+import traceback
+
+from werkzeug.serving import make_server
+
+WORKERS_ENV = "IR_WORKERS"
+GRACEFUL_TIMEOUT_ENV = "IR_GRACEFUL_TIMEOUT"
+DEFAULT_GRACEFUL_TIMEOUT = 30.0
+
+
+def default_workers():
+    return int(os.environ.get(WORKERS_ENV, os.cpu_count() or 1))
+
+
+class PreforkServer:
+    """ Serves a WSGI app from `workers` forked processes accepting on one
+        listening socket. Whatever the app loaded before `serve_forever` is
+        shared copy-on-write by all workers: the memory-mapped artifacts
+        (lexicons, columns, titles, posting files) stay shared page cache, and
+        the Python objects are frozen out of the cyclic GC so collections in
+        the workers do not write to - and copy - their pages.
+
+        SIGTERM / SIGINT stop the workers gracefully: they stop accepting and
+        finish the requests in flight, and are killed after `graceful_timeout`
+        seconds. A worker that dies otherwise is replaced.
+    """
+    def __init__(self, app, host='0.0.0.0', port=8080, workers=None, graceful_timeout=None,
+                 after_fork=None, backlog=1024):
+        self.app = app
+        self.host = host
+        self.port = port
+        self.workers = workers or default_workers()
+        if graceful_timeout is None:
+            graceful_timeout = float(os.environ.get(GRACEFUL_TIMEOUT_ENV, DEFAULT_GRACEFUL_TIMEOUT))
+        self.graceful_timeout = graceful_timeout
+        # called in each worker right after the fork
+        self.after_fork = after_fork
+        self.backlog = backlog
+        self.socket = None
+        self.pids = set()
+        self._stopping = False
+
+    def bind(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((self.host, self.port))
+        sock.listen(self.backlog)
+        sock.set_inheritable(True)
+        self.socket = sock
+        self.port = sock.getsockname()[1]
+        return sock
+
+    def serve_forever(self):
+        if self.socket is None:
+            self.bind()
+        gc.collect()
+        gc.freeze()
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        print(f"Serving on {self.host}:{self.port} with {self.workers} workers")
+        for _ in range(self.workers):
+            self._spawn()
+        deadline = None
+        while self.pids:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+            if pid == 0:
+                if self._stopping and deadline is None:
+                    deadline = time.monotonic() + self.graceful_timeout
+                if deadline is not None and time.monotonic() > deadline:
+                    for pid in self.pids:
+                        os.kill(pid, signal.SIGKILL)
+                    deadline = float('inf')
+                time.sleep(0.1)
+                continue
+            self.pids.discard(pid)
+            if not self._stopping:
+                print(f"Worker {pid} exited with status {status}; restarting")
+                # do not spin when workers die on startup
+                time.sleep(1)
+                self._spawn()
+        self.socket.close()
+        print("Server stopped")
+
+    def _stop(self, signum, frame):
+        if self._stopping:
+            return
+        self._stopping = True
+        for pid in self.pids:
+            os.kill(pid, signal.SIGTERM)
+
+    def _spawn(self):
+        pid = os.fork()
+        if pid:
+            self.pids.add(pid)
+            return pid
+        code = 1
+        try:
+            self._run_worker()
+            code = 0
+        except BaseException:
+            traceback.print_exc()
+        finally:
+            os._exit(code)
+
+    def _run_worker(self):
+        # the parent forwards ctrl-C as SIGTERM
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        if self.after_fork is not None:
+            self.after_fork()
+        server = make_server(self.host, self.port, self.app, threaded=True, fd=self.socket.fileno())
+        # let server_close() wait for the requests in flight
+        server.daemon_threads = False
+        server.block_on_close = True
+
+        def shutdown(signum, frame):
+            threading.Thread(target=server.shutdown, daemon=True).start()
+        signal.signal(signal.SIGTERM, shutdown)
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
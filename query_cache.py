@@ -0,0 +1,138 @@
+import sys
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+import numpy as np
+
+
+def result_nbytes(value):
+    """ Approximate memory held by a cached result: arrays by their buffer,
+        lists / tuples / dicts by their items, everything else by getsizeof.
+    """
+    if isinstance(value, np.ndarray):
+        return value.nbytes + 112
+    if isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(result_nbytes(item) for item in value)
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(result_nbytes(k) + result_nbytes(v) for k, v in value.items())
+    return sys.getsizeof(value)
+
+
+class QueryCache:
+    """ LRU + TTL cache of whole search results, keyed by normalized query.
+
+        Concurrent misses on the same key are collapsed into one computation
+        (single-flight): the first caller computes, the others wait for its
+        result. Every lookup passes the current index version; a new version
+        drops all entries, and results computed against an older version are
+        not stored. Neither are results the caller marks as partial.
+
+        Bounded by both `max_entries` and `max_bytes` (None: no byte bound),
+        each entry weighted by `result_nbytes` - full title / anchor rankings
+        weigh far more than a page of results. Results larger than the whole
+        byte budget are not cached.
+    """
+    def __init__(self, max_entries, ttl, max_bytes=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.collapsed = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+        # key -> (expires_at, value, nbytes)
+        self._entries = OrderedDict()
+        self._in_flight = {}
+        self._version = None
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _check_version(self, version):
+        if version != self._version:
+            if self._entries:
+                self.invalidations += 1
+            self._entries.clear()
+            self.nbytes = 0
+            self._version = version
+
+    def get_or_compute(self, key, compute, version=None, cacheable=None):
+        """ The cached result for `key`, or compute() - run once for all
+            concurrent callers of the same key - which is then cached, unless
+            cacheable() says otherwise (e.g. a search missing a timed-out
+            signal). Exceptions reach every waiting caller and are not cached.
+        """
+        with self._lock:
+            self._check_version(version)
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[1]
+                del self._entries[key]
+                self.nbytes -= entry[2]
+                self.expirations += 1
+            future = self._in_flight.get(key)
+            leader = future is None
+            if leader:
+                future = self._in_flight[key] = Future()
+                self.misses += 1
+            else:
+                self.collapsed += 1
+        if not leader:
+            return future.result()
+
+        try:
+            value = compute()
+        except BaseException as e:
+            with self._lock:
+                del self._in_flight[key]
+            future.set_exception(e)
+            raise
+        nbytes = result_nbytes(value) if self.max_entries > 0 and self.max_bytes is not None else 0
+        with self._lock:
+            del self._in_flight[key]
+            if version == self._version and self.max_entries > 0 and \
+                    (self.max_bytes is None or nbytes <= self.max_bytes) and (cacheable is None or cacheable()):
+                old = self._entries.pop(key, None)
+                if old is not None:
+                    self.nbytes -= old[2]
+                self._entries[key] = (time.monotonic() + self.ttl, value, nbytes)
+                self.nbytes += nbytes
+                while len(self._entries) > self.max_entries or \
+                        (self.max_bytes is not None and self.nbytes > self.max_bytes):
+                    _, evicted = self._entries.popitem(last=False)
+                    self.nbytes -= evicted[2]
+                    self.evictions += 1
+        future.set_result(value)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses + self.collapsed
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'bytes': self.nbytes,
+                'max_bytes': self.max_bytes,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'collapsed': self.collapsed,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'invalidations': self.invalidations,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+            }
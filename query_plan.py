@@ -0,0 +1,68 @@
+import threading
+
+
+class QueryPlan:
+    """ A query analysed once per request and shared by every signal scoring
+        it: the tokens (stopwords removed), their stems, the stemmed bigrams,
+        per-index term statistics, and the posting lists fetched so far.
+
+        Posting fetches go through `read_posting_lists`, which reads each
+        (folder, term) at most once per plan - a signal asking for a list that
+        another signal is already fetching waits for that fetch instead of
+        issuing its own.
+    """
+    def __init__(self, query, tokens, stemmed_tokens, bigrams, fetch):
+        self.query = query
+        self.tokens = tokens
+        self.stemmed_tokens = stemmed_tokens
+        self.bigrams = bigrams
+        # set when a signal timed out and the results lack it - not cached
+        self.partial = False
+        # fetch(index, terms, gcs_folder) -> {term: PostingList}
+        self._fetch = fetch
+        self._stats = {}
+        self._postings = {}
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def term_stats(self, index, terms):
+        """ {term: df} of the `terms` present in `index`, in first-seen order. """
+        stats = self._stats.setdefault(id(index), {})
+        out = {}
+        for term in dict.fromkeys(terms):
+            if term not in stats:
+                stats[term] = index.df.get(term)
+            if stats[term] is not None:
+                out[term] = stats[term]
+        return out
+
+    def read_posting_lists(self, index, terms, gcs_folder, fetch=None):
+        """ Same as BackendClass.read_posting_lists, fetching only the lists
+            this plan has not fetched yet. `fetch` replaces the plan's own for
+            other kinds of keys (e.g. BlockMaxReader's blocks).
+        """
+        terms = list(dict.fromkeys(terms))
+        with self._lock:
+            mine = [t for t in terms
+                    if (gcs_folder, t) not in self._postings and (gcs_folder, t) not in self._pending]
+            for term in mine:
+                self._pending[(gcs_folder, term)] = threading.Event()
+            waiting = [self._pending[(gcs_folder, t)] for t in terms
+                       if (gcs_folder, t) in self._pending and t not in mine]
+        if mine:
+            fetched = {}
+            try:
+                fetched = (fetch or self._fetch)(index, mine, gcs_folder)
+            finally:
+                with self._lock:
+                    for term in mine:
+                        self._postings[(gcs_folder, term)] = fetched.get(term)
+                        self._pending.pop((gcs_folder, term)).set()
+        for event in waiting:
+            event.wait()
+        postings = {}
+        for term in terms:
+            posting_list = self._postings.get((gcs_folder, term))
+            if posting_list is not None:
+                postings[term] = posting_list
+        return postings
@@ -0,0 +1,212 @@
+import io
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+from requests.adapters import HTTPAdapter
+
+GCS_XML_ENDPOINT = "https://storage.googleapis.com"
+GCS_READ_SCOPE = "https://www.googleapis.com/auth/devstorage.read_only"
+
+
+def coalesce_ranges(ranges, max_gap=0):
+    """ Merges byte ranges of the same file that touch or lie within `max_gap`
+        bytes of each other.
+    Parameters:
+    -----------
+      ranges: list of (path, offset, n_bytes)
+    Returns:
+    --------
+      list of (path, offset, n_bytes, members) where members is a list of
+      (index into `ranges`, offset relative to the merged range, n_bytes).
+    """
+    order = sorted(range(len(ranges)), key=lambda i: (ranges[i][0], ranges[i][1]))
+    merged = []
+    for i in order:
+        path, offset, n_bytes = ranges[i]
+        if merged:
+            m_path, m_offset, m_len, members = merged[-1]
+            if m_path == path and offset <= m_offset + m_len + max_gap:
+                end = max(m_offset + m_len, offset + n_bytes)
+                members.append((i, offset - m_offset, n_bytes))
+                merged[-1] = (m_path, m_offset, end - m_offset, members)
+                continue
+        merged.append((path, offset, n_bytes, [(i, 0, n_bytes)]))
+    return merged
+
+
+def fetch_ranges(read_range, ranges, pool, max_gap=0):
+    """ Reads a batch of (path, offset, n_bytes) ranges with
+        read_range(path, offset, n_bytes) on `pool`, one call per coalesced
+        range, and returns their bytes in input order.
+    """
+    merged = coalesce_ranges(ranges, max_gap)
+    futures = [pool.submit(read_range, path, offset, n_bytes) for path, offset, n_bytes, _ in merged]
+    out = [b''] * len(ranges)
+    for (_, _, _, members), future in zip(merged, futures):
+        data = future.result()
+        if len(members) == 1:
+            out[members[0][0]] = data
+            continue
+        view = memoryview(data)
+        for i, rel, n_bytes in members:
+            out[i] = view[rel:rel + n_bytes]
+    return out
+
+
+class HTTPRangeStore:
+    """ Storage backend over an HTTP object endpoint (the GCS XML API or the
+        local stand-in below). Postings are fetched with `Range` requests for
+        exactly the bytes needed, over one pooled keep-alive session, and
+        `read_ranges` fetches a whole batch concurrently with adjacent ranges
+        of the same file merged into a single request.
+    """
+    def __init__(self, base_url, session=None, max_workers=16, max_gap=0):
+        self.base_url = base_url.rstrip('/')
+        self.max_gap = max_gap
+        if session is None:
+            session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        self._session = session
+        self._max_workers = max_workers
+        self._pool = ThreadPoolExecutor(max_workers=max_workers)
+
+    def _url(self, path):
+        return f'{self.base_url}/{path.lstrip("/")}'
+
+    def _get(self, path, headers=None):
+        r = self._session.get(self._url(path), headers=headers)
+        if r.status_code == HTTPStatus.NOT_FOUND:
+            raise FileNotFoundError(f"Missing: {self._url(path)}")
+        r.raise_for_status()
+        return r
+
+    def exists(self, path):
+        r = self._session.head(self._url(path))
+        return r.status_code == HTTPStatus.OK
+
+    def open(self, path, mode='rb'):
+        if mode != 'rb':
+            raise ValueError(f"HTTPRangeStore is read-only, got mode {mode!r}")
+        return io.BytesIO(self.read_bytes(path))
+
+    def read_bytes(self, path):
+        return self._get(path).content
+
+    def read_range(self, path, offset, n_bytes):
+        """ Returns `n_bytes` bytes of `path` starting at `offset`. """
+        if n_bytes <= 0:
+            return b''
+        r = self._get(path, {'Range': f'bytes={offset}-{offset + n_bytes - 1}'})
+        if r.status_code == HTTPStatus.OK:
+            # server ignored the range header
+            return r.content[offset:offset + n_bytes]
+        return r.content
+
+    def read_ranges(self, ranges):
+        """ Fetches a batch of (path, offset, n_bytes) ranges concurrently and
+            returns their bytes in input order.
+        """
+        return fetch_ranges(self.read_range, ranges, self._pool, self.max_gap)
+
+    def after_fork(self):
+        """ Drops the connections and fetch threads inherited from the parent
+            process; both are re-created on the next request.
+        """
+        self._session.close()
+        self._pool = ThreadPoolExecutor(max_workers=self._max_workers)
+
+    def close(self):
+        self._pool.shutdown(wait=False)
+        self._session.close()
+
+
+def gcs_range_store(bucket_name, **kwargs):
+    """ HTTPRangeStore over the GCS XML API, authenticated with the default
+        service account credentials.
+    """
+    import google.auth
+    from google.auth.transport.requests import AuthorizedSession
+    credentials, _ = google.auth.default(scopes=[GCS_READ_SCOPE])
+    return HTTPRangeStore(f'{GCS_XML_ENDPOINT}/{bucket_name}',
+                          session=AuthorizedSession(credentials), **kwargs)
+
+
+RE_RANGE = re.compile(r'bytes=(\d+)-(\d*)$')
+
+
+class RangeRequestHandler(SimpleHTTPRequestHandler):
+    """ Static file handler with single-range `Range` support, standing in for
+        the object store when running offline.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        path = self.translate_path(self.path)
+        if not os.path.isfile(path):
+            self.send_error(HTTPStatus.NOT_FOUND)
+            return
+        size = os.path.getsize(path)
+        start, end = 0, size - 1
+        status = HTTPStatus.OK
+        m = RE_RANGE.match(self.headers.get('Range', ''))
+        if m:
+            start = int(m.group(1))
+            if m.group(2):
+                end = min(int(m.group(2)), size - 1)
+            if start > end:
+                self.send_error(HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE)
+                return
+            status = HTTPStatus.PARTIAL_CONTENT
+        n_bytes = end - start + 1
+        with open(path, 'rb') as f:
+            f.seek(start)
+            body = f.read(n_bytes)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(n_bytes))
+        if status == HTTPStatus.PARTIAL_CONTENT:
+            self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+        self.end_headers()
+        # counted before the body goes out, so a client that has its reply
+        # sees it in the stats
+        with self.server.stats_lock:
+            self.server.requests_served += 1
+            self.server.bytes_served += n_bytes
+        self.wfile.write(body)
+
+
+def serve_directory(root, host='127.0.0.1', port=0):
+    """ Serves `root` over HTTP with range support on a background thread.
+        Returns the server; its base URL is `http://host:server.server_port`.
+    """
+    def handler(*args, **kwargs):
+        return RangeRequestHandler(*args, directory=str(root), **kwargs)
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    server.stats_lock = threading.Lock()
+    server.requests_served = 0
+    server.bytes_served = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="Serve a local index mirror with HTTP range support.")
+    parser.add_argument('root')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    args = parser.parse_args()
+    srv = serve_directory(args.root, args.host, args.port)
+    print(f"Serving {args.root} on http://{args.host}:{srv.server_port}")
+    threading.Event().wait()
@@ -43,10 +43,18 @@ gcloud compute instances tail-serial-port-output $INSTANCE_NAME --zone $ZONE
 # Verify that the instance is running
 gcloud compute instances list --filter="name=$INSTANCE_NAME" --format="table(name,status,zone,EXTERNAL_IP)"
 
-# 4. Secure copy your app to the VM (assume search_frontend.py is available in the current directory)
-gcloud compute scp ./search_frontend.py \
+# 4. Secure copy your app to the VM (run from the repo root): search_frontend.py,
+# the modules it imports, and backend_OPTIMIZED_FIXED.py as backend.py
+APP_FILES="search_frontend.py ScoringEngine.py block_max_index.py columnar_metadata.py \
+  doc_index.py inverted_index_gcp.py lexicon.py posting_cache.py prefork_server.py \
+  query_cache.py query_plan.py remote_store.py startup_loader.py title_forward_index.py \
+  title_store.py tokenizer.py topk.py tracing.py"
+gcloud compute scp $APP_FILES \
   ${GOOGLE_ACCOUNT_NAME}@${INSTANCE_NAME}:/home/${GOOGLE_ACCOUNT_NAME} \
   --zone ${ZONE}
+gcloud compute scp ./backend_OPTIMIZED_FIXED.py \
+  ${GOOGLE_ACCOUNT_NAME}@${INSTANCE_NAME}:/home/${GOOGLE_ACCOUNT_NAME}/backend.py \
+  --zone ${ZONE}
 
 # 5. SSH to your VM and start the app
 gcloud compute ssh $GOOGLE_ACCOUNT_NAME@$INSTANCE_NAME --zone $ZONE
@@ -61,7 +69,8 @@ gcloud compute ssh $GOOGLE_ACCOUNT_NAME@$INSTANCE_NAME --zone $ZONE
 # PY
 
 # 7. Run the server
-nohup ~/venv/bin/python ~/search_frontend.py > ~/frontend.log 2>&1 &
+# (--workers: one worker per core, or IR_WORKERS)
+nohup ~/venv/bin/python ~/search_frontend.py --workers > ~/frontend.log 2>&1 &
 
 # 8. Start querying
 curl "http://127.0.0.1:8080/search?query=hello"
@@ -1,17 +1,189 @@
-from flask import Flask, request, jsonify
-from backend import BackendClass
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+import numpy as np
+from flask import Flask, Response, g, request, jsonify
+from flask.json.provider import DefaultJSONProvider
+from werkzeug.serving import make_server
+import tracing
+from backend import BackendClass, make_store, STARTUP_WORKERS_ENV, DEFAULT_STARTUP_WORKERS
+from startup_loader import StartupLoader
+from prefork_server import PreforkServer, default_workers
 
 class MyFlaskApp(Flask):
+    backend = None
+    loader = None
+    load_error = None
+
+    def load_backend(self):
+        """ Builds the backend on a background thread so the server answers
+            /healthz and /readyz while the indices load. """
+        print("🔄 Initializing backend...")
+        store = make_store()
+        self.loader = StartupLoader(store, int(os.environ.get(STARTUP_WORKERS_ENV, DEFAULT_STARTUP_WORKERS)))
+
+        def load():
+            try:
+                self.backend = BackendClass(store=store, loader=self.loader)
+                print("✅ Backend ready!")
+            except Exception as e:
+                self.load_error = repr(e)
+                print(f"❌ Backend failed to load: {self.load_error}")
+        threading.Thread(target=load, name='backend-loader', daemon=True).start()
+
+    def serve(self, host='0.0.0.0', port=8080, workers=None):
+        """ Production mode: binds the port first and answers /healthz and
+            /readyz from this process while the backend loads, then serves it
+            from `workers` forked processes (IR_WORKERS, default one per core)
+            that share the loaded indices. Lazy indices stay lazy: a worker
+            loads one on first use. """
+        server = PreforkServer(self, host, port, workers, after_fork=self.after_fork)
+        server.bind()
+        startup = make_server(host, server.port, self, threaded=True, fd=server.socket.fileno())
+        # let server_close() wait for the probes in flight before forking
+        startup.daemon_threads = False
+        startup.block_on_close = True
+        threading.Thread(target=startup.serve_forever, name='startup-server', daemon=True).start()
+        print(f"🔄 Initializing backend... (probes on {host}:{server.port})")
+        try:
+            store = make_store()
+            self.loader = StartupLoader(store, int(os.environ.get(STARTUP_WORKERS_ENV, DEFAULT_STARTUP_WORKERS)))
+            self.backend = BackendClass(store=store, loader=self.loader)
+            self.loader.close()
+            print("✅ Backend ready!")
+        except Exception as e:
+            self.load_error = repr(e)
+            raise
+        finally:
+            startup.shutdown()
+            startup.server_close()
+        # workers publish their metrics here so /metrics of any one covers all
+        self.metrics_dir = tempfile.mkdtemp(prefix='ir-metrics-')
+        try:
+            server.serve_forever()
+        finally:
+            shutil.rmtree(self.metrics_dir, ignore_errors=True)
+
+    def after_fork(self):
+        self.backend.after_fork()
+        tracing.REGISTRY.share(self.metrics_dir)
+
     def run(self, host=None, port=None, debug=None, **options):
         # Initialize backend when server starts
-        print("🔄 Initializing backend...")
-        self.backend = BackendClass()
-        print("✅ Backend ready!")
+        if self.backend is None and self.loader is None:
+            self.load_backend()
         super(MyFlaskApp, self).run(host=host, port=port, debug=debug, **options)
 
+# packed little-endian ids in (uint32) and values out (PageRank float32,
+# page views uint32) for /get_pagerank and /get_pageview
+BINARY_MIMETYPE = "application/octet-stream"
+# rows per chunk of a streamed /search_title or /search_anchor response
+STREAM_CHUNK_ENV = "IR_STREAM_CHUNK"
+DEFAULT_STREAM_CHUNK = 1000
+# most queries in one /search_batch request; larger batches get a 413
+MAX_BATCH_ENV = "IR_MAX_BATCH"
+DEFAULT_MAX_BATCH = 100
+
+# Prometheus text exposition format
+METRICS_MIMETYPE = "text/plain; version=0.0.4; charset=utf-8"
+UNMETERED_ENDPOINTS = ('metrics', 'healthz', 'readyz')
+
+class TimedJSONProvider(DefaultJSONProvider):
+    ''' Times response serialization as the 'json' stage. '''
+    def dumps(self, obj, **kwargs):
+        with tracing.stage('json'):
+            return super().dumps(obj, **kwargs)
+
 app = MyFlaskApp(__name__)
+app.json = TimedJSONProvider(app)
 app.config['JSONIFY_PRETTYPRINT_REGULAR'] = False
 
+tracing.REGISTRY.describe('ir_request_seconds', "Request latency, by endpoint.")
+tracing.REGISTRY.describe('ir_requests_total', "Requests answered, by endpoint and status code.")
+
+def cache_stats(cache_name):
+    def stats():
+        cache = getattr(app.backend, cache_name, None)
+        if cache is None:
+            return {}
+        return {(('stat', name),): value for name, value in cache.stats().items()}
+    return stats
+
+tracing.REGISTRY.describe('ir_posting_cache', "Posting cache counters, by stat.")
+tracing.REGISTRY.describe('ir_result_cache', "Result cache counters, by stat.")
+tracing.REGISTRY.gauge('ir_posting_cache', cache_stats('posting_cache'))
+tracing.REGISTRY.gauge('ir_result_cache', cache_stats('result_cache'))
+
+@app.before_request
+def start_timing():
+    ''' ?debug_timing=1 traces the request's stages; see add_timing. '''
+    g.request_start = time.perf_counter()
+    if request.args.get('debug_timing', '0') not in ('', '0', 'false'):
+      g.trace_context = tracing.trace()
+      g.trace = g.trace_context.__enter__()
+
+@app.after_request
+def add_timing(response):
+    ''' Records the request in the /metrics counters and, for a traced
+        request, adds a Server-Timing header with the stage breakdown and
+        wraps a JSON body as {"results": body, "timing": breakdown}. '''
+    if tracing.metrics_enabled and request.endpoint not in UNMETERED_ENDPOINTS:
+      endpoint = request.endpoint or 'unknown'
+      tracing.REGISTRY.observe('ir_request_seconds', time.perf_counter() - g.request_start, endpoint=endpoint)
+      tracing.REGISTRY.inc('ir_requests_total', endpoint=endpoint, status=response.status_code)
+    trace = g.get('trace')
+    if trace is None:
+      return response
+    if response.is_json and not response.is_streamed:
+      results = response.get_json()
+      timing = trace.to_dict()
+      response.set_data(app.json.dumps({'results': results, 'timing': timing}))
+    else:
+      timing = trace.to_dict()
+    response.headers['Server-Timing'] = ', '.join(
+        [f"{name};dur={stage['ms']:.3f}" for name, stage in timing['stages'].items()]
+        + [f"total;dur={timing['total_ms']:.3f}"])
+    return response
+
+@app.teardown_request
+def end_timing(exc):
+    trace_context = g.pop('trace_context', None)
+    if trace_context is not None:
+      trace_context.__exit__(None, None, None)
+
+@app.before_request
+def require_backend():
+    ''' Search endpoints answer 503 until the backend has loaded. '''
+    if app.backend is None and request.endpoint not in UNMETERED_ENDPOINTS:
+        return jsonify([]), 503
+
+@app.route("/healthz")
+def healthz():
+    ''' Liveness: 200 while the process is up and loading has not failed. '''
+    if app.load_error is not None:
+        return jsonify({'status': 'failed', 'error': app.load_error}), 500
+    return jsonify({'status': 'ok'})
+
+@app.route("/readyz")
+def readyz():
+    ''' Readiness: 200 once the hot indices and metadata are loaded, 503
+        before. The body lists every artifact with its load status, bytes
+        and seconds. '''
+    ready = app.backend is not None
+    artifacts = app.loader.report() if app.loader is not None else {}
+    return jsonify({'ready': ready, 'artifacts': artifacts}), 200 if ready else 503
+
+@app.route("/metrics")
+def metrics():
+    ''' Prometheus metrics: per-stage and per-endpoint latency histograms,
+        posting lists and bytes fetched, and the posting and result cache
+        counters. Under --workers, summed over the workers (cache gauges
+        per worker). '''
+    return Response(tracing.REGISTRY.render(), content_type=METRICS_MIMETYPE)
+
 @app.route("/search")
 def search():
     ''' Returns up to a 100 of your best search results for the query. This is 
@@ -64,6 +236,39 @@ def search_body():
     # END SOLUTION
     return jsonify(res)
 
+def ranked_response(endpoint, query):
+    ''' A page and/or a stream of the /search_title or /search_anchor
+        results, with titles decoded only for the rows sent:
+          ?offset=N&limit=M  returns results[N:N+M]; the X-Total-Count header
+                             has the number of results and X-Next-Offset the
+                             offset of the next page, if there is one.
+          ?stream=1          sends the (paged) results as a chunked JSON list
+                             of IR_STREAM_CHUNK rows at a time.
+    '''
+    try:
+      offset = int(request.args.get('offset', 0))
+      limit = int(request.args['limit']) if 'limit' in request.args else None
+    except ValueError:
+      return jsonify([]), 400
+    if offset < 0 or (limit is not None and limit < 0):
+      return jsonify([]), 400
+    if request.args.get('stream', '0') not in ('', '0', 'false'):
+      chunks = app.backend.iter_search(endpoint, query, offset, limit,
+                                       int(os.environ.get(STREAM_CHUNK_ENV, DEFAULT_STREAM_CHUNK)))
+
+      def generate():
+        yield '['
+        for i, chunk in enumerate(chunks):
+          yield (',' if i else '') + app.json.dumps(chunk)[1:-1]
+        yield ']'
+      return Response(generate(), mimetype='application/json')
+    res, total = app.backend.search_page(endpoint, query, offset, limit)
+    response = jsonify(res)
+    response.headers['X-Total-Count'] = str(total)
+    if offset + len(res) < total:
+      response.headers['X-Next-Offset'] = str(offset + len(res))
+    return response
+
 @app.route("/search_title")
 def search_title():
     ''' Returns ALL (not just top 100) search results that contain A QUERY WORD 
@@ -90,6 +295,8 @@ def search_title():
     if len(query) == 0:
       return jsonify(res)
     # BEGIN SOLUTION
+    if any(arg in request.args for arg in ('offset', 'limit', 'stream')):
+      return ranked_response('search_title', query)
     res = app.backend.search_title(query)
     # END SOLUTION
     return jsonify(res)
@@ -120,10 +327,59 @@ def search_anchor():
     if len(query) == 0:
       return jsonify(res)
     # BEGIN SOLUTION
+    if any(arg in request.args for arg in ('offset', 'limit', 'stream')):
+      return ranked_response('search_anchor', query)
     res = app.backend.search_anchor(query)
     # END SOLUTION
     return jsonify(res)
 
+@app.route("/search_batch", methods=['POST'])
+def search_batch():
+    ''' Runs /search for many queries at once - posting lists shared by the
+        queries are read and decoded once for the whole batch.
+
+        Test this by issuing a POST request to a URL like:
+          http://YOUR_SERVER_DOMAIN/search_batch
+        with a json payload of the list of queries. In python do:
+          import requests
+          requests.post('http://YOUR_SERVER_DOMAIN/search_batch',
+                        json=['hello world', 'mount everest'])
+    Returns:
+    --------
+        list of result lists, one per query in the order given, each as
+        returned by /search. 400 unless the body is a JSON list of strings,
+        413 for more than IR_MAX_BATCH queries.
+    '''
+    res = []
+    queries = request.get_json(silent=True)
+    if not isinstance(queries, list) or not all(isinstance(q, str) for q in queries):
+      return jsonify(res), 400
+    if len(queries) > int(os.environ.get(MAX_BATCH_ENV, DEFAULT_MAX_BATCH)):
+      return jsonify(res), 413
+    if len(queries) == 0:
+      return jsonify(res)
+    res = app.backend.search_many(queries)
+    return jsonify(res)
+
+def posted_ids():
+    ''' The POSTed article ids: a JSON list, or with
+        Content-Type: application/octet-stream packed little-endian uint32s.
+        None when a binary body is not a whole number of ids. '''
+    if request.mimetype == BINARY_MIMETYPE:
+      data = request.get_data()
+      if len(data) % 4:
+        return None
+      return np.frombuffer(data, dtype='<u4')
+    return request.get_json()
+
+def wants_binary():
+    ''' Accept: application/octet-stream (preferred over JSON) asks for the
+        values as a packed little-endian array. '''
+    return request.accept_mimetypes.best_match(['application/json', BINARY_MIMETYPE]) == BINARY_MIMETYPE
+
+def binary_response(values, dtype):
+    return Response(np.ascontiguousarray(values, dtype=dtype).tobytes(), mimetype=BINARY_MIMETYPE)
+
 @app.route("/get_pagerank", methods=['POST'])
 def get_pagerank():
     ''' Returns PageRank values for a list of provided wiki article IDs. 
@@ -133,6 +389,8 @@ def get_pagerank():
         with a json payload of the list of article ids. In python do:
           import requests
           requests.post('http://YOUR_SERVER_DOMAIN/get_pagerank', json=[1,5,8])
+        For large batches post the ids as packed little-endian uint32s with
+        Content-Type and Accept application/octet-stream to get float32s back.
         As before YOUR_SERVER_DOMAIN is something like XXXX-XX-XX-XX-XX.ngrok.io
         if you're using ngrok on Colab or your external IP on GCP.
     Returns:
@@ -141,10 +399,14 @@ def get_pagerank():
           list of PageRank scores that correrspond to the provided article IDs.
     '''
     res = []
-    wiki_ids = request.get_json()
-    if len(wiki_ids) == 0:
+    wiki_ids = posted_ids()
+    if wiki_ids is None:
+      return jsonify(res), 400
+    if len(wiki_ids) == 0 and not wants_binary():
       return jsonify(res)
     # BEGIN SOLUTION
+    if wants_binary():
+      return binary_response(app.backend.pagerank_array(wiki_ids), '<f4')
     res = app.backend.get_pagerank(wiki_ids)
     # END SOLUTION
     return jsonify(res)
@@ -159,6 +421,8 @@ def get_pageview():
         with a json payload of the list of article ids. In python do:
           import requests
           requests.post('http://YOUR_SERVER_DOMAIN/get_pageview', json=[1,5,8])
+        For large batches post the ids as packed little-endian uint32s with
+        Content-Type and Accept application/octet-stream to get uint32s back.
         As before YOUR_SERVER_DOMAIN is something like XXXX-XX-XX-XX-XX.ngrok.io
         if you're using ngrok on Colab or your external IP on GCP.
     Returns:
@@ -168,10 +432,14 @@ def get_pageview():
           provided list article IDs.
     '''
     res = []
-    wiki_ids = request.get_json()
-    if len(wiki_ids) == 0:
+    wiki_ids = posted_ids()
+    if wiki_ids is None:
+      return jsonify(res), 400
+    if len(wiki_ids) == 0 and not wants_binary():
       return jsonify(res)
     # BEGIN SOLUTION
+    if wants_binary():
+      return binary_response(app.backend.pageview_array(wiki_ids), '<u4')
     res = app.backend.get_pageview(wiki_ids)
     # END SOLUTION
     return jsonify(res)
@@ -180,5 +448,15 @@ def run(**options):
     app.run(**options)
 
 if __name__ == '__main__':
-    # run the Flask RESTful API, make the server publicly available (host='0.0.0.0') on port 8080
-    app.run(host='0.0.0.0', port=8080, debug=True)
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, nargs='?', const=0, default=None,
+                        help="serve from N forked workers (no N or 0: IR_WORKERS, default one per core); "
+                             "omit for the dev server")
+    parser.add_argument('--port', type=int, default=8080)
+    args = parser.parse_args()
+    if args.workers is not None:
+        app.serve(port=args.port, workers=args.workers or default_workers())
+    else:
+        # run the Flask RESTful API, make the server publicly available (host='0.0.0.0') on port 8080
+        app.run(host='0.0.0.0', port=args.port, debug=True)
@@ -0,0 +1,111 @@
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+
+# store methods whose results are counted as bytes read
+_READ_METHODS = ('read_bytes', 'map_bytes', 'read_range', 'read_ranges')
+
+
+class MeteredStore:
+    """ Storage backend wrapper counting the bytes read through it (by one
+        artifact here, by a benchmark run in benchmark.py). Other attributes -
+        including the absence of optional methods such as `map_bytes` - pass
+        through to the wrapped store.
+    """
+    def __init__(self, store):
+        self._store = store
+        self.nbytes = 0
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        attr = getattr(self._store, name)
+        if name not in _READ_METHODS:
+            return attr
+
+        def metered(*args, **kwargs):
+            result = attr(*args, **kwargs)
+            n = sum(len(chunk) for chunk in result) if name == 'read_ranges' else len(result)
+            with self._lock:
+                self.nbytes += n
+            return result
+        return metered
+
+
+class StartupLoader:
+    """ Loads the artifacts a backend needs through a storage backend. Eager
+        artifacts start loading concurrently as soon as they are added; lazy
+        ones load on their first `get`. Every load is logged with the bytes
+        it read and the seconds it took, and kept for `report`.
+    """
+    def __init__(self, store, max_workers=8):
+        self.store = store
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='loader')
+        self._loaders = {}
+        self._futures = {}
+        self._lazy = set()
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def add(self, name, fn, lazy=False):
+        """ Registers artifact `name`, loaded by fn(store). """
+        self._loaders[name] = fn
+        if lazy:
+            self._lazy.add(name)
+        else:
+            self._futures[name] = self._pool.submit(self._load, name)
+
+    def _load(self, name):
+        store = MeteredStore(self.store)
+        start = time.perf_counter()
+        status = 'failed'
+        try:
+            value = self._loaders[name](store)
+            status = 'loaded'
+            return value
+        finally:
+            seconds = time.perf_counter() - start
+            self._stats[name] = {'status': status, 'bytes': store.nbytes, 'seconds': seconds,
+                                 'lazy': name in self._lazy}
+            # one write per line so lines of concurrent loads do not interleave
+            print((f"Loaded {name}: {store.nbytes:,} bytes in {seconds:.2f}s" if status == 'loaded'
+                   else f"Failed to load {name} after {seconds:.2f}s") + "\n", end='')
+
+    def get(self, name):
+        """ The artifact, loading it now if it is lazy and not loaded yet.
+            Re-raises the exception its load failed with.
+        """
+        future = self._futures.get(name)
+        if future is None:
+            with self._lock:
+                future = self._futures.get(name)
+                leader = future is None
+                if leader:
+                    future = self._futures[name] = Future()
+            if leader:
+                try:
+                    future.set_result(self._load(name))
+                except BaseException as e:
+                    future.set_exception(e)
+        return future.result()
+
+    def loaded(self, name):
+        future = self._futures.get(name)
+        return future is not None and future.done() and future.exception() is None
+
+    def wait(self):
+        """ Waits for all eager artifacts; returns {name: value}. """
+        eager = {name: future for name, future in self._futures.items() if name not in self._lazy}
+        wait(eager.values())
+        return {name: future.result() for name, future in eager.items()}
+
+    def report(self):
+        """ {name: {status, bytes, seconds, lazy}}; lazy artifacts not loaded
+            yet are 'pending'.
+        """
+        report = {name: {'status': 'pending', 'bytes': 0, 'seconds': 0.0, 'lazy': name in self._lazy}
+                  for name in self._loaders}
+        report.update(self._stats)
+        return report
+
+    def close(self):
+        self._pool.shutdown(wait=False)
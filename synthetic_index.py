@@ -0,0 +1,133 @@
+import os
+import pickle
+import random
+import zlib
+from pathlib import Path
+
+from inverted_index_gcp import InvertedIndex
+from tokenizer import Tokenizer
+
+N_BUCKETS = 4
+
+
+def synthetic_docs(queries, n_docs=5000, seed=1):
+    """ {wiki_id: (title, body, anchor text)} over the ground-truth ids of
+        `queries` ({query: [wiki_id, ...]}) plus random filler ids. A doc is
+        written from the words of the queries it is relevant to - more so the
+        higher it is in their list - over a Zipfian filler vocabulary, so the
+        ranking signals have something to find but do not find it perfectly.
+    """
+    rng = random.Random(seed)
+    filler = [f"word{i:03}" for i in range(500)]
+    weights = [1 / (i + 1) for i in range(len(filler))]
+    query_words = {q: q.split() for q in queries}
+    all_words = [w for words in query_words.values() for w in words]
+
+    relevant = {}
+    for q, ids in queries.items():
+        for rank, doc_id in enumerate(ids):
+            relevant.setdefault(int(doc_id), []).append((q, rank / max(len(ids), 1)))
+    doc_ids = set(relevant)
+    while len(doc_ids) < n_docs:
+        doc_ids.add(rng.randrange(1, 70_000_000))
+
+    docs = {}
+    for doc_id in sorted(doc_ids):
+        topical = []
+        for q, depth in relevant.get(doc_id, ()):
+            words = query_words[q]
+            topical += rng.sample(words, max(1, round(len(words) * (1 - depth) * rng.random())))
+        # some noise from unrelated queries
+        topical += rng.sample(all_words, rng.randint(0, 2))
+        title = " ".join(topical[:6] + rng.choices(filler[:50], k=rng.randint(0, 3)))
+        body = rng.choices(filler, weights=weights, k=rng.randint(30, 400))
+        for w in topical:
+            body[rng.randrange(len(body))] = w
+        anchor = " ".join(rng.choices(topical or filler[:20], k=rng.randint(0, 8)))
+        docs[doc_id] = (title, " ".join(body), anchor)
+    return docs
+
+
+def write_index(root, index_dir, postings_dir, pickle_name, tokens_by_doc):
+    """ Writes an InvertedIndex of {doc_id: tokens} the way the index building
+        notebooks lay it out: posting files under `postings_dir` and the
+        pickled index at `index_dir/pickle_name`.
+    """
+    index = InvertedIndex()
+    for doc_id, tokens in tokens_by_doc.items():
+        index.add_doc(doc_id, tokens)
+    base_dir = Path(root) / postings_dir
+    base_dir.mkdir(parents=True, exist_ok=True)
+    buckets = {}
+    for w in sorted(index._posting_list):
+        bucket = str(zlib.crc32(w.encode('utf-8')) % N_BUCKETS)
+        buckets.setdefault(bucket, []).append((w, sorted(index._posting_list[w])))
+    for bucket, w_pl in buckets.items():
+        InvertedIndex.write_a_posting_list((bucket, w_pl), str(base_dir))
+        locs_path = base_dir / f'{bucket}_posting_locs.pickle'
+        with open(locs_path, 'rb') as f:
+            for w, locs in pickle.load(f).items():
+                index.posting_locs[w].extend(locs)
+        os.remove(locs_path)
+    _dump(Path(root) / index_dir / pickle_name, index)
+    return index
+
+
+def _dump(path, obj):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, 'wb') as f:
+        pickle.dump(obj, f)
+
+
+def _bigrams(tokens):
+    return [f"{a}_{b}" for a, b in zip(tokens, tokens[1:])]
+
+
+def build_mirror(root, queries, n_docs=5000, seed=1):
+    """ Writes a small local mirror of the bucket - the indices, PageRank,
+        page views, doc lengths and titles BackendClass loads - from
+        `synthetic_docs`, and returns the number of documents. Serve it with
+        IR_LOCAL_INDEX_DIR=root.
+    """
+    root = Path(root)
+    docs = synthetic_docs(queries, n_docs, seed)
+    rng = random.Random(seed)
+    tokenizer = Tokenizer()
+    ids = list(docs)
+    titles = [docs[d][0].lower() for d in ids]
+
+    body_stem = dict(zip(ids, tokenizer.tokenize_many((docs[d][1] for d in ids), stem=True)))
+    title_stem = dict(zip(ids, tokenizer.tokenize_many(titles, stem=True)))
+    write_index(root, 'postings_gcp', 'postings_gcp', 'index.pkl', body_stem)
+    write_index(root, 'title_stemmed', 'title_stemmed', 'index.pkl', title_stem)
+    write_index(root, 'title_nostem', 'postings_title_nostem', 'index.pkl',
+                dict(zip(ids, tokenizer.tokenize_many(titles, stem=False))))
+    write_index(root, 'anchor_index', 'anchor_postings_gcp', 'anchor_index.pkl',
+                dict(zip(ids, tokenizer.tokenize_many((docs[d][2] for d in ids), stem=False))))
+    write_index(root, 'title_stemmed_phrases_idx', 'title_stemmed_phrases_idx', 'index.pkl',
+                {d: _bigrams(tokens) for d, tokens in title_stem.items()})
+    write_index(root, 'body_stemmed_phrases_idx', 'body_stemmed_phrases_idx', 'index.pkl',
+                {d: _bigrams(tokens) for d, tokens in body_stem.items()})
+
+    _dump(root / 'pr/pr.pkl', {d: rng.random() * 10 for d in ids})
+    _dump(root / 'page_views/pageview.pkl', {d: rng.randint(0, 100000) for d in ids})
+    _dump(root / 'postings_gcp/doc_lengths.pkl', {d: len(tokens) for d, tokens in body_stem.items()})
+    _dump(root / 'id_title/even_id_title_dict.pkl', {d: docs[d][0] for d in ids if d % 2 == 0})
+    _dump(root / 'id_title/uneven_id_title_dict.pkl', {d: docs[d][0] for d in ids if d % 2 == 1})
+    return len(docs)
+
+
+if __name__ == '__main__':
+    import argparse
+    import json
+    parser = argparse.ArgumentParser(
+        description="Build a small synthetic local mirror of the bucket from a queries file.")
+    parser.add_argument('root')
+    parser.add_argument('--queries', default='queries_train.json')
+    parser.add_argument('--docs', type=int, default=5000)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    with open(args.queries, encoding='utf-8') as f:
+        queries = json.load(f)
+    n_docs = build_mirror(args.root, queries, args.docs, args.seed)
+    print(f"{n_docs:,} documents -> {args.root}")
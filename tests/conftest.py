@@ -0,0 +1,29 @@
+import json
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from synthetic_index import build_mirror
+
+
+@pytest.fixture(scope='session')
+def queries():
+    with open(ROOT / 'queries_train.json', encoding='utf-8') as f:
+        return json.load(f)
+
+
+@pytest.fixture(scope='session')
+def mirror(tmp_path_factory, queries):
+    """ A small synthetic mirror, with BM25 bounds on the body indices and the
+        block-max copy of the body postings.
+    """
+    root = tmp_path_factory.mktemp('mirror')
+    build_mirror(root, queries, n_docs=1500)
+    for script in ('index_builder.py', 'block_max_index.py'):
+        subprocess.run([sys.executable, script, str(root)], cwd=ROOT, check=True, capture_output=True)
+    return root
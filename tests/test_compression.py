@@ -0,0 +1,75 @@
+import pickle
+
+import numpy as np
+import pytest
+
+from inverted_index_gcp import (InvertedIndex, LocalStore, POSTING_FORMAT_VARINT,
+                                decode_compressed, decode_varints, encode_compressed, encode_varints)
+
+
+def test_varints_round_trip_at_byte_boundaries():
+    values = np.array([0, 1, 127, 128, 16383, 16384, 2**21 - 1, 2**21, 2**32 - 1, 2**35], dtype=np.uint64)
+    data = encode_varints(values)
+    decoded, used = decode_varints(data + b'\x05\x80\x01', len(values))
+    assert used == len(data)
+    assert decoded.tolist() == values.tolist()
+
+
+@pytest.mark.parametrize('seed', range(3))
+def test_compressed_postings_round_trip_without_tf_clipping(seed):
+    rng = np.random.default_rng(seed)
+    doc_ids = np.unique(rng.integers(0, 2**32 - 1, 5000, dtype=np.uint64)).astype(np.uint32)
+    tfs = rng.integers(1, 300, len(doc_ids)).astype(np.uint32)
+    tfs[::97] = rng.integers(65536, 2**24, len(tfs[::97]))
+    decoded_ids, decoded_tfs = decode_compressed(encode_compressed(doc_ids, tfs), len(doc_ids))
+    assert decoded_ids.tolist() == doc_ids.tolist()
+    assert decoded_tfs.tolist() == tfs.tolist()
+
+
+def test_empty_and_single_posting_lists():
+    for doc_ids, tfs in (([], []), ([7], [70000])):
+        decoded_ids, decoded_tfs = decode_compressed(encode_compressed(doc_ids, tfs), len(doc_ids))
+        assert decoded_ids.tolist() == doc_ids
+        assert decoded_tfs.tolist() == tfs
+
+
+def test_corrupt_lists_raise():
+    doc_ids, tfs = [3, 200, 70000], [1, 300, 2]
+    data = encode_compressed(doc_ids, tfs)
+    for bad in (data[:-1], data[:-3], data + b'\x01', data[1:], b''):
+        with pytest.raises(ValueError):
+            decode_compressed(bad, len(doc_ids))
+    with pytest.raises(ValueError):
+        decode_compressed(data, len(doc_ids) + 1)
+    # an 11-byte varint does not fit in 64 bits
+    with pytest.raises(ValueError):
+        decode_varints(b'\xff' * 10 + b'\x01', 1)
+
+
+def test_written_varint_lists_read_back(tmp_path):
+    lists = [('alpha', [(3, 1), (10, 65535), (11, 65536), (4_000_000_000, 100_000)]),
+             ('beta', [(1, 2)])]
+    InvertedIndex.write_a_posting_list(('0', lists), str(tmp_path), compress=True)
+    index = InvertedIndex()
+    index.posting_format = POSTING_FORMAT_VARINT
+    with open(tmp_path / '0_posting_locs.pickle', 'rb') as f:
+        index.posting_locs.update(pickle.load(f))
+    with open(tmp_path / '0_posting_nbytes.pickle', 'rb') as f:
+        index.posting_nbytes = pickle.load(f)
+    for w, pl in lists:
+        index.df[w] = len(pl)
+    for w, pl in lists:
+        assert index.read_a_posting_list(str(tmp_path), w) == pl
+
+
+def test_compressed_copy_matches_raw_index(mirror, tmp_path):
+    with open(mirror / 'postings_gcp/index.pkl', 'rb') as f:
+        index = pickle.load(f)
+    store = LocalStore(mirror)
+    compressed = index.compressed_copy('postings_gcp', str(tmp_path), store=store)
+    for w in index.df:
+        raw = index.read_a_posting_array('postings_gcp', w, store=store)
+        packed = compressed.read_a_posting_array(str(tmp_path), w)
+        assert packed.doc_ids.tolist() == raw.doc_ids.tolist()
+        assert packed.tfs.tolist() == raw.tfs.tolist()
+    assert sum(compressed.posting_nbytes.values()) < sum(index.posting_size(w) for w in index.df)
@@ -0,0 +1,45 @@
+import pytest
+
+from backend_OPTIMIZED_FIXED import BackendClass
+from inverted_index_gcp import LocalStore
+from query_cache import QueryCache
+from ScoringEngine import ScoringEngine
+from topk import top_k_items
+
+
+class PostingsIndex:
+    """ The index interface ScoringEngine.cosine_similarity reads: DL, df,
+        doc_norm (none, as in the built indices) and read_posting_list.
+    """
+    def __init__(self, backend):
+        self.backend = backend
+        self.DL = dict(backend.doc_lengths.items())
+        self.df = backend.body_stem_index.df
+        self.doc_norm = {}
+
+    def read_posting_list(self, term, base_dir):
+        return self.backend.read_posting_list_from_gcs(self.backend.body_stem_index, term, 'postings_gcp')
+
+
+@pytest.fixture(scope='module')
+def backend(mirror):
+    return BackendClass(store=LocalStore(mirror), result_cache=QueryCache(0, 0))
+
+
+def test_cosine_matches_brute_force(backend, queries):
+    index = PostingsIndex(backend)
+    assert backend.N == len(index.DL)
+    for query in list(queries) + ["word001 word002 word001", "word003 word100 word400"]:
+        tokens = backend.plan(query).stemmed_tokens
+        doc_ids, scores = backend.calculate_cosine_similarity(tokens, backend.body_stem_index, 'postings_gcp')
+        expected = dict(ScoringEngine.cosine_similarity(tokens, index, top_n=None))
+        assert dict(zip(doc_ids.tolist(), scores.tolist())) == pytest.approx(expected, rel=1e-9), query
+        ranking = [doc_id for doc_id, _ in top_k_items(doc_ids, scores, 100)]
+        assert ranking == [doc_id for doc_id, _ in top_k_items(list(expected), list(expected.values()), 100)], query
+
+
+def test_search_body_returns_the_cosine_ranking(backend):
+    doc_ids, scores = backend.calculate_cosine_similarity(
+        backend.plan("word003 word100").stemmed_tokens, backend.body_stem_index, 'postings_gcp')
+    expected = [str(doc_id) for doc_id, _ in top_k_items(doc_ids, scores, 100)]
+    assert [doc_id for doc_id, _ in backend.search_body("word003 word100")] == expected
@@ -0,0 +1,67 @@
+import pickle
+import shutil
+import subprocess
+import sys
+
+import pytest
+
+from backend_OPTIMIZED_FIXED import BackendClass
+from inverted_index_gcp import InvertedIndex, LocalStore
+from lexicon import Lexicon, LexiconView
+from query_cache import QueryCache
+
+from conftest import ROOT
+
+
+def frozen(index):
+    return Lexicon.from_buffer(Lexicon.freeze(index)).index()
+
+
+@pytest.mark.parametrize('path', ['postings_gcp/index.pkl', 'title_nostem/index.pkl',
+                                  'postings_gcp_block_max/index.pkl'])
+def test_lexicon_matches_index(mirror, path):
+    with open(mirror / path, 'rb') as f:
+        index = pickle.load(f)
+    lexicon = frozen(index)
+    assert dict(lexicon.df.items()) == {w: df for w, df in index.df.items() if df}
+    assert len(lexicon.posting_locs) == len(index.posting_locs)
+    for w, locs in index.posting_locs.items():
+        assert lexicon.posting_locs[w] == [tuple(loc) for loc in locs]
+        assert lexicon.df[w] == index.df[w]
+    bm25_max = getattr(index, 'bm25_max', {})
+    assert dict(lexicon.bm25_max.items()) == bm25_max
+    assert lexicon.bm25_params == getattr(index, 'bm25_params', None)
+
+
+def test_missing_and_unicode_terms():
+    index = InvertedIndex()
+    for doc_id, tokens in ((1, ['café', 'naïve', '日本']), (2, ['café', 'zebra'])):
+        index.add_doc(doc_id, tokens)
+    for w in index.df:
+        index.posting_locs[w].append(('0_000.bin', len(w)))
+    lexicon = frozen(index)
+    assert dict(lexicon.df.items()) == dict(index.df)
+    assert lexicon.posting_locs['日本'] == [('0_000.bin', 2)]
+    assert 'missing' not in lexicon.df
+    assert lexicon.df['missing'] == 0
+    assert lexicon.posting_locs['missing'] == []
+    assert lexicon.df.get('missing') is None
+    assert lexicon.df.get(None) is None
+
+
+@pytest.fixture(scope='module')
+def lexicon_mirror(mirror, tmp_path_factory):
+    """ The synthetic mirror with every index frozen to a `.lex` lexicon. """
+    root = tmp_path_factory.mktemp('lexicon') / 'mirror'
+    shutil.copytree(mirror, root)
+    subprocess.run([sys.executable, 'lexicon.py', str(root)], cwd=ROOT, check=True, capture_output=True)
+    return root
+
+
+def test_backend_results_same_with_lexicons(mirror, lexicon_mirror, queries):
+    pickled = BackendClass(store=LocalStore(mirror), result_cache=QueryCache(0, 0))
+    frozen_backend = BackendClass(store=LocalStore(lexicon_mirror), result_cache=QueryCache(0, 0))
+    assert isinstance(frozen_backend.body_stem_index.df, LexiconView)
+    for query in queries:
+        for endpoint in ('search', 'search_body', 'search_title', 'search_anchor'):
+            assert getattr(frozen_backend, endpoint)(query) == getattr(pickled, endpoint)(query), (endpoint, query)
@@ -0,0 +1,108 @@
+import numpy as np
+import pytest
+
+import tracing
+from backend_OPTIMIZED_FIXED import BackendClass
+from block_max_index import BlockMaxTerm
+from inverted_index_gcp import LocalStore
+from query_cache import QueryCache
+from ScoringEngine import ScoringEngine, BM25Term
+from topk import top_k_items
+
+
+def random_terms(rng, n_docs, doc_lengths, avgdl, n_terms):
+    terms = []
+    for _ in range(n_terms):
+        df = int(rng.integers(1, n_docs // 2))
+        dense_ids = np.sort(rng.choice(n_docs, df, replace=False))
+        tfs = rng.integers(1, 20, df).astype(np.uint16)
+        idf = float(np.log((n_docs - df + 0.5) / (df + 0.5) + 1.0))
+        bound = ScoringEngine.bm25_term_scores(tfs, doc_lengths[dense_ids], idf, avgdl).max()
+        terms.append(BM25Term(idf, float(bound), dense_ids, tfs))
+    return terms
+
+
+@pytest.mark.parametrize('seed', range(5))
+@pytest.mark.parametrize('k', [1, 10, 100])
+def test_bm25_max_score_matches_exhaustive(seed, k):
+    rng = np.random.default_rng(seed)
+    n_docs = 3000
+    doc_lengths = rng.integers(5, 400, n_docs).astype(np.float32)
+    avgdl = float(doc_lengths.mean())
+    groups = [random_terms(rng, n_docs, doc_lengths, avgdl, 4), random_terms(rng, n_docs, doc_lengths, avgdl, 2)]
+
+    # per-group sums added up, as the backend adds the unigram and phrase scores
+    acc = np.zeros(n_docs)
+    for group in groups:
+        group_acc = np.zeros(n_docs)
+        for term in group:
+            ScoringEngine.bm25_accumulate(group_acc, term.dense_ids, term.tfs, doc_lengths, term.idf, avgdl)
+        acc += group_acc
+    matched = np.flatnonzero(acc)
+    expected = top_k_items(matched, acc[matched], k)
+
+    dense_ids, scores = ScoringEngine.bm25_max_score(groups, k, doc_lengths, avgdl)
+    assert top_k_items(dense_ids, scores, k) == expected
+
+
+@pytest.fixture(scope='module')
+def backend(mirror):
+    return BackendClass(store=LocalStore(mirror), result_cache=QueryCache(0, 0))
+
+
+@pytest.mark.parametrize('block_max', [True, False])
+@pytest.mark.parametrize('k', [1, 10, 100])
+def test_pruned_body_top_k_matches_exhaustive(backend, queries, block_max, k):
+    block_reader = backend.body_block_reader
+    assert block_reader is not None and backend.body_stem_index.bm25_max
+    if not block_max:
+        backend.body_block_reader = None
+    try:
+        terms = backend._bm25_bounded_terms(['word001'], backend.body_stem_index, 'postings_gcp')
+        assert terms and all(isinstance(t, BlockMaxTerm) == block_max for t in terms)
+        for query in list(queries) + ["word001 word002", "word003 word100 word400"]:
+            backend.body_pruning = True
+            pruned = backend.get_body_top_k(query, k)
+            backend.body_pruning = False
+            assert pruned == backend.get_body_top_k(query, k), query
+    finally:
+        backend.body_block_reader = block_reader
+        backend.body_pruning = True
+
+
+def test_pruned_and_exhaustive_bm25_are_separate_stages(backend):
+    stages = {}
+    for pruning in (True, False):
+        backend.body_pruning = pruning
+        with tracing.trace() as t:
+            backend.get_body_top_k("word001 word002", 10)
+        stages[pruning] = set(t.stages)
+    backend.body_pruning = True
+    assert 'maxscore' in stages[True] and 'bm25' not in stages[True]
+    assert 'bm25' in stages[False] and 'maxscore' not in stages[False]
+
+
+def test_bounds_for_another_avgdl_are_logged_and_unused(backend, capsys):
+    index = backend.body_stem_index
+    params = index.bm25_params
+    block_params = backend.body_block_reader.index.bm25_params
+    avgdl = backend.get_avgdl()
+    try:
+        # off by rounding only: the bounds still apply
+        index.bm25_params = dict(params, avgdl=avgdl * (1 + 1e-15))
+        backend.body_block_reader.index.bm25_params = dict(block_params, avgdl=avgdl * (1 - 1e-15))
+        assert backend._bm25_bounded_terms(['word001'], index, 'postings_gcp')
+
+        backend.body_block_reader.index.bm25_params = dict(block_params, avgdl=avgdl * 1.01)
+        assert all(not isinstance(t, BlockMaxTerm) for t in
+                   backend._bm25_bounded_terms(['word001'], index, 'postings_gcp'))
+        index.bm25_params = dict(params, avgdl=avgdl * 1.01)
+        assert backend._bm25_bounded_terms(['word001'], index, 'postings_gcp') is None
+        backend._bm25_bounded_terms(['word002'], index, 'postings_gcp')
+        logged = capsys.readouterr().out
+        assert logged.count("BM25 bounds of postings_gcp were computed with") == 1
+        assert logged.count("BM25 bounds of postings_gcp_block_max were computed with") == 1
+    finally:
+        index.bm25_params = params
+        backend.body_block_reader.index.bm25_params = block_params
+        backend._stale_bounds.clear()
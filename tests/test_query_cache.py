@@ -0,0 +1,31 @@
+import numpy as np
+
+from query_cache import QueryCache, result_nbytes
+
+
+def test_byte_budget_evicts_least_recently_used():
+    ranking = np.arange(10_000, dtype=np.int64)
+    cache = QueryCache(100, 60.0, max_bytes=3 * result_nbytes(ranking))
+    for q in 'abcd':
+        cache.get_or_compute(q, lambda: ranking.copy())
+    assert len(cache) == 3 and cache.evictions == 1
+    assert cache.nbytes == 3 * result_nbytes(ranking) <= cache.max_bytes
+    # 'a' was evicted, 'b' is still there
+    calls = []
+    cache.get_or_compute('b', lambda: calls.append('b'))
+    cache.get_or_compute('a', lambda: calls.append('a') or ranking.copy())
+    assert calls == ['a']
+
+
+def test_results_over_the_budget_are_not_cached():
+    cache = QueryCache(100, 60.0, max_bytes=1000)
+    cache.get_or_compute('small', lambda: [(1, 'title')])
+    cache.get_or_compute('big', lambda: np.zeros(1000))
+    assert len(cache) == 1 and 0 < cache.nbytes <= 1000
+    cache.clear()
+    assert cache.nbytes == 0
+
+
+def test_result_nbytes_counts_list_items():
+    page = [(i, f"title {i}") for i in range(100)]
+    assert result_nbytes(page) > result_nbytes(page[:10]) > 10 * result_nbytes("title 0")
@@ -0,0 +1,93 @@
+import pickle
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from inverted_index_gcp import LocalStore, MultiFileReader, TUPLE_SIZE
+from remote_store import HTTPRangeStore, coalesce_ranges, fetch_ranges, serve_directory
+
+
+@pytest.fixture
+def served(mirror):
+    server = serve_directory(mirror)
+    store = HTTPRangeStore(f'http://127.0.0.1:{server.server_port}', max_workers=4)
+    yield server, store
+    store.close()
+    server.shutdown()
+    server.server_close()
+
+
+def posting_requests(mirror, folder='postings_gcp', n=200):
+    with open(mirror / folder / 'index.pkl', 'rb') as f:
+        index = pickle.load(f)
+    terms = sorted(index.posting_locs)[:n]
+    return [(index.posting_locs[w], index.df[w] * TUPLE_SIZE) for w in terms]
+
+
+def test_coalesce_adjacent_and_overlapping_ranges():
+    ranges = [('a', 10, 5), ('b', 0, 4), ('a', 0, 10), ('a', 12, 8), ('a', 40, 2), ('a', 14, 2)]
+    merged = coalesce_ranges(ranges)
+    assert [(path, offset, n_bytes) for path, offset, n_bytes, _ in merged] == \
+        [('a', 0, 20), ('a', 40, 2), ('b', 0, 4)]
+    assert merged[0][3] == [(2, 0, 10), (0, 10, 5), (3, 12, 8), (5, 14, 2)]
+    # gaps up to max_gap are read through
+    assert [(p, o, n) for p, o, n, _ in coalesce_ranges(ranges, max_gap=20)] == \
+        [('a', 0, 42), ('b', 0, 4)]
+
+
+@pytest.mark.parametrize('max_gap', [0, 20])
+def test_fetch_ranges_slices_merged_reads(max_gap):
+    files = {'a': bytes(range(64)), 'b': bytes(range(100, 164))}
+    calls = []
+
+    def read_range(path, offset, n_bytes):
+        calls.append((path, offset, n_bytes))
+        return files[path][offset:offset + n_bytes]
+
+    ranges = [('a', 10, 5), ('b', 0, 4), ('a', 0, 10), ('a', 12, 8), ('a', 40, 2), ('a', 14, 2)]
+    with ThreadPoolExecutor(2) as pool:
+        out = fetch_ranges(read_range, ranges, pool, max_gap)
+    assert [bytes(b) for b in out] == [files[p][o:o + n] for p, o, n in ranges]
+    assert len(calls) == len(coalesce_ranges(ranges, max_gap))
+
+
+def test_read_many_matches_local_store(mirror, served):
+    server, http_store = served
+    requests = posting_requests(mirror)
+    # the same lists again, read from part way in, overlap the full reads
+    requests += [(locs, n_bytes - TUPLE_SIZE, TUPLE_SIZE)
+                 for locs, n_bytes in requests[::3] if n_bytes > TUPLE_SIZE]
+
+    local = MultiFileReader('postings_gcp', store=LocalStore(mirror)).read_many(requests)
+    remote = MultiFileReader('postings_gcp', store=http_store).read_many(requests)
+    assert [bytes(b) for b in remote] == [bytes(b) for b in local]
+    assert all(len(b) == request[1] for b, request in zip(remote, requests))
+
+
+def test_read_many_sends_one_request_per_merged_range(mirror, served):
+    server, http_store = served
+    requests = posting_requests(mirror)
+    reader = MultiFileReader('postings_gcp', store=http_store)
+    ranges = [r for request in requests for r in reader._ranges(*request)]
+    expected = len(coalesce_ranges(ranges))
+    # posting lists are written back to back, so the batch coalesces
+    assert expected < len(ranges)
+
+    before = server.requests_served
+    reader.read_many(requests)
+    assert server.requests_served - before == expected
+
+
+def test_missing_file_raises_file_not_found(served):
+    _, http_store = served
+    with pytest.raises(FileNotFoundError):
+        http_store.read_range('postings_gcp/missing.bin', 0, 10)
+
+
+def test_local_store_reads_empty_files(tmp_path):
+    (tmp_path / 'empty.bin').write_bytes(b'')
+    store = LocalStore(tmp_path)
+    assert bytes(store.read_range('empty.bin', 0, 6)) == b''
+    assert [bytes(b) for b in MultiFileReader('.', store=store).read_many([([('empty.bin', 0)], 6)])] == [b'']
+    with pytest.raises(FileNotFoundError):
+        store.read_range('missing.bin', 0, 6)
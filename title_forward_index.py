@@ -0,0 +1,103 @@
+import numpy as np
+
+from columnar_metadata import pack_arrays, unpack_arrays, load_buffer
+from lexicon import term_arrays, find_term
+
+TITLE_TERMS_PATH = 'id_title/title_terms.fwd'
+
+
+class TitleForwardIndex:
+    """ The (unstemmed, stopword-free) title tokens of every document, as
+        sorted unique term ids per doc id in CSR form: `doc_ids` (sorted wiki
+        ids), `starts` (row i's ids are term_ids[starts[i]:starts[i + 1]]) and
+        `term_ids`, with the term table of lexicon.py mapping tokens to ids.
+        Built once from the titles so scoring never re-tokenizes a title.
+    """
+    def __init__(self, arrays):
+        self.arrays = arrays
+        self.doc_ids = arrays['doc_ids']
+        self.starts = arrays['starts']
+        self.term_ids = arrays['term_ids']
+
+    @classmethod
+    def build(cls, doc_titles, tokenize):
+        """ Builds the index from (wiki_id, title) pairs, in any order, with
+            tokenize(title) -> tokens.
+        """
+        vocab = {}
+        rows = []
+        for doc_id, title in doc_titles:
+            ids = {vocab.setdefault(t, len(vocab)) for t in tokenize(title)}
+            rows.append((doc_id, sorted(ids)))
+        rows.sort(key=lambda row: row[0])
+        lengths = np.fromiter((len(ids) for _, ids in rows), dtype=np.int64, count=len(rows))
+        starts = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+        arrays = term_arrays(list(vocab))
+        arrays['doc_ids'] = np.fromiter((doc_id for doc_id, _ in rows), dtype=np.int64,
+                                        count=len(rows)).astype('<u4')
+        arrays['starts'] = starts.astype('<u4' if starts[-1] < 2**32 else '<u8')
+        arrays['term_ids'] = np.fromiter((i for _, ids in rows for i in ids), dtype='<u4',
+                                         count=int(starts[-1]))
+        return cls(arrays)
+
+    def to_bytes(self):
+        return pack_arrays({}, self.arrays)
+
+    @classmethod
+    def load(cls, store, path=TITLE_TERMS_PATH):
+        """ Loads through a storage backend - memory-mapped when it is local. """
+        return cls(unpack_arrays(load_buffer(store, path))[1])
+
+    def term_id(self, term):
+        """ Id of a title token, -1 when no title has it. """
+        return find_term(self.arrays, term)
+
+    def contains(self, doc_ids, term_ids):
+        """ Boolean (len(doc_ids), len(term_ids)) matrix: does the title of
+            each doc contain each term. Unknown docs and ids (-1) are False.
+        """
+        doc_ids = np.asarray(doc_ids, dtype=np.int64)
+        out = np.zeros((len(doc_ids), len(term_ids)), dtype=bool)
+        if len(self.doc_ids) == 0 or len(doc_ids) == 0:
+            return out
+        rows = np.searchsorted(self.doc_ids, doc_ids)
+        np.minimum(rows, len(self.doc_ids) - 1, out=rows)
+        found = self.doc_ids[rows] == doc_ids
+        lo = self.starts[rows].astype(np.int64)
+        lengths = np.where(found, self.starts[rows + 1].astype(np.int64) - lo, 0)
+        # every title token of every doc, with the doc's position alongside
+        owners = np.repeat(np.arange(len(doc_ids)), lengths)
+        positions = np.arange(lengths.sum()) + np.repeat(lo - (np.cumsum(lengths) - lengths), lengths)
+        tokens = self.term_ids[positions]
+        for j, term_id in enumerate(term_ids):
+            if term_id >= 0:
+                out[owners[tokens == term_id], j] = True
+        return out
+
+
+if __name__ == '__main__':
+    import argparse
+    import pickle
+    from pathlib import Path
+    from inverted_index_gcp import LocalStore
+    from title_store import TitleStore
+    from tokenizer import Tokenizer
+    parser = argparse.ArgumentParser(
+        description="Build the title forward index of a local mirror.")
+    parser.add_argument('root')
+    args = parser.parse_args()
+    root = Path(args.root)
+    try:
+        titles = TitleStore.load(LocalStore(root))
+    except FileNotFoundError:
+        title_dicts = []
+        for name in ('even_id_title_dict.pkl', 'uneven_id_title_dict.pkl'):
+            with open(root / 'id_title' / name, 'rb') as f:
+                title_dicts.append(pickle.load(f))
+        titles = TitleStore.build(title_dicts)
+    doc_ids = titles.keys()
+    # BackendClass.tokenize(title.lower(), stem=False), as one batch
+    title_tokens = Tokenizer().tokenize_many((t.lower() for t in titles.titles(doc_ids)), stem=False)
+    index = TitleForwardIndex.build(zip(doc_ids.tolist(), title_tokens), lambda tokens: tokens)
+    (root / TITLE_TERMS_PATH).write_bytes(index.to_bytes())
+    print(f"{len(index.doc_ids):,} titles, {len(index.term_ids):,} title terms -> {root / TITLE_TERMS_PATH}")
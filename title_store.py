@@ -0,0 +1,112 @@
+from pathlib import Path
+
+import numpy as np
+
+from columnar_metadata import ColumnarMetadata, load_buffer
+
+TITLES_PATH = 'id_title/titles.cols'
+TITLES_BLOB_PATH = 'id_title/titles.blob'
+TITLE_OFFSET = 'title_offset'
+TITLE_LENGTH = 'title_length'
+
+
+class TitleStore:
+    """ Article titles as one UTF-8 blob plus, per doc id row, the title's
+        byte offset and length (a columnar metadata file). Both files are
+        memory-mapped from a local store and a title is decoded only when it
+        is asked for. Rows are the dense doc ids of the DocIdMap the store was
+        built with; documents without a title have a missing offset.
+
+        Reads like the {wiki_id: title} dict it replaces (`get`, `in`, `len`,
+        `keys`), with `titles` to decode a batch at once.
+    """
+    def __init__(self, columns, blob):
+        self.columns = columns
+        self.blob = blob
+
+    @classmethod
+    def build(cls, title_dicts, doc_ids=None):
+        """ Builds the store from {wiki_id: title} dicts - later dicts win,
+            as in {**even, **odd} - over the rows `doc_ids` (sorted; defaults
+            to the titled ids, ids with a title are always added).
+        """
+        ids_parts, titles = [], []
+        for d in title_dicts:
+            ids_parts.append(np.fromiter(d.keys(), dtype=np.int64, count=len(d)))
+            titles.extend(d.values())
+        ids = np.concatenate(ids_parts or [np.empty(0, np.int64)])
+        # last occurrence of each id
+        unique_ids, first_from_end = np.unique(ids[::-1], return_index=True)
+        picks = len(ids) - 1 - first_from_end
+        rows = unique_ids if doc_ids is None else np.union1d(np.asarray(doc_ids, dtype=np.int64), unique_ids)
+
+        encoded = [titles[i].encode('utf-8') for i in picks.tolist()]
+        lengths = np.fromiter(map(len, encoded), dtype=np.int64, count=len(encoded))
+        offsets = np.concatenate([[0], np.cumsum(lengths)[:-1]]).astype(np.uint64)
+        positions = np.searchsorted(rows, unique_ids)
+        offset_column = np.full(len(rows), np.iinfo(np.uint64).max, dtype='<u8')
+        offset_column[positions] = offsets
+        length_column = np.zeros(len(rows), dtype='<u4')
+        length_column[positions] = lengths
+        columns = ColumnarMetadata(rows.astype('<u4'), {TITLE_OFFSET: offset_column,
+                                                        TITLE_LENGTH: length_column})
+        return cls(columns, b''.join(encoded))
+
+    def save(self, base_dir):
+        base_dir = Path(base_dir)
+        self.columns.save(base_dir / TITLES_PATH)
+        (base_dir / TITLES_BLOB_PATH).write_bytes(bytes(self.blob))
+
+    @classmethod
+    def load(cls, store):
+        """ Loads the store written by `save` through a storage backend. """
+        return cls(ColumnarMetadata.load(store, TITLES_PATH), load_buffer(store, TITLES_BLOB_PATH))
+
+    def titles(self, doc_ids, default=None):
+        """ Titles of many doc ids, `default` where there is none. """
+        offset_column = self.columns[TITLE_OFFSET]
+        rows, found = offset_column.find(np.atleast_1d(doc_ids))
+        if not found.any():
+            return [default] * len(rows)
+        offsets = offset_column.values_array[rows].tolist()
+        lengths = self.columns[TITLE_LENGTH].values_array[rows].tolist()
+        blob = self.blob
+        return [str(blob[o:o + n], 'utf-8') if f else default
+                for o, n, f in zip(offsets, lengths, found.tolist())]
+
+    def get(self, doc_id, default=None):
+        return self.titles([doc_id], default)[0]
+
+    def __contains__(self, doc_id):
+        return doc_id in self.columns[TITLE_OFFSET]
+
+    def __len__(self):
+        return len(self.columns[TITLE_OFFSET])
+
+    def keys(self):
+        """ Wiki ids that have a title. """
+        return self.columns[TITLE_OFFSET].keys()
+
+
+if __name__ == '__main__':
+    import argparse
+    import pickle
+    from doc_index import DocIdMap, DOC_IDS_PATH
+    parser = argparse.ArgumentParser(
+        description="Build the memory-mapped title store from the id_title pickles of a local mirror.")
+    parser.add_argument('root')
+    args = parser.parse_args()
+    root = Path(args.root)
+    title_dicts = []
+    for name in ('even_id_title_dict.pkl', 'uneven_id_title_dict.pkl'):
+        with open(root / 'id_title' / name, 'rb') as f:
+            title_dicts.append(pickle.load(f))
+    # rows follow the dense doc ids
+    if (root / DOC_IDS_PATH).exists():
+        doc_ids = np.load(root / DOC_IDS_PATH)
+    else:
+        with open(root / 'postings_gcp/doc_lengths.pkl', 'rb') as f:
+            doc_ids = DocIdMap.build(pickle.load(f)).wiki_ids
+    store = TitleStore.build(title_dicts, doc_ids)
+    store.save(root)
+    print(f"{len(store):,} titles -> {root / TITLES_PATH}")
@@ -0,0 +1,92 @@
+import re
+from functools import lru_cache
+
+from nltk.corpus import stopwords
+from nltk.stem.porter import PorterStemmer
+
+# the staff tokenizer pattern, as used by BackendClass
+RE_WORD_PATTERN = r"[\#\@\w](['\-]?\w){2,24}"
+STEM_CACHE_SIZE = 2**18
+QUERY_CACHE_SIZE = 2**14
+
+
+class Tokenizer:
+    """ Regex tokenization, stopword removal and Porter stemming with memo
+        caches, shared by BackendClass and QueryProcessor.
+
+        Stopwords and precompiled stems live in one lookup table (token ->
+        stem, None for a stopword), so filtering and stemming a known token is
+        a single dict lookup. Other stems go through a bounded LRU cache, and
+        whole `tokenize` results through another, keyed by the text.
+    """
+    def __init__(self, pattern=RE_WORD_PATTERN, stop_words=None, lowercase_text=False,
+                 stem_cache_size=STEM_CACHE_SIZE, query_cache_size=QUERY_CACHE_SIZE):
+        self.re_word = re.compile(pattern, re.UNICODE)
+        self.stop_words = frozenset(stopwords.words('english') if stop_words is None else stop_words)
+        # lowercase the whole text before matching instead of each token after
+        self.lowercase_text = lowercase_text
+        self.stemmer = PorterStemmer()
+        self._table = dict.fromkeys(self.stop_words)
+        self._stem = lru_cache(maxsize=stem_cache_size)(self.stemmer.stem)
+        self._tokenize = lru_cache(maxsize=query_cache_size)(self._tokenize_uncached)
+
+    def precompile(self, vocabulary):
+        """ Adds the stems of `vocabulary` (e.g. an index's unstemmed terms or
+            a query log's tokens) to the lookup table.
+        """
+        for token in vocabulary:
+            if token not in self._table:
+                self._table[token] = self._stem(token)
+
+    def stem(self, token):
+        stem = self._table.get(token)
+        return stem if stem is not None else self._stem(token)
+
+    def words(self, text):
+        """ All tokens of `text`, lowercased, stopwords included. """
+        if self.lowercase_text:
+            return [token.group() for token in self.re_word.finditer(text.lower())]
+        return [token.group().lower() for token in self.re_word.finditer(text)]
+
+    def _tokenize_uncached(self, text, stem):
+        table = self._table
+        if not stem:
+            return tuple(t for t in self.words(text) if t not in self.stop_words)
+        out = []
+        for t in self.words(text):
+            if t in table:
+                if table[t] is not None:
+                    out.append(table[t])
+            else:
+                out.append(self._stem(t))
+        return tuple(out)
+
+    def tokenize(self, text, stem=True):
+        """ Tokens of `text` without stopwords, stemmed if `stem`. """
+        return list(self._tokenize(text, stem))
+
+    def tokenize_many(self, texts, stem=True):
+        """ Batch tokenization for index building: yields the token list of
+            each text, with the stems of the whole batch memoized in a local
+            table that does not evict (and is dropped afterwards).
+        """
+        stop_words = self.stop_words
+        if not stem:
+            for text in texts:
+                yield [t for t in self.words(text) if t not in stop_words]
+            return
+        table = dict(self._table)
+        stemmer = self.stemmer
+        for text in texts:
+            out = []
+            for t in self.words(text):
+                s = table.get(t, t)
+                if s is t and t not in table:
+                    s = table[t] = stemmer.stem(t)
+                if s is not None:
+                    out.append(s)
+            yield out
+
+    def cache_info(self):
+        return {'table': len(self._table), 'stems': self._stem.cache_info()._asdict(),
+                'queries': self._tokenize.cache_info()._asdict()}
@@ -0,0 +1,40 @@
+import numpy as np
+
+
+def top_k_items(doc_ids, scores, k=None):
+    """ Selects the k best (doc_id, score) pairs without sorting everything.
+        Candidates are cut to the k best with an O(n) partition and only those
+        are sorted, by score descending then doc id ascending so ties always
+        come out in the same order.
+    Parameters:
+    -----------
+      doc_ids: array-like of ints
+      scores: array-like of numbers, aligned with doc_ids
+      k: number of results to keep, None keeps (and orders) all of them
+    Returns:
+    --------
+      list of (doc_id:int, score) tuples, best first.
+    """
+    doc_ids = np.asarray(doc_ids)
+    scores = np.asarray(scores)
+    n = len(scores)
+    if n == 0 or k == 0:
+        return []
+    if k is not None and k < n:
+        # value of the k-th best score; everything tied with it stays a
+        # candidate so the doc id tie-break below decides who makes the cut
+        kth = np.partition(scores, n - k)[n - k]
+        candidates = np.flatnonzero(scores >= kth)
+        doc_ids, scores = doc_ids[candidates], scores[candidates]
+    order = np.lexsort((doc_ids, -scores))[:k]
+    return list(zip(doc_ids[order].tolist(), scores[order].tolist()))
+
+
+def top_k(scores, k=None):
+    """ `top_k_items` over a {doc_id: score} dict. """
+    n = len(scores)
+    if n == 0:
+        return []
+    doc_ids = np.fromiter(scores.keys(), dtype=np.int64, count=n)
+    values = np.fromiter(scores.values(), dtype=np.float64, count=n)
+    return top_k_items(doc_ids, values, k)
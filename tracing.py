@@ -0,0 +1,311 @@
+import bisect
+import contextvars
+import functools
+import os
+import pickle
+import threading
+import time
+
+# IR_METRICS=0 turns the /metrics histograms and counters off; per-request
+# traces (`trace`) still work. Off, an instrumented call costs one flag check
+# and one context variable lookup.
+METRICS_ENV = "IR_METRICS"
+metrics_enabled = os.environ.get(METRICS_ENV, '1') != '0'
+
+# upper bounds (seconds) of the latency histogram buckets
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# seconds between the metric snapshots a shared worker publishes
+SHARE_INTERVAL = 1.0
+
+_current_trace = contextvars.ContextVar('ir_trace', default=None)
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Registry:
+    """ Histograms and counters by (name, labels), rendered in the Prometheus
+        text format. Gauges are read from callbacks at render time.
+
+        Under prefork_server every worker has its own registry; after
+        `share(directory)` in each worker, any worker's render() reports the
+        sum over all of them (gauges per worker), so counters stay monotonic
+        whichever worker answers the scrape.
+    """
+    def __init__(self):
+        self._histograms = {}
+        self._counters = {}
+        self._gauges = {}
+        self._help = {}
+        self._lock = threading.Lock()
+        self._shared_dir = None
+        self._share_interval = SHARE_INTERVAL
+
+    def describe(self, name, help_text):
+        self._help[name] = help_text
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def gauge(self, name, fn):
+        """ Registers fn() -> {labels tuple: value} (or a number) read on render. """
+        self._gauges[name] = fn
+
+    def snapshot(self):
+        """ This process's metrics as plain data. """
+        with self._lock:
+            histograms = {key: (list(h.counts), h.sum, h.count) for key, h in self._histograms.items()}
+            counters = dict(self._counters)
+        gauges = {}
+        for name, fn in self._gauges.items():
+            values = fn()
+            gauges[name] = values if isinstance(values, dict) else {(): values}
+        return {'pid': os.getpid(), 'time': time.time(), 'histograms': histograms,
+                'counters': counters, 'gauges': gauges}
+
+    def share(self, directory, interval=SHARE_INTERVAL):
+        """ Call in each worker process: drops the metrics inherited from the
+            parent and publishes this process's snapshot to `directory` every
+            `interval` seconds and on every render.
+        """
+        with self._lock:
+            self._histograms.clear()
+            self._counters.clear()
+        self._shared_dir = directory
+        self._share_interval = interval
+
+        def publish():
+            while True:
+                time.sleep(interval)
+                try:
+                    self._publish()
+                except Exception as e:
+                    print(f"Publishing metrics failed: {e!r}")
+        threading.Thread(target=publish, name='metrics-share', daemon=True).start()
+
+    def _publish(self):
+        snapshot = self.snapshot()
+        path = os.path.join(self._shared_dir, f"{snapshot['pid']}.pkl")
+        with open(path + '.tmp', 'wb') as f:
+            pickle.dump(snapshot, f)
+        os.replace(path + '.tmp', path)
+        return snapshot
+
+    def _shared_snapshots(self):
+        """ The snapshots of every process sharing the directory - exited
+            workers included, so their counts are not lost - with this one's
+            published first.
+        """
+        own = self._publish()
+        snapshots = [own]
+        for name in os.listdir(self._shared_dir):
+            if not name.endswith('.pkl') or name == f"{own['pid']}.pkl":
+                continue
+            try:
+                with open(os.path.join(self._shared_dir, name), 'rb') as f:
+                    snapshots.append(pickle.load(f))
+            except (OSError, EOFError, pickle.UnpicklingError):
+                continue
+        return snapshots
+
+    def render(self):
+        if self._shared_dir is None:
+            snapshots = [self.snapshot()]
+        else:
+            snapshots = self._shared_snapshots()
+        histograms, counters = {}, {}
+        for snapshot in snapshots:
+            for key, (counts, total, count) in snapshot['histograms'].items():
+                merged = histograms.setdefault(key, [[0] * len(counts), 0.0, 0])
+                merged[0] = [a + b for a, b in zip(merged[0], counts)]
+                merged[1] += total
+                merged[2] += count
+            for key, value in snapshot['counters'].items():
+                counters[key] = counters.get(key, 0) + value
+        gauges = {}
+        now = time.time()
+        for snapshot in snapshots:
+            if self._shared_dir is not None and now - snapshot['time'] > 3 * self._share_interval:
+                # an exited worker
+                continue
+            worker = () if self._shared_dir is None else (('worker', snapshot['pid']),)
+            for name, values in snapshot['gauges'].items():
+                for labels, value in values.items():
+                    gauges.setdefault(name, {})[tuple(labels) + worker] = value
+
+        lines = []
+        for name in sorted({name for name, _ in histograms}):
+            self._header(lines, name, 'histogram')
+            for (key_name, labels), (counts, total, count) in sorted(histograms.items()):
+                if key_name != name:
+                    continue
+                cumulative = 0
+                for bound, n in zip(BUCKETS + (float('inf'),), counts):
+                    cumulative += n
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append(f"{name}_bucket{_labels(labels + (('le', le),))} {cumulative}")
+                lines.append(f"{name}_sum{_labels(labels)} {total!r}")
+                lines.append(f"{name}_count{_labels(labels)} {count}")
+        for name in sorted({name for name, _ in counters}):
+            self._header(lines, name, 'counter')
+            for (key_name, labels), value in sorted(counters.items()):
+                if key_name == name:
+                    lines.append(f"{name}{_labels(labels)} {value}")
+        for name, values in sorted(gauges.items()):
+            self._header(lines, name, 'gauge')
+            for labels, value in sorted(values.items()):
+                lines.append(f"{name}{_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+    def _header(self, lines, name, kind):
+        if name in self._help:
+            lines.append(f"# HELP {name} {self._help[name]}")
+        lines.append(f"# TYPE {name} {kind}")
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in labels)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(labels, escaped)) + '}'
+
+
+REGISTRY = Registry()
+REGISTRY.describe('ir_stage_seconds', "Time spent in each stage of query processing.")
+REGISTRY.describe('ir_postings_fetched_total', "Posting lists fetched from the store, by posting folder.")
+REGISTRY.describe('ir_posting_bytes_fetched_total', "Posting bytes fetched from the store, by posting folder.")
+REGISTRY.describe('ir_posting_lists_read_total', "Posting lists read, by source (cache or store).")
+
+
+class Trace:
+    """ Stage timings and counts of one request: seconds and calls per stage
+        (stages nest, so their seconds overlap) and summed counters.
+    """
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.stages = {}
+        self.counts = {}
+        self._lock = threading.Lock()
+
+    def add(self, name, seconds):
+        with self._lock:
+            calls, total = self.stages.get(name, (0, 0.0))
+            self.stages[name] = (calls + 1, total + seconds)
+
+    def count(self, name, amount):
+        with self._lock:
+            self.counts[name] = self.counts.get(name, 0) + amount
+
+    def to_dict(self):
+        return {
+            'total_ms': (time.perf_counter() - self.start) * 1000,
+            'stages': {name: {'calls': calls, 'ms': seconds * 1000}
+                       for name, (calls, seconds) in self.stages.items()},
+            'counts': dict(self.counts),
+        }
+
+
+class trace:
+    """ `with trace() as t:` records the stages run in this context - and in
+        the threads it hands work to through `propagate` - into Trace t.
+    """
+    def __enter__(self):
+        self.trace = Trace()
+        self._token = _current_trace.set(self.trace)
+        return self.trace
+
+    def __exit__(self, *exc):
+        _current_trace.reset(self._token)
+
+
+def current_trace():
+    return _current_trace.get()
+
+
+def record(name, seconds):
+    if metrics_enabled:
+        REGISTRY.observe('ir_stage_seconds', seconds, stage=name)
+    t = _current_trace.get()
+    if t is not None:
+        t.add(name, seconds)
+
+
+def count(name, amount=1, **labels):
+    """ Adds to counter `name` (and to the current trace's count of it). """
+    if metrics_enabled:
+        REGISTRY.inc(name, amount, **labels)
+    t = _current_trace.get()
+    if t is not None:
+        t.count(name, amount)
+
+
+class stage:
+    """ `with stage('fusion'):` times the block as that stage. """
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        if metrics_enabled or _current_trace.get() is not None:
+            self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        if self.start is not None:
+            record(self.name, time.perf_counter() - self.start)
+
+
+def timed(name):
+    """ Decorator timing every call of a function as stage `name`. """
+    def decorate(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not metrics_enabled and _current_trace.get() is None:
+                return fn(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                record(name, time.perf_counter() - start)
+        return wrapper
+    return decorate
+
+
+def propagate(fn):
+    """ fn, run under the current trace when there is one - for work handed
+        to other threads (thread pools do not carry context variables over).
+    """
+    t = _current_trace.get()
+    if t is None:
+        return fn
+
+    def traced(*args, **kwargs):
+        token = _current_trace.set(t)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _current_trace.reset(token)
+    return traced